@@ -0,0 +1,139 @@
+"""
+Benchmark of decoding place rows: numeric coordinates as Decimal into dicts, as places were decoded
+before, against double precision coordinates as float into core.place.Place.
+Run from the project root: python -m benchmarks.bench_decode
+Text values are cast by the psycopg2 type casters as they are on fetching, so no server is needed;
+with DATABASE_URL set the rows are also fetched from PostgreSQL.
+"""
+
+import os
+import random
+import time
+import tracemalloc
+from itertools import starmap
+
+import psycopg2
+import psycopg2.extensions
+
+from core.database import NUMERIC_AS_FLOAT
+from core.place import Place
+
+ROWS = 100_000
+DECIMAL = psycopg2.extensions.DECIMAL
+FLOAT = psycopg2.extensions.FLOAT
+
+
+def dict_place(row: tuple) -> dict:
+    """ Place as core.database decoded it before """
+    return {
+        'id': row[0],
+        'lat': str(row[1]),
+        'long': str(row[2]),
+        'description': row[3],
+        'has_photo': row[4],
+        'photo_file_id': row[5]
+    }
+
+
+def text_rows(rnd: random.Random) -> list:
+    """ Rows as PostgreSQL sends them in the text format """
+    return [(str(num), f'{rnd.uniform(-80, 80):.7f}', f'{rnd.uniform(-180, 180):.7f}', f'Place number {num}',
+             't' if num % 10 == 0 else 'f', None) for num in range(ROWS)]
+
+
+def measure(func) -> tuple:
+    """ Best of 5 runs in seconds and the size of the result in MB """
+    best = min(_timed(func) for _ in range(5))
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return best, size / 1024 / 1024
+
+
+def _timed(func) -> float:
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+def report(name: str, seconds: float, size: float, baseline: float = None) -> None:
+    change = f' ({(seconds - baseline) / baseline * 100:+.1f} %)' if baseline else ''
+    print(f'{name:<34} {seconds * 1000:8.1f} ms {seconds / ROWS * 1_000_000_000:7.0f} ns/row '
+          f'{size:7.1f} MB{change}')
+
+
+def bench_casters() -> None:
+    """ Casting and decoding in the process, as psycopg2 does it for every fetched value """
+    rows = text_rows(random.Random(0))
+
+    def numeric_dicts():
+        return [dict_place((int(row[0]), DECIMAL(row[1], None), DECIMAL(row[2], None), row[3], row[4] == 't', row[5]))
+                for row in rows]
+
+    def numeric_as_float_places():
+        return [Place(int(row[0]), NUMERIC_AS_FLOAT(row[1], None), NUMERIC_AS_FLOAT(row[2], None), row[3],
+                      row[4] == 't', row[5]) for row in rows]
+
+    def double_places():
+        return [Place(int(row[0]), FLOAT(row[1], None), FLOAT(row[2], None), row[3], row[4] == 't', row[5])
+                for row in rows]
+
+    print(f'{ROWS} rows, type casters in the process')
+    baseline, size = measure(numeric_dicts)
+    report('numeric -> Decimal -> dict', baseline, size)
+    report('numeric -> float -> Place', *measure(numeric_as_float_places), baseline)
+    report('double -> float -> Place', *measure(double_places), baseline)
+
+
+def bench_server(db_url: str) -> None:
+    """ Fetching and decoding the same rows from PostgreSQL, numeric and double precision tables """
+    conn = psycopg2.connect(db_url)
+    try:
+        with conn.cursor() as cursor:
+            for table, column_type in (('bench_numeric', 'numeric'), ('bench_double', 'double precision')):
+                cursor.execute(f"""
+                    create temporary table {table} as
+                        select num::bigint as id,
+                            (random() * 160 - 80)::numeric(10, 7)::{column_type} as lat,
+                            (random() * 360 - 180)::numeric(10, 7)::{column_type} as long,
+                            'Place number ' || num as place_description,
+                            num % 10 = 0 as has_photo,
+                            null::varchar as photo_file_id
+                        from generate_series(1, {ROWS}) as num
+                """)
+            query = 'select id, lat, long, place_description, has_photo, photo_file_id from {}'
+
+            def fetch(table: str, decode, caster=None):
+                def run():
+                    with conn.cursor() as fetch_cursor:
+                        if caster is not None:
+                            psycopg2.extensions.register_type(caster, fetch_cursor)
+                        fetch_cursor.execute(query.format(table))
+                        return decode(fetch_cursor.fetchall())
+                return run
+
+            print(f'{ROWS} rows fetched from PostgreSQL')
+            baseline, size = measure(fetch('bench_numeric', lambda rows: [dict_place(row) for row in rows]))
+            report('numeric -> Decimal -> dict', baseline, size)
+            report('numeric -> float -> Place',
+                   *measure(fetch('bench_numeric', lambda rows: list(starmap(Place, rows)), NUMERIC_AS_FLOAT)),
+                   baseline)
+            report('double -> float -> Place',
+                   *measure(fetch('bench_double', lambda rows: list(starmap(Place, rows)))), baseline)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def main() -> None:
+    """ Running the benchmark in the process and, with DATABASE_URL, against PostgreSQL """
+    bench_casters()
+    if os.environ.get('DATABASE_URL'):
+        print()
+        bench_server(os.environ['DATABASE_URL'])
+
+
+if __name__ == '__main__':
+    main()
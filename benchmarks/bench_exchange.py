@@ -0,0 +1,70 @@
+"""
+Benchmark of export and import of places on the SQLite backend.
+Run from the project root: python -m benchmarks.bench_exchange
+Peak memory is measured by tracemalloc, so it covers Python objects only.
+"""
+
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from core import exchange
+from core.place import Place
+from core.sqlitedb import SqliteDatabase
+
+PLACES = 100_000
+USER_ID = 1
+
+
+def measure(func):
+    """ Running the function; (result, seconds, peak memory in MB) """
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main() -> None:
+    """ Importing generated places, then exporting and importing them back in every format """
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = SqliteDatabase(os.path.join(tmp_dir, 'bench.db'))
+        db.create_user(USER_ID)
+        source = os.path.join(tmp_dir, 'source.csv')
+        with open(source, 'w', newline='') as file:
+            exchange.write_csv(
+                (Place(num, rnd.uniform(-80, 80), rnd.uniform(-180, 180), f'Place number {num}')
+                 for num in range(PLACES)),
+                file
+            )
+        print(f'{PLACES} places')
+        with open(source, 'rb') as file:
+            (count, _), seconds, peak = measure(
+                lambda: exchange.import_places(db, USER_ID, file, 'source.csv', batch_size=5_000)
+            )
+        print(f'{"import csv (plain file)":<26} {seconds:7.2f} s {peak:8.2f} MB peak, {count} places')
+
+        for num, file_format in enumerate(exchange.FORMATS, start=2):
+            path = os.path.join(tmp_dir, f'export_{file_format}.zip')
+            with open(path, 'wb') as file:
+                count, seconds, peak = measure(
+                    lambda: exchange.export_places(db, USER_ID, file, file_format)
+                )
+            print(f'{"export " + file_format:<26} {seconds:7.2f} s {peak:8.2f} MB peak, {count} places, '
+                  f'{os.path.getsize(path) / 1024 / 1024:.1f} MB zip')
+            db.create_user(num)
+            with open(path, 'rb') as file:
+                (count, _), seconds, peak = measure(
+                    lambda: exchange.import_places(db, num, file, 'places.zip', batch_size=5_000)
+                )
+            print(f'{"import " + file_format:<26} {seconds:7.2f} s {peak:8.2f} MB peak, {count} places')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Benchmark of batch geodesy against the scalar core.locationcalc functions.
+Run from the project root: python -m benchmarks.bench_geodesy
+"""
+
+import random
+import timeit
+
+from core import geodesy
+from core.locationcalc import get_area_coord, get_distance
+
+POINTS = 100_000
+
+
+def main() -> None:
+    """ Comparing scalar loops and NumPy batches on the same random points """
+    rnd = random.Random(0)
+    lats = [rnd.uniform(-80, 80) for _ in range(POINTS)]
+    longs = [rnd.uniform(-180, 180) for _ in range(POINTS)]
+
+    cases = (
+        ('bounding areas, scalar',
+         lambda: [get_area_coord(lat, long, 500) for lat, long in zip(lats, longs)]),
+        ('bounding areas, batch',
+         lambda: geodesy.bounding_boxes(lats, longs, 500)),
+        ('distances, scalar',
+         lambda: [get_distance(51.5, 0.1, lat, long) for lat, long in zip(lats, longs)]),
+        ('distances, batch',
+         lambda: geodesy.distances(51.5, 0.1, lats, longs)),
+        ('radius mask, batch',
+         lambda: geodesy.within_radius(51.5, 0.1, lats, longs, 10_000)),
+    )
+    print(f'{POINTS} points, best of 5 runs')
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print(f'{name:<24} {best * 1000:9.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark of the logging cost in handlers.
+Run from the project root: python -m benchmarks.bench_logging
+A handler here is SqliteDatabase.get_last_places, which writes two debug records per call.
+"""
+
+import logging
+import os
+import statistics
+import tempfile
+import time
+import timeit
+
+import core.logs as logs
+from core.sqlitedb import SqliteDatabase
+
+CALLS = 20_000
+USER_ID = 1
+LOGGER = logging.getLogger('bench_logging.py')
+
+
+def latencies(func) -> tuple:
+    """ Mean and 99th percentile of the call latency in microseconds """
+    results = []
+    for _ in range(CALLS):
+        started = time.perf_counter()
+        func()
+        results.append((time.perf_counter() - started) * 1_000_000)
+    return statistics.mean(results), statistics.quantiles(results, n=100)[98]
+
+
+def reset_root() -> logging.Logger:
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    return root
+
+
+def main() -> None:
+    """ Comparing handler latency with logging off, with a direct file handler and with the queue pipeline """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = SqliteDatabase(os.path.join(tmp_dir, 'bench.db'))
+        db.create_user(USER_ID)
+        for num in range(100):
+            db.create_new_place(USER_ID, {'lat': 51.5, 'long': -0.1, 'description': f'Place {num}'})
+
+        def handler():
+            db.get_last_places(USER_ID)
+
+        print(f'{CALLS} calls')
+        root = reset_root()
+        root.setLevel(logging.INFO)
+        mean, p99 = latencies(handler)
+        print(f'{"debug off":<28} {mean:8.1f} us mean {p99:8.1f} us p99')
+
+        root.setLevel(logging.DEBUG)
+        file_handler = logging.FileHandler(os.path.join(tmp_dir, 'direct.log'))
+        file_handler.setFormatter(logging.Formatter(logs.LOG_FORMAT))
+        root.addHandler(file_handler)
+        mean, p99 = latencies(handler)
+        print(f'{"debug, direct file handler":<28} {mean:8.1f} us mean {p99:8.1f} us p99')
+
+        for json_format in (False, True):
+            reset_root()
+            listener = logs.setup_logging(level=logging.DEBUG, path=os.path.join(tmp_dir, f'queue_{json_format}'),
+                                          json_format=json_format)
+            mean, p99 = latencies(handler)
+            started = time.perf_counter()
+            listener.stop()
+            drained = time.perf_counter() - started
+            name = 'debug, queue, ' + ('json' if json_format else 'text')
+            print(f'{name:<28} {mean:8.1f} us mean {p99:8.1f} us p99, drained in {drained:.2f} s')
+        reset_root()
+        db.close()
+
+    # Cost of a disabled debug call: the f-string is built before the level is checked.
+    LOGGER.setLevel(logging.INFO)
+    place = {'id': 1, 'lat': 51.5, 'long': -0.1}
+    eager = min(timeit.repeat(lambda: LOGGER.debug(msg=f'UserID: {USER_ID}. Place: {place}'),
+                              number=CALLS, repeat=5))
+    lazy = min(timeit.repeat(lambda: LOGGER.debug('UserID: %s. Place: %s', USER_ID, place),
+                             number=CALLS, repeat=5))
+    print(f'{"disabled debug, f-string":<28} {eager / CALLS * 1_000_000_000:8.1f} ns per call')
+    print(f'{"disabled debug, %-style":<28} {lazy / CALLS * 1_000_000_000:8.1f} ns per call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark of the instrumentation cost of core.metrics.
+Run from the project root: python -m benchmarks.bench_metrics
+"""
+
+import os
+import tempfile
+import timeit
+
+from core.metrics import InstrumentedDatabase, Registry
+from core.sqlitedb import SqliteDatabase
+
+CALLS = 100_000
+USER_ID = 1
+
+
+def per_call(func, number: int = CALLS) -> float:
+    """ Best time of one call in nanoseconds """
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1_000_000_000
+
+
+def main() -> None:
+    """ Measuring single operations, then a real DB call with and without the timing proxy """
+    registry = Registry()
+    counter = registry.counter('bench_total', 'Benchmark counter.', ('method',))
+    histogram = registry.histogram('bench_seconds', 'Benchmark histogram.', ('method',))
+    child = histogram.labels('get_last_places')
+
+    def timed_block():
+        with child.time():
+            pass
+
+    cases = (
+        ('counter inc', lambda: counter.labels('get_last_places').inc()),
+        ('histogram observe', lambda: histogram.labels('get_last_places').observe(0.003)),
+        ('timer, bound child', timed_block),
+    )
+    for name, func in cases:
+        print(f'{name:<28} {per_call(func):8.1f} ns per call')
+
+    for num in range(50):
+        histogram.labels(f'method_{num}').observe(0.01)
+    print(f'{"render 50 histograms":<28} {per_call(registry.render, 1_000) / 1000:8.1f} us per call')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = SqliteDatabase(os.path.join(tmp_dir, 'bench.db'))
+        db.create_user(USER_ID)
+        for num in range(100):
+            db.create_new_place(USER_ID, {'lat': 51.5, 'long': -0.1, 'description': f'Place {num}'})
+        instrumented = InstrumentedDatabase(db)
+        plain = per_call(lambda: db.get_last_places(USER_ID), 10_000)
+        timed = per_call(lambda: instrumented.get_last_places(USER_ID), 10_000)
+        print(f'{"get_last_places, plain":<28} {plain / 1000:8.1f} us per call')
+        print(f'{"get_last_places, timed":<28} {timed / 1000:8.1f} us per call '
+              f'({(timed - plain) / plain * 100:+.1f} %)')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark of inline SQL queries against the prepared statements of core.database.
+It needs PostgreSQL: DATABASE_URL=postgres://... python -m benchmarks.bench_queries
+All rows are written in one transaction which is rolled back at the end.
+"""
+
+import os
+import random
+import timeit
+
+import psycopg2
+
+import core.locationcalc as loc
+from core.database import DISTANCE_SQL, SCHEMA, execute, prepare_statements
+
+USER_ID = -1
+PLACES = 10_000
+CALLS = 1_000
+
+
+def main() -> None:
+    """ Comparing per-call latency of inline and prepared queries on the same data """
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    rnd = random.Random(0)
+    try:
+        with conn.cursor() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement)
+            prepare_statements(conn)
+            execute(cursor, 'create_user', USER_ID)
+            for _ in range(PLACES):
+                lat, long = rnd.uniform(51.3, 51.7), rnd.uniform(-0.4, 0.2)
+                execute(cursor, 'create_new_place', USER_ID, lat, long, loc.get_cell_id(lat, long),
+                        'benchmark', None, None)
+            cursor.execute('analyze places')
+
+            lat, long = 51.5, -0.1
+            area = loc.get_area_coord(lat=lat, long=long, distance=2_000)
+            cells = loc.get_area_cells(area)
+            nearest_params = {'id': USER_ID, 'cells': cells, 'lat': lat, 'long': long,
+                              'radius': 2_000, 'limit': 10,
+                              'min_lat': area[0], 'min_long': area[1], 'max_lat': area[2], 'max_long': area[3]}
+
+            def last_inline():
+                cursor.execute(
+                    f"""
+                    select id, lat, long, place_description, photo is not null, photo_file_id
+                        from places
+                        where user_id = {USER_ID}
+                        order by created_at desc
+                        limit 10
+                    """
+                )
+                cursor.fetchall()
+
+            def last_prepared():
+                execute(cursor, 'get_last_places', USER_ID, 10)
+                cursor.fetchall()
+
+            def nearest_inline():
+                cursor.execute(
+                    f"""
+                    select id, lat, long, place_description, has_photo, photo_file_id, distance
+                        from (
+                            select id, lat, long, place_description, photo is not null as has_photo,
+                                photo_file_id, created_at,
+                                {DISTANCE_SQL} as distance
+                                from places
+                                where user_id = %(id)s
+                                    and cell = any(%(cells)s)
+                                    and (lat between %(min_lat)s and %(max_lat)s)
+                                    and (long between %(min_long)s and %(max_long)s)
+                        ) as candidates
+                        where distance <= %(radius)s
+                        order by distance, created_at desc
+                        limit %(limit)s;
+                    """,
+                    nearest_params
+                )
+                cursor.fetchall()
+
+            def nearest_prepared():
+                execute(cursor, 'get_nearest_places_cells', USER_ID, lat, long, *area, 2_000, 10, cells)
+                cursor.fetchall()
+
+            cases = (
+                ('last places, inline', last_inline),
+                ('last places, prepared', last_prepared),
+                ('nearest places, inline', nearest_inline),
+                ('nearest places, prepared', nearest_prepared),
+            )
+            print(f'{PLACES} places, {CALLS} calls, best of 5 runs')
+            for name, func in cases:
+                best = min(timeit.repeat(func, number=CALLS, repeat=5))
+                print(f'{name:<26} {best / CALLS * 1_000_000:9.1f} us per call')
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
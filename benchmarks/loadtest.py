@@ -0,0 +1,393 @@
+"""
+Load test of TelegramBot against a local fake Bot API server and a local database.
+Run from the project root: python -m benchmarks.loadtest --users 1000 --output loadtest.json
+Synthetic users go through the start, add place (with a photo), list, nearby and delete flows.
+A step is the time from an update being queued by the fake API until the bot sends its next menu.
+The report is JSON; --baseline prints the change against an earlier report.
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import telebot as tb
+
+import core.routes as routes
+from main import create_bot
+
+TOKEN = 'loadtest'
+
+
+class FakeBotApi:
+    """
+    Local stand-in of Telegram Bot API.
+    It serves queued updates to getUpdates, records sent messages,
+    adds latency and answers some calls by 429 Too Many Requests.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 1, seed: int = 0,
+                 photo_size: int = 50_000) -> None:
+        self._latency = latency
+        self._photo_size = photo_size
+        self._error_rate = error_rate
+        self._retry_after = retry_after
+        self._random = random.Random(seed)
+        self._cond = threading.Condition()
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._menus = Counter()
+        self._stopped = False
+        self.calls = Counter()
+        self.errors = 0
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._request_handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-api', daemon=True)
+
+    @property
+    def api_url(self) -> str:
+        """ Value of telebot.apihelper.API_URL for this server """
+        return f'http://127.0.0.1:{self._server.server_address[1]}/bot{{0}}/{{1}}'
+
+    @property
+    def file_url(self) -> str:
+        """ Value of telebot.apihelper.FILE_URL for this server """
+        return f'http://127.0.0.1:{self._server.server_address[1]}/file/bot{{0}}/{{1}}'
+
+    def photo_data(self, file_id: str) -> bytes:
+        """ Bytes of the photo file, the same for the same file_id """
+        return (hashlib.sha256(file_id.encode()).digest() * (self._photo_size // 32 + 1))[:self._photo_size]
+
+    def start(self) -> None:
+        """ Serving requests in a background thread """
+        self._thread.start()
+
+    def close(self) -> None:
+        """ Answering the waiting getUpdates and stopping the server """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update: dict) -> None:
+        """ Queueing an update for getUpdates """
+        with self._cond:
+            update['update_id'] = next(self._update_ids)
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def menus_sent(self, chat_id: int) -> int:
+        """ Number of messages with a keyboard sent to the chat """
+        with self._cond:
+            return self._menus[chat_id]
+
+    def wait_menus(self, chat_id: int, count: int, timeout: float) -> bool:
+        """ Waiting until `count` messages with a keyboard were sent to the chat """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._menus[chat_id] >= count, timeout)
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset', 0))
+        timeout = float(params.get('timeout', 0))
+        with self._cond:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            self._cond.wait_for(lambda: self._updates or self._stopped, timeout)
+            return self._updates[:100]
+
+    def _message(self, chat_id, **fields) -> dict:
+        return dict(message_id=next(self._message_ids), date=int(time.time()),
+                    chat={'id': int(chat_id), 'type': 'private'}, **fields)
+
+    def _answer(self, method: str, params: dict):
+        """ (HTTP status, answer) of an API call """
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if self._latency:
+            time.sleep(self._latency)
+        with self._cond:
+            self.calls[method] += 1
+            if self._error_rate and self._random.random() < self._error_rate:
+                self.errors += 1
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                             'parameters': {'retry_after': self._retry_after}}
+            if method == 'sendMessage' and params.get('reply_markup'):
+                self._menus[int(params['chat_id'])] += 1
+                self._cond.notify_all()
+        chat_id = params.get('chat_id', 0)
+        if method == 'sendMessage':
+            result = self._message(chat_id, text=params.get('text', ''))
+        elif method == 'sendPhoto':
+            result = self._message(chat_id, photo=[{'file_id': f'photo{next(self._message_ids)}',
+                                                    'width': 320, 'height': 180}])
+        elif method == 'sendMediaGroup':
+            result = [self._message(chat_id, photo=[{'file_id': f'photo{next(self._message_ids)}',
+                                                     'width': 320, 'height': 180}])
+                      for _ in json.loads(params.get('media', '[]'))]
+        elif method in ('sendVenue', 'sendDocument'):
+            result = self._message(chat_id)
+        elif method == 'getFile':
+            result = {'file_id': params['file_id'], 'file_size': self._photo_size,
+                      'file_path': f"photos/{params['file_id']}.jpg"}
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def _request_handler_class(self):
+        api = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            """ Handler of Bot API requests """
+
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are separate writes; with Nagle on, keep-alive calls wait for delayed ACKs.
+            disable_nagle_algorithm = True
+
+            def _handle(self) -> None:
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                if body and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+                if url.path.startswith('/file/'):
+                    status, content_type = 200, 'image/jpeg'
+                    data = api.photo_data(url.path.rsplit('/', 1)[-1][:-len('.jpg')])
+                    with api._cond:
+                        api.calls['file'] += 1
+                else:
+                    status, answer = api._answer(url.path.rsplit('/', 1)[-1], params)
+                    data, content_type = json.dumps(answer).encode(), 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return RequestHandler
+
+
+def _user(chat_id: int) -> dict:
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+
+
+def message_update(chat_id: int, **fields) -> dict:
+    """ Update with a message of the user """
+    return {'message': dict(message_id=1, date=int(time.time()), chat={'id': chat_id, 'type': 'private'},
+                            **{'from': _user(chat_id)}, **fields)}
+
+
+def callback_update(chat_id: int, menu_text: str, data: str) -> dict:
+    """ Update with a tap on a button of the menu """
+    return {'callback_query': {
+        'id': str(chat_id), 'chat_instance': str(chat_id), 'data': data, 'from': _user(chat_id),
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                    'text': menu_text},
+    }}
+
+
+def photo_sizes(file_id: str) -> list:
+    """ Sizes of a photo as Telegram sends them, the smallest first """
+    return [{'file_id': f'{file_id}_{width}', 'width': width, 'height': width * 9 // 16}
+            for width in (90, 320, 800, 1280)]
+
+
+def user_flow(chat_id: int, places: int, photos: int, rnd: random.Random) -> list:
+    """ (step name, update) pairs of one synthetic user; every step ends with a menu """
+    lat, long = rnd.uniform(51.3, 51.7), rnd.uniform(-0.4, 0.2)
+    steps = [('start', message_update(chat_id, text='/start',
+                                      entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}]))]
+    for num in range(places):
+        location = {'latitude': lat + rnd.uniform(-0.01, 0.01), 'longitude': long + rnd.uniform(-0.01, 0.01)}
+        steps += [
+            ('add_place', callback_update(chat_id, routes.MAIN_MENU_TEXT, 'add_place')),
+            ('place_location', message_update(chat_id, location=location)),
+            ('place_description', message_update(chat_id, text=f'Place {num} of user {chat_id}')),
+        ]
+        if photos:
+            # Users send photos from a common set, so some of them are duplicates.
+            steps.append(('place_photo', message_update(chat_id, photo=photo_sizes(f'photo{rnd.randrange(photos)}'))))
+        steps += [
+            ('place_save', callback_update(chat_id, routes.PLACE_MENU_TEXT, 'save')),
+        ]
+    steps += [
+        ('list_places', callback_update(chat_id, routes.MAIN_MENU_TEXT, 'get_places')),
+        ('nearby_places', message_update(chat_id, location={'latitude': lat, 'longitude': long})),
+        ('delete_places', callback_update(chat_id, routes.MAIN_MENU_TEXT, 'delete_places')),
+    ]
+    return steps
+
+
+def percentiles(values: list) -> dict:
+    """ Count, p50, p90, p99 and max of the latencies in milliseconds """
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def at(share: float) -> float:
+        return round(values[min(len(values) - 1, int(share * len(values)))] * 1000, 2)
+
+    return {'count': len(values), 'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99),
+            'max_ms': round(values[-1] * 1000, 2), 'mean_ms': round(statistics.mean(values) * 1000, 2)}
+
+
+def git_version() -> str:
+    """ Commit of the tree, 'unknown' outside of git """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(args, config: dict) -> dict:
+    """ Running the synthetic users against the bot; the report is returned """
+    api = FakeBotApi(latency=args.latency, error_rate=args.error_rate, retry_after=args.retry_after, seed=args.seed,
+                     photo_size=args.photo_size)
+    api.start()
+    tb.apihelper.API_URL = api.api_url
+    tb.apihelper.FILE_URL = api.file_url
+    bot = create_bot(config)
+    bot_thread = threading.Thread(target=bot.run, name='bot', daemon=True)
+    bot_thread.start()
+
+    latencies = defaultdict(list)
+    timeouts = Counter()
+    lock = threading.Lock()
+    rnd = random.Random(args.seed)
+    flows = [(1_000_000 + num, user_flow(1_000_000 + num, args.places, args.photos, rnd)) for num in range(args.users)]
+
+    def drive(chat_id: int, steps: list) -> None:
+        for name, update in steps:
+            expected = api.menus_sent(chat_id) + 1
+            started = time.perf_counter()
+            api.push_update(update)
+            done = api.wait_menus(chat_id, expected, args.step_timeout)
+            with lock:
+                if done:
+                    latencies[name].append(time.perf_counter() - started)
+                else:
+                    timeouts[name] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(drive, chat_id, steps) for chat_id, steps in flows]:
+            future.result()
+    duration = time.perf_counter() - started
+    stats = bot.stats()
+    bot.stop()
+    bot_thread.join(60)
+    api.close()
+
+    updates = sum(len(steps) for _, steps in flows)
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'version': git_version(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        # The fake API and the drivers run in the same process and share the CPUs with the bot.
+        'cpus': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'config': {key: value for key, value in config.items() if key != 'TOKEN'},
+        'updates': updates,
+        'duration_s': round(duration, 3),
+        'updates_per_s': round(updates / duration, 1),
+        'latency': percentiles(all_latencies),
+        'latency_by_step': {name: percentiles(values) for name, values in sorted(latencies.items())},
+        'timeouts': dict(timeouts),
+        'api_calls': dict(api.calls),
+        'api_429_answers': api.errors,
+        # ru_maxrss is in kilobytes on Linux; it covers the fake API and the drivers too.
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'bot_stats': stats,
+    }
+
+
+def compare(report: dict, baseline: dict) -> list:
+    """ Lines with the change of the main numbers against the baseline report """
+    numbers = (
+        ('updates/s', ('updates_per_s',)),
+        ('p50 ms', ('latency', 'p50_ms')),
+        ('p99 ms', ('latency', 'p99_ms')),
+        ('peak RSS MB', ('peak_rss_mb',)),
+    )
+    lines = [f"baseline {baseline.get('version')} -> {report.get('version')}"]
+    for name, path in numbers:
+        old, new = baseline, report
+        for key in path:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if old and new is not None:
+            lines.append(f'{name:<12} {old:>10} -> {new:>10} ({(new - old) / old * 100:+.1f} %)')
+    return lines
+
+
+def main() -> None:
+    """ Parsing arguments, running the load test and saving the report """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='synthetic users')
+    parser.add_argument('--places', type=int, default=2, help='places added by every user')
+    parser.add_argument('--concurrency', type=int, default=100, help='users active at the same time')
+    parser.add_argument('--photos', type=int, default=20, help='distinct photos sent by the users, 0 for none')
+    parser.add_argument('--photo-size', type=int, default=50_000, help='bytes of a photo file')
+    parser.add_argument('--latency', type=float, default=0.005, help='latency of the fake API, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls answered by 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of the 429 answers, seconds')
+    parser.add_argument('--step-timeout', type=float, default=60, help='seconds to wait for a menu')
+    parser.add_argument('--database-url', default=None, help='database URL, a temporary SQLite file by default')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='configuration of the bot, as in config.json')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadtest.json', help='path of the JSON report')
+    parser.add_argument('--baseline', default=None, help='earlier JSON report to compare with')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR, format='%(levelname)s ; %(asctime)s ; %(name)s ; %(message)s')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = {
+            'TOKEN': TOKEN,
+            'DATABASE_URL': args.database_url or f"sqlite:///{os.path.join(tmp_dir, 'loadtest.db')}",
+            # Telegram limits are lifted by default, so the bot itself is measured.
+            'SEND_RATE': 100_000,
+            'CHAT_SEND_RATE': 100_000,
+        }
+        for item in args.set:
+            key, _, value = item.partition('=')
+            config[key] = value
+        report = run(args, config)
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps({key: report[key] for key in ('updates', 'duration_s', 'updates_per_s', 'latency',
+                                                   'timeouts', 'api_429_answers', 'peak_rss_mb')}, indent=2))
+    print(f'Report: {args.output}')
+    if args.baseline:
+        with open(args.baseline) as file:
+            print('\n'.join(compare(report, json.load(file))))
+    if report['timeouts']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Module of program which contains an asyncio client of Telegram Bot API.
+Requests are made with aiohttp; answers are parsed to pyTelegramBotAPI types.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+import telebot as tb
+
+from core.metrics import API_CALL_SECONDS, API_ERRORS
+
+LOGGER = logging.getLogger('aiobot.py')
+
+API_URL = 'https://api.telegram.org'
+# aiohttp has no SOCKS support.
+PROXY_SCHEMES = ('http', 'https')
+
+
+def is_supported_proxy(proxy_url: str) -> bool:
+    """ Checking whether aiohttp can connect through the proxy """
+    return urlparse(proxy_url).scheme in PROXY_SCHEMES
+
+
+class ApiError(Exception):
+    """ Unsuccessful answer of Telegram Bot API """
+
+    def __init__(self, method: str, answer: dict) -> None:
+        super().__init__(f'A request to the Telegram API was unsuccessful. '
+                         f'Method: {method}. Answer: {answer}')
+        self.method = method
+        self.error_code = answer.get('error_code')
+        self.description = answer.get('description')
+
+
+class BotApi:
+    """ asyncio client of Telegram Bot API """
+
+    def __init__(self, token: str, proxy_url: str = None, api_url: str = API_URL,
+                 max_retries: int = 3) -> None:
+        if proxy_url and not is_supported_proxy(proxy_url):
+            raise ValueError(f'Only HTTP proxies are supported, not {urlparse(proxy_url).scheme}.')
+        self._token = token
+        self._proxy_url = proxy_url
+        self._api_url = api_url
+        self._max_retries = max_retries
+        self._session = None
+
+    async def start(self) -> None:
+        """ Opening the HTTP session; it must be done inside the event loop """
+        self._session = aiohttp.ClientSession()
+
+    async def close(self) -> None:
+        """ Closing the HTTP session """
+        if self._session is not None:
+            await self._session.close()
+
+    @staticmethod
+    def _form_value(value) -> str:
+        if hasattr(value, 'to_json'):
+            return value.to_json()
+        if isinstance(value, (list, dict)):
+            return json.dumps(value)
+        return str(value)
+
+    def _request_data(self, params: dict, files: dict):
+        if not files:
+            return {key: self._form_value(value) for key, value in params.items()}
+        form = aiohttp.FormData()
+        for key, value in params.items():
+            form.add_field(key, self._form_value(value))
+        for key, value in files.items():
+            file_name, value = value if isinstance(value, tuple) else (key, value)
+            form.add_field(key, value, filename=file_name)
+        return form
+
+    @staticmethod
+    async def _answer(response: aiohttp.ClientResponse) -> dict:
+        """ Answer of the API; a body which isn't a JSON object (e.g. an error page of a proxy) is an error """
+        try:
+            answer = await response.json(content_type=None)
+        except ValueError:
+            answer = None
+        if not isinstance(answer, dict):
+            return {'ok': False, 'error_code': response.status, 'description': 'The answer is not a JSON object.'}
+        return answer
+
+    async def call(self, method: str, files: dict = None, **params):
+        """ Calling API method; 'Too Many Requests' answers are retried after the asked delay """
+        params = {key: value for key, value in params.items() if value is not None}
+        url = f'{self._api_url}/bot{self._token}/{method}'
+        timeout = aiohttp.ClientTimeout(total=params.get('timeout', 0) + 30)
+        histogram = API_CALL_SECONDS.labels(method)
+        for attempt in range(self._max_retries + 1):
+            started = time.perf_counter()
+            try:
+                async with self._session.post(url, data=self._request_data(params, files),
+                                              proxy=self._proxy_url, timeout=timeout) as response:
+                    answer = await self._answer(response)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+            if answer.get('ok'):
+                return answer['result']
+            API_ERRORS.labels(method).inc()
+            retry_after = answer.get('parameters', {}).get('retry_after')
+            if answer.get('error_code') != 429 or retry_after is None or attempt == self._max_retries:
+                raise ApiError(method, answer)
+            LOGGER.warning(msg=f'Too Many Requests, method {method}, retry after {retry_after} s.')
+            await asyncio.sleep(retry_after)
+
+    async def get_updates(self, offset: int = None, timeout: int = 10) -> list:
+        """ Long polling of updates """
+        result = await self.call('getUpdates', offset=offset, timeout=timeout)
+        return [tb.types.Update.de_json(update) for update in result]
+
+    async def delete_webhook(self) -> None:
+        """ Deleting webhook, which is required for long polling """
+        await self.call('deleteWebhook')
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None):
+        """ Sending text message """
+        result = await self.call('sendMessage', chat_id=chat_id, text=text, reply_markup=reply_markup)
+        return tb.types.Message.de_json(result)
+
+    async def send_photo(self, chat_id: int, photo, caption: str = None):
+        """ Sending photo by file_id or bytes """
+        if isinstance(photo, str):
+            result = await self.call('sendPhoto', chat_id=chat_id, photo=photo, caption=caption)
+        else:
+            result = await self.call('sendPhoto', files={'photo': photo}, chat_id=chat_id, caption=caption)
+        return tb.types.Message.de_json(result)
+
+    async def send_media_group(self, chat_id: int, media: list) -> list:
+        """ Sending album of InputMediaPhoto """
+        files = {}
+        items = []
+        for input_media in media:
+            item = input_media.to_dic()
+            if item['media'].startswith('attach://'):
+                files[item['media'][len('attach://'):]] = input_media.media
+            items.append(item)
+        result = await self.call('sendMediaGroup', files=files, chat_id=chat_id, media=items)
+        return [tb.types.Message.de_json(message) for message in result]
+
+    async def send_venue(self, chat_id: int, latitude: float, longitude: float, title: str, address: str):
+        """ Sending location with title and address """
+        result = await self.call('sendVenue', chat_id=chat_id, latitude=latitude, longitude=longitude,
+                                 title=title, address=address)
+        return tb.types.Message.de_json(result)
+
+    async def send_document(self, chat_id: int, document: bytes, file_name: str):
+        """ Sending file """
+        result = await self.call('sendDocument', files={'document': (file_name, document)}, chat_id=chat_id)
+        return tb.types.Message.de_json(result)
+
+    async def get_file(self, file_id: str):
+        """ Getting file info """
+        return tb.types.File.de_json(await self.call('getFile', file_id=file_id))
+
+    async def download_file(self, file_path: str) -> bytes:
+        """ Downloading file by path from get_file """
+        url = f'{self._api_url}/file/bot{self._token}/{file_path}'
+        async with self._session.get(url, proxy=self._proxy_url) as response:
+            response.raise_for_status()
+            return await response.read()
@@ -0,0 +1,256 @@
+"""
+Module of program which contains class to work with PostgreSQL Database from asyncio.
+It has the same methods as core.database.Database, as coroutines.
+"""
+
+import asyncio
+import logging
+from itertools import starmap
+
+import asyncpg
+
+import core.locationcalc as loc
+from core import geodesy
+from core.database import ITER_PLACES_SQL, NEAR_RADII, SCHEMA, STATEMENTS, get_search_query
+from core.photos import photo_row, place_batches
+from core.place import Place
+
+LOGGER = logging.getLogger('aiodatabase.py')
+
+
+# Columns of the places copied by import_places.
+IMPORT_COLUMNS = ('user_id', 'lat', 'long', 'cell', 'place_description', 'photo_hash', 'photo_file_id')
+
+
+async def _setup_connection(conn) -> None:
+    """ Decoding numbers which are still numeric to float instead of Decimal """
+    await conn.set_type_codec('numeric', encoder=str, decoder=float, schema='pg_catalog', format='text')
+
+
+def _batch_records(batches, user_id: int) -> tuple:
+    """ Photos and place records of the next batch, None after the last one; it runs in the executor """
+    batch = next(batches, None)
+    if batch is None:
+        return None
+    photos, records = {}, []
+    for content in batch:
+        photo = photo_row(content)
+        if photo is not None:
+            photos[photo[0]] = photo[1]
+        records.append((user_id, float(content['lat']), float(content['long']),
+                        loc.get_cell_id(content['lat'], content['long']), content['description'],
+                        photo[0] if photo else None, content.get('photo_file_id')))
+    return list(photos.items()), records
+
+
+class AsyncDatabase:
+    """  class to work with PostgreSQL Database from asyncio """
+
+    def __init__(self, db_url: str, min_conn: int = 1, max_conn: int = 10,
+                 pool_timeout: float = 10.0) -> None:
+        self._db_url = db_url
+        self._min_conn = min_conn
+        self._max_conn = max_conn
+        self._pool_timeout = pool_timeout
+        self._pool = None
+
+    async def connect(self) -> None:
+        """ Creating the connection pool and the tables; it must be done inside the event loop """
+        LOGGER.info(msg='AsyncDatabase class initialisation.')
+        try:
+            self._pool = await asyncpg.create_pool(
+                self._db_url,
+                min_size=self._min_conn,
+                max_size=self._max_conn,
+                timeout=self._pool_timeout,
+                init=_setup_connection,
+                ssl='require'
+            )
+            LOGGER.info(msg='The connection to DB has been created.')
+        except Exception as err:
+            LOGGER.error(msg=f'Problem connecting to database. Error: {err}')
+            return
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    for statement in SCHEMA:
+                        await conn.execute(statement)
+            LOGGER.info(msg='The tables have been created.')
+        except Exception as err:
+            LOGGER.error(msg=f'Problem connecting to database. Error: {err}')
+
+    async def create_user(self, user_id: int) -> None:
+        """ Creating new user in DB """
+        LOGGER.debug('Creating user. UserID: %s.', user_id)
+        try:
+            await self._pool.execute(STATEMENTS['create_user'][1], user_id)
+            LOGGER.debug('UserID: %s has bean created.', user_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem creating user. UserID: {user_id}. Error: {err}')
+
+    async def get_last_places(self, user_id: int, limit: int = 10, before_id: int = None) -> list:
+        """ Getting last places; the next page starts before the place with `before_id` """
+        LOGGER.debug('Getting last places. UserID: %s, before: %s.', user_id, before_id)
+        try:
+            if before_id is None:
+                records = await self._pool.fetch(STATEMENTS['get_last_places'][1], user_id, limit)
+            else:
+                records = await self._pool.fetch(STATEMENTS['get_last_places_before'][1], user_id, before_id, limit)
+            LOGGER.debug('Getting last places. UserID: %s - Success.', user_id)
+            return list(starmap(Place, records))
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting last places. UserID: {user_id}. Error: {err}')
+
+    async def iter_places(self, user_id: int, chunk_size: int = 1000):
+        """ Async generator of all places of the user, oldest first, with created_at; rows come in chunks """
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                async for record in conn.cursor(
+                        ITER_PLACES_SQL.replace('%(id)s', '$1'), user_id, prefetch=chunk_size):
+                    yield Place(*record)
+
+    async def import_places(self, user_id: int, places, batch_size: int = 1000) -> int:
+        """
+        Inserting places from the iterable in batches, photos by executemany and places by COPY.
+        The iterable is read in the default executor, so parsing of a file doesn't block the event loop.
+        All batches are one transaction; the number of places is returned, None on errors.
+        """
+        LOGGER.debug('Importing places. UserID: %s.', user_id)
+        loop = asyncio.get_running_loop()
+        batches = place_batches(places, batch_size)
+        count = 0
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    while True:
+                        batch = await loop.run_in_executor(None, _batch_records, batches, user_id)
+                        if batch is None:
+                            break
+                        photos, records = batch
+                        if photos:
+                            await conn.executemany(STATEMENTS['save_photo'][1], photos)
+                        await conn.copy_records_to_table('places', records=records, columns=IMPORT_COLUMNS)
+                        count += len(records)
+            LOGGER.debug('Importing places. UserID: %s - Success.', user_id)
+            return count
+        except Exception as err:
+            LOGGER.error(msg=f'Problem importing places. UserID: {user_id}. Error: {err}')
+
+    async def delete_places(self, user_id: int) -> None:
+        """ Deleting all places of user and their photos which no other place has """
+        LOGGER.debug('Deleting all places of user. UserID: %s.', user_id)
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    records = await conn.fetch(STATEMENTS['delete_places'][1], user_id)
+                    hashes = list({record['photo_hash'] for record in records if record['photo_hash'] is not None})
+                    if hashes:
+                        await conn.execute(STATEMENTS['delete_unused_photos'][1], hashes)
+            LOGGER.debug('All places of UserID: %s have bean deleted.', user_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem with deleting user\'s places. UserID: {user_id}. Error: {err}')
+
+    async def get_near_places(self, user_id: int, area: list) -> list:
+        """ Getting all places near location (places which wre located into some area) """
+        LOGGER.debug('Getting places near location. UserID: %s.', user_id)
+        cells = loc.get_area_cells(area)
+        try:
+            if cells:
+                records = await self._pool.fetch(STATEMENTS['get_near_places_cells'][1], user_id, *area, cells)
+            else:
+                records = await self._pool.fetch(STATEMENTS['get_near_places'][1], user_id, *area)
+            LOGGER.debug('Getting places near location. UserID: %s - Success.', user_id)
+            return list(starmap(Place, records))
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting places near location. UserID: {user_id}. Error: {err}')
+
+    async def get_nearest_places(self, user_id: int, lat: float, long: float, limit: int = 10,
+                                 radii: tuple = NEAR_RADII) -> list:
+        """
+        Getting up to `limit` places closest to the location, ordered by distance.
+        The search ring grows until enough places are found.
+        """
+        LOGGER.debug('Getting nearest places. UserID: %s.', user_id)
+        try:
+            records = []
+            async with self._pool.acquire() as conn:
+                for radius, area in zip(radii, geodesy.search_areas(lat, long, radii)):
+                    cells = loc.get_area_cells(area)
+                    params = (user_id, float(lat), float(long), *area, radius, limit)
+                    if cells:
+                        records = await conn.fetch(STATEMENTS['get_nearest_places_cells'][1], *params, cells)
+                    else:
+                        records = await conn.fetch(STATEMENTS['get_nearest_places'][1], *params)
+                    if len(records) >= limit:
+                        break
+            LOGGER.debug('Getting nearest places. UserID: %s - Success.', user_id)
+            return list(starmap(Place, records))
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting nearest places. UserID: {user_id}. Error: {err}')
+
+    async def create_new_place(self, user_id: int, content: dict) -> bool:
+        """ Creating a new place in DB; True after the commit, False on errors """
+        LOGGER.debug('Creating new place. UserID: %s.', user_id)
+        try:
+            photo = photo_row(content)
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    if photo is not None:
+                        await conn.execute(STATEMENTS['save_photo'][1], *photo)
+                    await conn.execute(
+                        STATEMENTS['create_new_place'][1],
+                        user_id, float(content['lat']), float(content['long']),
+                        loc.get_cell_id(content['lat'], content['long']),
+                        content['description'], photo[0] if photo else None, content.get('photo_file_id')
+                    )
+            LOGGER.debug('Creating new place. UserID: %s - Success.', user_id)
+            return True
+        except Exception as err:
+            LOGGER.error(msg=f'Problem creating new place. UserID: {user_id}. Error: {err}')
+            return False
+
+    async def search_places(self, user_id: int, text: str, limit: int = 10, offset: int = 0) -> list:
+        """ Getting places whose description has the words of the text, best matches first """
+        LOGGER.debug('Searching places. UserID: %s.', user_id)
+        query = get_search_query(text)
+        if not query:
+            return []
+        try:
+            records = await self._pool.fetch(STATEMENTS['search_places'][1], user_id, query, limit, offset)
+            LOGGER.debug('Searching places. UserID: %s - Success.', user_id)
+            return list(starmap(Place, records))
+        except Exception as err:
+            LOGGER.error(msg=f'Problem searching places. UserID: {user_id}. Error: {err}')
+
+    async def get_place_photo(self, place_id: int) -> bytes:
+        """ Getting photo bytes of the place, only when they have to be uploaded """
+        try:
+            return await self._pool.fetchval(STATEMENTS['get_place_photo'][1], place_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting place photo. PlaceID: {place_id}. Error: {err}')
+
+    async def set_photo_file_id(self, place_id: int, file_id: str) -> None:
+        """ Saving Telegram file_id of the place photo to send it without uploading """
+        try:
+            await self._pool.execute(STATEMENTS['set_photo_file_id'][1], file_id, place_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem saving photo file_id. PlaceID: {place_id}. Error: {err}')
+
+    def stats(self) -> dict:
+        """ Connection pool counters """
+        if self._pool is None:
+            return {}
+        return {
+            'size': self._pool.get_size(),
+            'max_size': self._pool.get_max_size(),
+            'idle': self._pool.get_idle_size(),
+        }
+
+    async def close(self) -> None:
+        """ Closing connection to DB """
+        try:
+            await self._pool.close()
+            LOGGER.info(msg=f'The connection to DB has been closed.')
+        except Exception as err:
+            LOGGER.error(msg=f'Problem with closing DB connection. Error: {err}')
+
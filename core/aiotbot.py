@@ -0,0 +1,439 @@
+"""
+Module of program which contains class of Telegram bot on asyncio.
+It follows the same routing as core.tbot.TelegramBot, but all conversations
+run as tasks of one event loop.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from zipfile import ZipFile
+
+import aiohttp
+import telebot as tb
+
+import core.exchange as exchange
+import core.flows as flows
+import core.logs as logs
+import core.photos as photos
+import core.routes as routes
+from core.aiobot import ApiError, BotApi
+from core.metrics import HANDLER_ERRORS, HANDLER_SECONDS, REGISTRY
+from core.profiling import MemoryTracer, SamplingProfiler
+from core.session import MemorySessionStore
+
+LOGGER = logging.getLogger('aiotbot.py')
+
+PENDING_PHOTOS = 1000  # Photos processed for places which are not saved yet.
+PHOTO_TIMEOUT = 60
+POLLING_MAX_DELAY = 60
+
+
+class AsyncTelegramBot:
+    """ Class of Telegram bot on asyncio """
+
+    def __init__(self, token: str, db, proxy_url: str, adm_pin: str,
+                 max_concurrency: int = 1000, sessions=None, profile_seconds: float = 30,
+                 photo_max_side: int = photos.MAX_SIDE, photo_quality: int = photos.QUALITY,
+                 exchange_workers: int = 2) -> None:
+        LOGGER.info(msg='Async Telegram bot initialisation.')
+        self._db = db
+        self.__adm_pin = adm_pin
+        self._api = BotApi(token, proxy_url=proxy_url)
+        self._max_concurrency = max_concurrency
+        # Sessions of users who are in the progress of adding a new place.
+        self._sessions = sessions if sessions is not None else MemorySessionStore()
+        # This set contains users who ask admin mode.
+        self._admin_set = set()
+        # Profilers started from the admin menu; they are off until then.
+        self._profiler = SamplingProfiler()
+        self._memory_tracer = MemoryTracer()
+        self._profile_seconds = profile_seconds
+        self._profile_task = None
+        # Tasks which download and prepare photos by file_id while the user goes on adding the place.
+        self._photo_tasks = {}
+        self._photo_max_side = photo_max_side
+        self._photo_quality = photo_quality
+        # Export and import write and parse files in their own threads; the DB is called back in the loop.
+        self._exchange = ThreadPoolExecutor(max_workers=exchange_workers, thread_name_prefix='exchange')
+        # Locks which keep updates of one chat in order, with the number of their users.
+        self._chat_locks = {}
+        self._semaphore = None
+
+    async def _handle_update(self, chat_id: int, update) -> None:
+        lock, users = self._chat_locks.get(chat_id, (asyncio.Lock(), 0))
+        self._chat_locks[chat_id] = (lock, users + 1)
+        try:
+            async with lock:
+                if update.message:
+                    await self._handle_message(update.message)
+                elif update.callback_query:
+                    await self._handle_callback(update.callback_query)
+        except Exception as err:
+            LOGGER.error(msg=f'UserID: {chat_id}. Problem handling update. Error: {err}', exc_info=True)
+        finally:
+            lock, users = self._chat_locks[chat_id]
+            if users == 1:
+                del self._chat_locks[chat_id]
+            else:
+                self._chat_locks[chat_id] = (lock, users - 1)
+            self._semaphore.release()
+
+    async def _handle_callback(self, callback_query) -> None:
+        chat_id = callback_query.message.chat.id
+        LOGGER.debug('Callback received. UserID: %s, text answer: %s', chat_id, callback_query.data)
+        answer, argument = routes.split_callback_data(callback_query.data)
+        action = routes.route_callback(
+            callback_query.message.text, answer,
+            has_session=lambda: chat_id in self._sessions
+        )
+        if action:
+            await self._handle(action, callback_query.message, *([argument] if argument else []))
+
+    async def _handle_message(self, message) -> None:
+        chat_id = message.chat.id
+        LOGGER.debug('UserID: %s - text: %s', chat_id, message.text)
+        action = routes.route_message(
+            message.content_type, message.text,
+            has_session=lambda: chat_id in self._sessions,
+            is_admin=lambda: chat_id in self._admin_set
+        )
+        if action:
+            await self._handle(action, message)
+
+    async def _handle(self, action: str, message, *args) -> None:
+        """ Calling the handler of the action, timed by HANDLER_SECONDS """
+        started = time.perf_counter()
+        try:
+            await getattr(self, f'_{action}')(message, *args)
+        except Exception:
+            HANDLER_ERRORS.labels(action).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(action).observe(time.perf_counter() - started)
+
+    async def _reply(self, message, replies: list) -> None:
+        """ Sending the replies of a flow of core.flows to the chat of the message, in order """
+        chat_id = message.chat.id
+        for reply in replies:
+            try:
+                if isinstance(reply, flows.Text):
+                    await self._api.send_message(chat_id, reply.text, reply_markup=reply.reply_markup)
+                elif isinstance(reply, flows.Venue):
+                    await self._api.send_venue(chat_id, **reply._asdict())
+                else:
+                    await self._send_place_photos(chat_id, reply.places)
+            except ApiError as err:
+                LOGGER.error(msg=f'UserID: {chat_id}. API Exception: {err}')
+
+    async def _main_menu(self, message) -> None:
+        await self._reply(message, flows.main_menu())
+
+    async def _help_massage(self, message) -> None:
+        await self._reply(message, flows.help_message())
+
+    async def _send_place_photos(self, chat_id: int, photo_places: list) -> None:
+        """ Sending photos by cached file_id as albums, uploading the stored bytes only if needed """
+        async def album(use_file_ids: bool) -> list:
+            items = []
+            for place, caption in photo_places:
+                if use_file_ids and place.photo_file_id:
+                    photo = place.photo_file_id
+                else:
+                    photo = await self._db.get_place_photo(place_id=place.id)
+                if photo is None:
+                    LOGGER.warning(msg=f'UserID: {chat_id}. Photo of the place {place.id} was not found.')
+                    continue
+                items.append((place, caption, photo))
+            return items
+
+        async def send(items: list) -> list:
+            # Telegram takes albums of 2 to 10 photos.
+            if len(items) == 1:
+                _, caption, photo = items[0]
+                return [await self._api.send_photo(chat_id, photo, caption)]
+            if not items:
+                return []
+            return await self._api.send_media_group(
+                chat_id, [tb.types.InputMediaPhoto(photo, caption=caption) for _, caption, photo in items])
+
+        cached = any(place.photo_file_id for place, _ in photo_places)
+        items = await album(use_file_ids=True)
+        try:
+            sent = await send(items)
+        except ApiError as err:
+            if not cached:
+                raise
+            LOGGER.warning(msg=f'UserID: {chat_id}. Photo file_id was rejected: {err}')
+            cached = False
+            items = await album(use_file_ids=False)
+            sent = await send(items)
+        for (place, _, _), sent_message in zip(items, sent):
+            if not cached or not place.photo_file_id:
+                await self._db.set_photo_file_id(place_id=place.id, file_id=sent_message.photo[-1].file_id)
+
+    async def _list_last_places(self, message) -> None:
+        await self._send_places_page(message)
+
+    async def _list_older_places(self, message, before_id: str) -> None:
+        await self._send_places_page(message, before_id=int(before_id))
+
+    async def _send_places_page(self, message, before_id: int = None) -> None:
+        # One extra place tells whether there are older places.
+        places = await self._db.get_last_places(
+            user_id=message.chat.id,
+            limit=routes.PLACES_PAGE_SIZE + 1,
+            before_id=before_id
+        )
+        await self._reply(message, flows.places_page(places))
+
+    async def _ask_location(self, message) -> None:
+        await self._reply(message, flows.ask_location())
+
+    async def _location_received(self, message) -> None:
+        places = await self._db.get_nearest_places(
+            user_id=message.chat.id,
+            lat=message.location.latitude,
+            long=message.location.longitude
+        )
+        await self._reply(message, flows.nearest_places(places))
+
+    async def _search_places(self, message) -> None:
+        words = routes.get_command_argument(message.text)
+        if not words:
+            await self._reply(message, flows.search_usage())
+            return
+        await self._send_search_page(message, words, page=1)
+
+    async def _search_next_page(self, message) -> None:
+        words, page = routes.parse_search_text(message.text)
+        await self._send_search_page(message, words, page=page + 1)
+
+    async def _send_search_page(self, message, words: str, page: int) -> None:
+        # One extra place tells whether there is the next page.
+        places = await self._db.search_places(
+            user_id=message.chat.id,
+            text=words,
+            limit=routes.SEARCH_PAGE_SIZE + 1,
+            offset=(page - 1) * routes.SEARCH_PAGE_SIZE
+        )
+        await self._reply(message, flows.search_page(places, words, page))
+
+    def _write_export(self, user_id: int, file_format: str, with_photos: bool, loop) -> tuple:
+        """ Zip archive of the places and their number; called by the exchange threads """
+        file = BytesIO()
+        count = exchange.export_places(exchange.BlockingDatabase(self._db, loop), user_id, file, file_format,
+                                       with_photos=with_photos)
+        return file.getvalue(), count
+
+    async def _export_places(self, message) -> None:
+        options = routes.get_command_argument(message.text).lower().split()
+        file_format = next((option for option in options if option in exchange.FORMATS), 'geojson')
+        loop = asyncio.get_running_loop()
+        try:
+            data, count = await loop.run_in_executor(self._exchange, self._write_export, message.chat.id,
+                                                     file_format, 'photos' in options, loop)
+        except Exception as err:
+            LOGGER.error(msg=f'UserID: {message.chat.id}. Problem exporting places. Error: {err}')
+            count = None
+        if count:
+            await self._api.send_document(message.chat.id, data, f'places_{file_format}.zip')
+            await self._main_menu(message)
+        else:
+            await self._reply(message, flows.export_failed(count))
+
+    async def _import_places(self, message) -> None:
+        document = message.document
+        if exchange.get_format(document.file_name) is None or (document.file_size or 0) > exchange.MAX_FILE_SIZE:
+            await self._reply(message, flows.import_formats())
+            return
+        await self._db.create_user(user_id=message.chat.id)
+        loop = asyncio.get_running_loop()
+        try:
+            file_info = await self._api.get_file(document.file_id)
+            data = await self._api.download_file(file_info.file_path)
+            imported, skipped = await loop.run_in_executor(
+                self._exchange, exchange.import_places, exchange.BlockingDatabase(self._db, loop),
+                message.chat.id, BytesIO(data), document.file_name
+            )
+        except Exception as err:
+            LOGGER.error(msg=f'UserID: {message.chat.id}. Problem importing places. Error: {err}')
+            imported, skipped = None, 0
+        await self._reply(message, flows.imported(imported, skipped))
+
+    async def _delete_users_data(self, message) -> None:
+        await self._db.delete_places(user_id=message.chat.id)
+        await self._reply(message, flows.places_deleted())
+
+    async def _add_new_place_start(self, message) -> None:
+        await self._reply(message, flows.start_place(self._sessions, message.chat.id))
+
+    async def _add_new_place_location(self, message) -> None:
+        _, replies = flows.place_location(self._sessions, message.chat.id,
+                                          message.location.latitude, message.location.longitude)
+        await self._reply(message, replies)
+
+    async def _add_new_place_description(self, message) -> None:
+        _, replies = flows.place_description(self._sessions, message.chat.id, message.text)
+        await self._reply(message, replies)
+
+    async def _process_photo(self, file_id: str) -> tuple:
+        photo_info = await self._api.get_file(file_id)
+        data = await self._api.download_file(photo_info.file_path)
+        # Resizing and hashing take the CPU, so they run in the default executor.
+        return await asyncio.get_running_loop().run_in_executor(
+            None, photos.prepare_photo, data, self._photo_max_side, self._photo_quality
+        )
+
+    async def _add_new_place_photo(self, message) -> None:
+        file_id = photos.choose_variant(message.photo, self._photo_max_side).file_id
+        added, replies = flows.place_photo(self._sessions, message.chat.id, file_id)
+        if added and file_id not in self._photo_tasks:
+            self._photo_tasks[file_id] = asyncio.ensure_future(self._process_photo(file_id))
+            if len(self._photo_tasks) > PENDING_PHOTOS:
+                self._photo_tasks.pop(next(iter(self._photo_tasks))).cancel()
+        await self._reply(message, replies)
+
+    async def _add_new_place_save(self, message) -> None:
+        content = flows.take_place(self._sessions, message.chat.id)
+        if content is None:
+            await self._main_menu(message)
+            return
+        if 'photo_file_id' in content.keys():
+            file_id = content['photo_file_id']
+            task = self._photo_tasks.pop(file_id, None) or asyncio.ensure_future(self._process_photo(file_id))
+            try:
+                content['photo_hash'], content['photo'] = await asyncio.wait_for(task, PHOTO_TIMEOUT)
+            except Exception as err:
+                LOGGER.error(msg=f'Problem processing photo. FileID: {file_id}. Error: {err}')
+                await self._reply(message, flows.photo_failed(content))
+        saved = await self._db.create_new_place(user_id=message.chat.id, content=content)
+        await self._reply(message, flows.place_saved(saved))
+
+    async def _add_new_place_cancel(self, message) -> None:
+        task = self._photo_tasks.pop(flows.cancel_place(self._sessions, message.chat.id), None)
+        if task is not None:
+            task.cancel()
+        await self._main_menu(message)
+
+    async def _ask_place_location(self, message) -> None:
+        await self._reply(message, flows.ask_place_location())
+
+    async def _ask_place_description(self, message) -> None:
+        await self._reply(message, flows.ask_place_description())
+
+    async def _ask_place_photo(self, message) -> None:
+        await self._reply(message, flows.ask_place_photo())
+
+    async def _create_new_user(self, message) -> None:
+        await self._db.create_user(user_id=message.chat.id)
+        await self._reply(message, flows.welcome())
+
+    async def _call_admin_menu(self, message) -> None:
+        await self._reply(message, flows.admin_prompt(self._admin_set, message.chat.id))
+
+    async def _check_admin_pin(self, message) -> None:
+        if message.text == self.__adm_pin:
+            LOGGER.warning(msg=f'UserID: {message.chat.id} - admin menu')
+        else:
+            LOGGER.warning(msg=f'UserID: {message.chat.id} - admin login unsuccessful!')
+        await self._reply(message,
+                          flows.check_admin_pin(self._admin_set, message.chat.id, message.text, self.__adm_pin))
+
+    async def _admin_exit(self, message) -> None:
+        await self._reply(message, flows.admin_exit(self._admin_set, message.chat.id))
+
+    async def _admin_menu(self, message) -> None:
+        await self._reply(message, flows.admin_menu())
+
+    async def _admin_stats(self, message) -> None:
+        await self._reply(message, flows.admin_stats(self.stats(), REGISTRY.summary()))
+
+    async def _admin_profile(self, message) -> None:
+        started = self._profiler.start(self._profile_seconds)
+        if started:
+            self._profile_task = asyncio.create_task(self._send_profile(message.chat.id))
+        await self._reply(message, flows.profile_started(started, self._profile_seconds))
+
+    async def _send_profile(self, chat_id: int) -> None:
+        await asyncio.sleep(self._profile_seconds)
+        collapsed = self._profiler.stop()
+        await self._api.send_document(chat_id, collapsed.encode(), 'profile.txt')
+
+    async def _admin_memory(self, message) -> None:
+        if self._memory_tracer.running:
+            await self._api.send_document(message.chat.id, self._memory_tracer.stop().encode(), 'memory.txt')
+        else:
+            self._memory_tracer.start()
+            await self._reply(message, [flows.Text(flows.MEMORY_STARTED_TEXT)])
+        await self._admin_menu(message)
+
+    async def _admin_get_logs(self, message) -> None:
+        buffer = BytesIO()
+        with ZipFile(buffer, 'w') as zip_file:
+            for dir_name, _, file_list in os.walk(logs.LOG_DIR):
+                for file in file_list:
+                    zip_file.write(os.path.join(dir_name, file))
+        await self._api.send_document(message.chat.id, buffer.getvalue(), 'logs.zip')
+        await self._admin_menu(message)
+
+    async def _polling(self) -> None:
+        offset = None
+        delay = 0
+        await self._api.delete_webhook()
+        while True:
+            try:
+                updates = await self._api.get_updates(offset=offset, timeout=10)
+                delay = 0
+            except (ApiError, aiohttp.ClientError, OSError, ValueError, asyncio.TimeoutError) as err:
+                # Delays grow while the API or the network is down.
+                delay = min(max(delay * 2, 1), POLLING_MAX_DELAY)
+                LOGGER.error(msg=f'Problem getting updates, retry after {delay} s. Error: {err}')
+                await asyncio.sleep(delay)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                if update.message:
+                    chat_id = update.message.chat.id
+                elif update.callback_query and update.callback_query.message:
+                    chat_id = update.callback_query.message.chat.id
+                else:
+                    continue
+                # The semaphore bounds the number of updates in progress.
+                await self._semaphore.acquire()
+                asyncio.ensure_future(self._handle_update(chat_id, update))
+
+    async def _run(self) -> None:
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        await self._api.start()
+        await self._db.connect()
+        try:
+            LOGGER.info(msg='Polling starting')
+            await self._polling()
+        finally:
+            self._exchange.shutdown(wait=False)
+            await self._api.close()
+            await self._db.close()
+
+    def stats(self) -> dict:
+        """ Counters of the DB pool """
+        return {'db': self._db.stats()}
+
+    def metrics(self) -> str:
+        """ Prometheus text of the metrics and of the stats """
+        return REGISTRY.render(stats=self.stats())
+
+    def run(self) -> None:
+        """
+        The main method for the bot.
+        It runs the event loop until the bot is stopped.
+        """
+        LOGGER.info(msg='Async bot starting.')
+        try:
+            asyncio.run(self._run())
+        except Exception as err:
+            LOGGER.critical(msg=f'Problem with Telegram bot. Error: {err}')
+            LOGGER.critical(msg='Exiting!')
@@ -0,0 +1,46 @@
+"""
+Module of program which opens the database backend by the scheme of DATABASE_URL:
+sqlite:///path/to/file.db for SQLite, postgres://... for PostgreSQL.
+"""
+
+import logging
+
+LOGGER = logging.getLogger('backends.py')
+
+SQLITE_SCHEME = 'sqlite:///'
+
+
+def is_sqlite_url(db_url: str) -> bool:
+    """ Checking whether the URL points to a SQLite file """
+    return db_url.startswith(SQLITE_SCHEME)
+
+
+def open_database(db_url: str, **kwargs):
+    """
+    Creating the database backend by the URL scheme.
+    Keyword arguments are options of core.database.Database; SQLite takes only create_schema.
+    """
+    if is_sqlite_url(db_url):
+        from core.sqlitedb import SqliteDatabase
+
+        LOGGER.info(msg='SQLite backend is chosen.')
+        if kwargs.get('write_buffer_size'):
+            LOGGER.warning(msg='The SQLite backend has no write buffer, WRITE_BUFFER_SIZE is ignored.')
+        return SqliteDatabase(db_url[len(SQLITE_SCHEME):], create_schema=kwargs.get('create_schema', True))
+    # psycopg2 is needed only with PostgreSQL.
+    from core.database import Database
+
+    LOGGER.info(msg='PostgreSQL backend is chosen.')
+    return Database(db_url, **kwargs)
+
+
+def create_schema(db_url: str) -> None:
+    """ Creating the tables of the backend by the URL scheme, without opening the backend for queries """
+    if is_sqlite_url(db_url):
+        from core.sqlitedb import SqliteDatabase
+
+        SqliteDatabase(db_url[len(SQLITE_SCHEME):]).close()
+        return
+    from core.database import create_tables
+
+    create_tables(db_url)
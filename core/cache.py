@@ -0,0 +1,219 @@
+"""
+Module of program which contains a read-through cache of query results.
+CachedDatabase wraps any database backend: the lists of places are kept per user
+and dropped when the places of the user change.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+LOGGER = logging.getLogger('cache.py')
+
+
+class ResultCache:
+    """ Thread-safe LRU cache with TTL; keys are tuples whose second item is the user id """
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 60) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Keys of every user, for invalidation.
+        self._user_keys = {}
+        # Owners of the cached places and the places of every user, to drop the entries of a changed place.
+        self._place_users = {}
+        self._user_places = {}
+        # Invalidations of every user; a value read before an invalidation is not cached.
+        self._generations = {}
+        self._epoch = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def _remove(self, key: tuple) -> None:
+        del self._entries[key]
+        keys = self._user_keys[key[1]]
+        keys.discard(key)
+        if not keys:
+            del self._user_keys[key[1]]
+            for place_id in self._user_places.pop(key[1], ()):
+                del self._place_users[place_id]
+
+    def get(self, key: tuple):
+        """ Getting the cached value, None if it is missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def generation(self, user_id) -> tuple:
+        """ Token to pass to set: it changes when the entries of the user are invalidated """
+        with self._lock:
+            return self._epoch, self._generations.get(user_id, 0)
+
+    def set(self, key: tuple, value, generation: tuple = None) -> None:
+        """
+        Caching the value, the least recently used entries are evicted.
+        The value is dropped if the user was invalidated since the generation was taken.
+        """
+        if value is None:
+            return
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(key[1], 0)):
+                return
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            self._user_keys.setdefault(key[1], set()).add(key)
+            place_ids = self._user_places.setdefault(key[1], set())
+            for place in value:
+                place_ids.add(place.id)
+                self._place_users[place.id] = key[1]
+            while len(self._entries) > self._max_size:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def invalidate_user(self, user_id) -> None:
+        """ Dropping all entries of the user; None drops the whole cache """
+        with self._lock:
+            self._invalidate(user_id)
+
+    def invalidate_place(self, place_id: int) -> None:
+        """ Dropping all entries of the owner of the place, if any of them has it """
+        with self._lock:
+            user_id = self._place_users.get(place_id)
+            if user_id is not None:
+                self._invalidate(user_id)
+
+    def _invalidate(self, user_id) -> None:
+        if user_id is None or len(self._generations) >= self._max_size:
+            # A new epoch changes the generations of all users, so the counters can be dropped.
+            self._epoch += 1
+            self._generations.clear()
+        if user_id is None:
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._user_keys.clear()
+            self._place_users.clear()
+            self._user_places.clear()
+            return
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+        for key in list(self._user_keys.get(user_id, ())):
+            self._remove(key)
+            self._invalidations += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """ Hit, miss and eviction counters """
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio_avg': self._hits / requests if requests else 0.0,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+            }
+
+
+class CachedDatabase:
+    """
+    Read-through cache in front of a database backend.
+    Methods which are not cached are passed to the backend as they are.
+    """
+
+    def __init__(self, db, cache: ResultCache = None) -> None:
+        LOGGER.info(msg='Cached database initialisation.')
+        self._db = db
+        self._cache = cache if cache is not None else ResultCache()
+        # Backends shared by processes tell about changes made by the other processes.
+        self._notified = hasattr(db, 'listen_changes')
+        if self._notified:
+            db.listen_changes(self._cache.invalidate_user)
+
+    def __getattr__(self, name: str):
+        return getattr(self._db, name)
+
+    def get_last_places(self, user_id: int, limit: int = 10, before_id: int = None) -> list:
+        """ Getting a page of last places, from the cache when the places have not changed """
+        key = ('last', user_id, limit, before_id)
+        places = self._cache.get(key)
+        if places is None:
+            generation = self._cache.generation(user_id)
+            places = self._db.get_last_places(user_id=user_id, limit=limit, before_id=before_id)
+            self._cache.set(key, places, generation)
+        return places
+
+    def get_near_places(self, user_id: int, area: tuple) -> list:
+        """ Getting places in the area, from the cache when the places have not changed """
+        key = ('near', user_id, tuple(area))
+        places = self._cache.get(key)
+        if places is None:
+            generation = self._cache.generation(user_id)
+            places = self._db.get_near_places(user_id=user_id, area=area)
+            self._cache.set(key, places, generation)
+        return places
+
+    def get_nearest_places(self, user_id: int, lat: float, long: float, limit: int = 10, **kwargs) -> list:
+        """
+        Getting places closest to the location, from the cache when the same location was searched.
+        The key is the exact location: the closest places of another point, even a near one, may be others.
+        """
+        key = ('nearest', user_id, float(lat), float(long), limit, tuple(sorted(kwargs.items())))
+        places = self._cache.get(key)
+        if places is None:
+            generation = self._cache.generation(user_id)
+            places = self._db.get_nearest_places(user_id=user_id, lat=lat, long=long, limit=limit, **kwargs)
+            self._cache.set(key, places, generation)
+        return places
+
+    def create_new_place(self, user_id: int, content: dict, callback=None) -> None:
+        """ Creating a new place and dropping cached places of the user, also after a buffered commit """
+        def saved(success: bool) -> None:
+            self._cache.invalidate_user(user_id)
+            if callback is not None:
+                callback(success)
+
+        try:
+            self._db.create_new_place(user_id=user_id, content=content, callback=saved)
+        finally:
+            self._cache.invalidate_user(user_id)
+
+    def import_places(self, user_id: int, places, batch_size: int = 1000) -> int:
+        """ Importing places and dropping cached places of the user """
+        try:
+            return self._db.import_places(user_id=user_id, places=places, batch_size=batch_size)
+        finally:
+            self._cache.invalidate_user(user_id)
+
+    def delete_places(self, user_id: int) -> None:
+        """ Deleting all places of user and dropping cached places of the user """
+        try:
+            self._db.delete_places(user_id=user_id)
+        finally:
+            self._cache.invalidate_user(user_id)
+
+    def set_photo_file_id(self, place_id: int, file_id: str) -> None:
+        """ Saving Telegram file_id of the place photo and dropping cached places of its owner """
+        try:
+            self._db.set_photo_file_id(place_id=place_id, file_id=file_id)
+        finally:
+            # Backends which notify about changes drop them on the notification.
+            if not self._notified:
+                self._cache.invalidate_place(place_id)
+
+    def stats(self) -> dict:
+        """ Backend counters with the cache counters """
+        return dict(self._db.stats(), cache=self._cache.stats())
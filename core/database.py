@@ -3,173 +3,710 @@ Module of program which contains class to work with PostgreSQL Database.
 """
 
 import logging
+import re
+import select
+import threading
+import time
+from itertools import starmap
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+import core.locationcalc as loc
+from core import geodesy
+from core.photos import photo_row, place_batches
+from core.place import Place
+from core.pool import ConnectionPool
 
 LOGGER = logging.getLogger('database.py')
 
+# Cell of the fixed grid from core.locationcalc, calculated by the DB.
+CELL_SQL = (
+    f'least(greatest(floor((lat + 90) / {loc.GRID_STEP})::bigint, 0), {loc.GRID_ROWS - 1})'
+    f' * {loc.GRID_COLUMNS}'
+    f' + mod(floor((long + 180) / {loc.GRID_STEP})::bigint, {loc.GRID_COLUMNS})'
+)
+
+# Great-circle distance in meters from the point given by lat/long parameters.
+DISTANCE_SQL = (
+    f'2 * {loc.R_EARTH} * asin(least(1, sqrt('
+    'power(sin(radians(lat - %(lat)s) / 2), 2)'
+    ' + cos(radians(%(lat)s)) * cos(radians(lat)) * power(sin(radians(long - %(long)s) / 2), 2)'
+    ')))'
+)
+
+NEAR_RADII = loc.NEAR_RADII
+
+# Full-text search document of a place; queries must use the same expression to use the index.
+SEARCH_VECTOR_SQL = "to_tsvector('simple', coalesce(place_description, ''))"
+
+# Channel of notifications with user id of every change of places.
+CHANGES_CHANNEL = 'places_changed'
+
+# Statements which create and migrate the tables, executed on start in order.
+SCHEMA = (
+    """
+    create table if not exists users (
+        user_id bigint not null primary key,
+        created_at timestamp default now()
+    )
+    """,
+    """
+    create table if not exists places (
+        user_id bigint not null,
+        lat  double precision not null,
+        long double precision not null,
+        place_description varchar(255),
+        photo bytea,
+        created_at timestamp default now(),
+        foreign key (user_id) references users(user_id)
+    );
+    """,
+    'create index if not exists idx_places on places(user_id, created_at)',
+    # Filling the grid cells in once, when the column is added to older tables.
+    f"""
+    do $$
+    begin
+        if not exists (select 1 from information_schema.columns
+                where table_name = 'places' and column_name = 'cell') then
+            alter table places add column cell bigint;
+            update places set cell = {CELL_SQL};
+        end if;
+    end;
+    $$ language plpgsql
+    """,
+    'create index if not exists idx_places_cell on places(user_id, cell)',
+    'alter table places add column if not exists id bigserial primary key',
+    'alter table places add column if not exists photo_file_id varchar(255)',
+    'create index if not exists idx_places_keyset on places(user_id, created_at, id)',
+    'drop index if exists idx_places',
+    """
+    create unlogged table if not exists sessions (
+        user_id bigint not null primary key,
+        content text not null,
+        updated_at timestamp default now()
+    )
+    """,
+    f'create index if not exists idx_places_search on places using gin ({SEARCH_VECTOR_SQL})',
+    f"""
+    create or replace function notify_places_changed() returns trigger as $$
+    begin
+        perform pg_notify('{CHANGES_CHANNEL}', coalesce(new.user_id, old.user_id)::text);
+        return null;
+    end;
+    $$ language plpgsql
+    """,
+    'drop trigger if exists places_changed on places',
+    """
+    create trigger places_changed after insert or update or delete on places
+        for each row execute procedure notify_places_changed()
+    """,
+    # Photos are stored once by the hex SHA-256 of their bytes; places refer to them.
+    """
+    create table if not exists photos (
+        hash varchar(64) not null primary key,
+        data bytea not null,
+        created_at timestamp default now()
+    )
+    """,
+    # Moving photos which were saved in places, once, when the column is added; sha256() needs PostgreSQL 11.
+    """
+    do $$
+    begin
+        if not exists (select 1 from information_schema.columns
+                where table_name = 'places' and column_name = 'photo_hash') then
+            alter table places add column photo_hash varchar(64) references photos(hash);
+            insert into photos (hash, data)
+                select encode(sha256(photo), 'hex'), photo from places where photo is not null
+                on conflict (hash) do nothing;
+            update places set photo_hash = encode(sha256(photo), 'hex'), photo = null where photo is not null;
+        end if;
+    end;
+    $$ language plpgsql
+    """,
+    'create index if not exists idx_places_photo on places(photo_hash)',
+    # Coordinates were numeric, decoded to Decimal; descriptions were saved in quotes until then too.
+    """
+    do $$
+    begin
+        if (select data_type from information_schema.columns
+                where table_name = 'places' and column_name = 'lat') = 'numeric' then
+            alter table places alter column lat type double precision, alter column long type double precision;
+            update places set place_description = substr(place_description, 2, length(place_description) - 2)
+                where length(place_description) >= 2 and place_description like '''%''';
+        end if;
+    end;
+    $$ language plpgsql
+    """,
+)
+
+
+# Columns of a place row, in the order of the fields of core.place.Place.
+PLACE_COLUMNS = 'id, lat, long, place_description, photo_hash is not null as has_photo, photo_file_id'
+
+PREPARED_DISTANCE_SQL = DISTANCE_SQL % {'lat': '$2', 'long': '$3'}
+
+
+# An area which crosses the antimeridian has min_long > max_long (core.locationcalc.split_area).
+def _near_places_sql(with_cells: bool) -> str:
+    return f"""
+        select {PLACE_COLUMNS}
+            from places
+            where user_id = $1
+                {'and cell = any($6)' if with_cells else ''}
+                and (lat between $2 and $4)
+                and (long between $3 and $5 or ($3 > $5 and (long >= $3 or long <= $5)))
+            order by created_at desc
+            limit 10
+        """
+
+
+def _nearest_places_sql(with_cells: bool) -> str:
+    return f"""
+        select id, lat, long, place_description, has_photo, photo_file_id, round(distance)::int
+            from (
+                select id, lat, long, place_description, photo_hash is not null as has_photo,
+                    photo_file_id, created_at,
+                    {PREPARED_DISTANCE_SQL} as distance
+                    from places
+                    where user_id = $1
+                        {'and cell = any($10)' if with_cells else ''}
+                        and (lat between $4 and $6)
+                        and (long between $5 and $7 or ($5 > $7 and (long >= $5 or long <= $7)))
+            ) as candidates
+            where candidates.distance <= $8
+            order by candidates.distance, created_at desc
+            limit $9
+        """
+
+
+NEAR_PARAMS = ('bigint', 'float8', 'float8', 'float8', 'float8')
+NEAREST_PARAMS = ('bigint', 'float8', 'float8', 'float8', 'float8', 'float8', 'float8', 'float8', 'int')
+
+# Server-side prepared statements: name -> (parameter types, query).
+# They are prepared once on every pooled connection, so calls skip parsing and planning.
+STATEMENTS = {
+    'create_user': (('bigint',), 'insert into users (user_id) values ($1) on conflict (user_id) do nothing'),
+    'get_last_places': (
+        ('bigint', 'int'),
+        f'select {PLACE_COLUMNS} from places where user_id = $1 order by created_at desc, id desc limit $2'
+    ),
+    # Keyset page: places older than the given one, by the index on (user_id, created_at, id).
+    'get_last_places_before': (
+        ('bigint', 'bigint', 'int'),
+        f"""
+        select {PLACE_COLUMNS}
+            from places
+            where user_id = $1
+                and (created_at, id) < (select created_at, id from places where id = $2)
+            order by created_at desc, id desc
+            limit $3
+        """
+    ),
+    'delete_places': (('bigint',), 'delete from places where user_id = $1 returning photo_hash'),
+    # Photos of the deleted places which no other place refers to.
+    'delete_unused_photos': (
+        ('varchar[]',),
+        """
+        delete from photos
+            where hash = any($1)
+                and not exists (select 1 from places where places.photo_hash = photos.hash)
+        """
+    ),
+    'get_near_places': (NEAR_PARAMS, _near_places_sql(with_cells=False)),
+    'get_near_places_cells': (NEAR_PARAMS + ('bigint[]',), _near_places_sql(with_cells=True)),
+    'get_nearest_places': (NEAREST_PARAMS, _nearest_places_sql(with_cells=False)),
+    'get_nearest_places_cells': (NEAREST_PARAMS + ('bigint[]',), _nearest_places_sql(with_cells=True)),
+    'create_new_place': (
+        ('bigint', 'float8', 'float8', 'bigint', 'varchar', 'varchar', 'varchar'),
+        """
+        insert into places
+        (user_id, lat, long, cell, place_description, photo_hash, photo_file_id)
+        values
+        ($1, $2, $3, $4, $5, $6, $7)
+        """
+    ),
+    'search_places': (
+        ('bigint', 'text', 'int', 'int'),
+        f"""
+        select {PLACE_COLUMNS}
+            from places
+            where user_id = $1 and {SEARCH_VECTOR_SQL} @@ to_tsquery('simple', $2)
+            order by ts_rank({SEARCH_VECTOR_SQL}, to_tsquery('simple', $2)) desc, created_at desc, id desc
+            limit $3
+            offset $4
+        """
+    ),
+    'save_photo': (('varchar', 'bytea'), 'insert into photos (hash, data) values ($1, $2) on conflict do nothing'),
+    'get_place_photo': (
+        ('bigint',),
+        'select photos.data from places join photos on photos.hash = places.photo_hash where places.id = $1'
+    ),
+    'set_photo_file_id': (('varchar', 'bigint'), 'update places set photo_file_id = $1 where id = $2'),
+    'get_session': (
+        ('bigint', 'float8'),
+        "select content from sessions where user_id = $1 and updated_at > now() - $2 * interval '1 second'"
+    ),
+    'has_session': (
+        ('bigint', 'float8'),
+        "select 1 from sessions where user_id = $1 and updated_at > now() - $2 * interval '1 second'"
+    ),
+    'save_session': (
+        ('bigint', 'text'),
+        """
+        insert into sessions (user_id, content) values ($1, $2)
+            on conflict (user_id) do update
+            set content = excluded.content, updated_at = now()
+        """
+    ),
+    'delete_session': (('bigint',), 'delete from sessions where user_id = $1'),
+    'delete_expired_sessions': (
+        ('float8',),
+        "delete from sessions where updated_at < now() - $1 * interval '1 second'"
+    ),
+}
+
+
+# Streamed places, for a server-side cursor: prepared statements can't be declared as cursors.
+ITER_PLACES_SQL = f"""
+    select {PLACE_COLUMNS}, null as distance, created_at
+        from places
+        where user_id = %(id)s
+        order by created_at, id
+    """
+
+# Insert of buffered places, one statement for the whole batch.
+INSERT_PLACES_SQL = """
+    insert into places
+    (user_id, lat, long, cell, place_description, photo_hash, photo_file_id)
+    values %s
+    """
+
+# Insert of the photos of a batch; a photo which is already stored is kept.
+INSERT_PHOTOS_SQL = 'insert into photos (hash, data) values %s on conflict do nothing'
+
+
+def get_search_query(text: str) -> str:
+    """ tsquery matching places with all words of the text, also as prefixes; '' if there are no words """
+    return ' & '.join(f'{word}:*' for word in re.findall(r'\w+', text.lower()))
+
+
+# Numbers which are still numeric are decoded to float instead of Decimal.
+NUMERIC_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'NUMERIC_AS_FLOAT',
+    lambda value, cursor: float(value) if value is not None else None
+)
+
+
+def setup_connection(conn) -> None:
+    """ Registering the type casters and preparing STATEMENTS on a new connection """
+    psycopg2.extensions.register_type(NUMERIC_AS_FLOAT, conn)
+    prepare_statements(conn)
+
+
+def prepare_statements(conn) -> None:
+    """ Preparing STATEMENTS on a new connection """
+    with conn.cursor() as cursor:
+        for name, (types, query) in STATEMENTS.items():
+            cursor.execute(f'prepare {name} ({", ".join(types)}) as {query}')
+
+
+def execute(cursor, name: str, *params) -> None:
+    """ Executing a prepared statement; parameters are bound by psycopg2 """
+    cursor.execute(f'execute {name} ({", ".join(["%s"] * len(params))})', params)
+
+
+def create_tables(db_url: str) -> bool:
+    """
+    Running SCHEMA: the tables, indexes and triggers, with the migrations of older databases.
+    It is run once before the worker processes start, so they don't migrate concurrently.
+    """
+    try:
+        conn = psycopg2.connect(db_url, sslmode='require')
+        try:
+            with conn, conn.cursor() as cursor:
+                for statement in SCHEMA:
+                    cursor.execute(statement)
+        finally:
+            conn.close()
+        LOGGER.info(msg='The tables have been created.')
+        return True
+    except Exception as err:
+        LOGGER.error(msg=f'Problem connecting to database. Error: {err}')
+        return False
+
 
 class Database:
     """  class to work with PostgreSQL Database """
 
-    def __init__(self, db_url: str) -> None:
+    def __init__(self, db_url: str, min_conn: int = 1, max_conn: int = 10,
+                 pool_timeout: float = 10.0, write_buffer_size: int = 0,
+                 write_buffer_delay: float = 1.0, create_schema: bool = True) -> None:
         LOGGER.info(msg='Database class initialisation.')
+        self._db_url = db_url
+        self._pool = None
+        self._stopped = threading.Event()
+        # Write-behind buffer of new places: (user_id, content, callback, time of adding).
+        self._write_buffer_size = write_buffer_size
+        self._write_buffer_delay = write_buffer_delay
+        self._write_buffer = []
+        self._write_cond = threading.Condition()
+        self._flusher = None
+        if write_buffer_size > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, name='db-flusher', daemon=True)
+            self._flusher.start()
+        # The tables must exist before the statements are prepared on pooled connections.
+        if create_schema:
+            create_tables(db_url)
         try:
-            self._conn = psycopg2.connect(db_url, sslmode='require')
-            self._cursor = self._conn.cursor()
+            self._pool = ConnectionPool(
+                db_url,
+                min_conn=min_conn,
+                max_conn=max_conn,
+                timeout=pool_timeout,
+                on_connect=setup_connection,
+                sslmode='require'
+            )
             LOGGER.info(msg='The connection to DB has been created.')
         except Exception as err:
             LOGGER.error(msg=f'Problem connecting to database. Error: {err}')
-        else:
-            try:
-                self._cursor.execute(
-                    """
-                    create table if not exists users (
-                        user_id bigint not null primary key,
-                        created_at timestamp default now()
-                    )
-                    """
-                )
-                self._cursor.execute(
-                    """
-                    create table if not exists places (
-                        user_id bigint not null,
-                        lat  numeric not null,
-                        long numeric not null,
-                        place_description varchar(255),
-                        photo bytea,
-                        created_at timestamp default now(),
-                        foreign key (user_id) references users(user_id)
-                    );
-                    """
-                )
-                self._cursor.execute(
-                    'create index if not exists idx_places on places(user_id, created_at)'
-                )
-                self._conn.commit()
-                LOGGER.info(msg='The tables have been created.')
-            except Exception as err:
-                self._conn.rollback()
-                LOGGER.error(msg=f'Problem connecting to database. Error: {err}')
 
     def create_user(self, user_id: str) -> None:
         """ Creating new user in DB """
-        LOGGER.debug(msg=f'Creating user. UserID: {user_id}.')
+        LOGGER.debug('Creating user. UserID: %s.', user_id)
         try:
-            self._cursor.execute(
-                f'insert into users (user_id) values ({user_id})'
-            )
-            self._conn.commit()
-            LOGGER.debug(msg=f'UserID: {user_id} has bean created.')
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'create_user', user_id)
+            LOGGER.debug('UserID: %s has bean created.', user_id)
         except Exception as err:
-            self._conn.rollback()
             LOGGER.error(msg=f'Problem creating user. UserID: {user_id}. Error: {err}')
 
-    def get_last_places(self, user_id: str) -> dict:
-        """ Getting last 10 places """
-        LOGGER.debug(msg=f'Getting las 10 places. UserID: {user_id}.')
+    def get_last_places(self, user_id: str, limit: int = 10, before_id: int = None) -> list:
+        """ Getting last places; the next page starts before the place with `before_id` """
+        LOGGER.debug('Getting last places. UserID: %s, before: %s.', user_id, before_id)
         try:
-            self._cursor.execute(
-                f"""
-                select lat, long, place_description, photo
-                    from places
-                    where user_id = {user_id}
-                    order by created_at desc
-                    limit 10
-                """
-            )
-            result = self._cursor.fetchall()
-            for i in range(len(result)):
-                result[i] = {
-                    'lat': str(result[i][0]),
-                    'long': str(result[i][1]),
-                    'description': result[i][2],
-                    'photo': result[i][3]
-                }
-            LOGGER.debug(msg=f'Getting las 10 places. UserID: {user_id} - Success.')
+            with self._pool.cursor() as cursor:
+                if before_id is None:
+                    execute(cursor, 'get_last_places', user_id, limit)
+                else:
+                    execute(cursor, 'get_last_places_before', user_id, before_id, limit)
+                result = list(starmap(Place, cursor.fetchall()))
+            LOGGER.debug('Getting last places. UserID: %s - Success.', user_id)
             return result
         except Exception as err:
-            self._conn.rollback()
-            LOGGER.error(msg=f'Problem getting las 10 places. UserID: {user_id}. Error: {err}')
+            LOGGER.error(msg=f'Problem getting last places. UserID: {user_id}. Error: {err}')
+
+    def iter_places(self, user_id: str, chunk_size: int = 1000):
+        """
+        Generator of all places of the user, oldest first, with created_at.
+        Rows come from a server-side cursor in chunks, so memory doesn't grow with the number of places.
+        """
+        LOGGER.debug('Streaming places. UserID: %s.', user_id)
+        try:
+            with self._pool.connection() as conn:
+                with conn.cursor(name='iter_places') as cursor:
+                    cursor.itersize = chunk_size
+                    cursor.execute(ITER_PLACES_SQL, {'id': user_id})
+                    for row in cursor:
+                        yield Place(*row)
+            LOGGER.debug('Streaming places. UserID: %s - Success.', user_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem streaming places. UserID: {user_id}. Error: {err}')
+            raise
 
     def delete_places(self, user_id: str) -> None:
-        """ Deleting all places of user """
-        LOGGER.debug(msg=f'Deleting all places of user. UserID: {user_id}.')
+        """ Deleting all places of user and their photos which no other place has """
+        LOGGER.debug('Deleting all places of user. UserID: %s.', user_id)
         try:
-            self._cursor.execute(
-                f'delete from places where user_id = {user_id}'
-            )
-            self._conn.commit()
-            LOGGER.debug(msg=f'All places of UserID: {user_id} have bean deleted.')
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'delete_places', user_id)
+                hashes = list({row[0] for row in cursor.fetchall() if row[0] is not None})
+                if hashes:
+                    execute(cursor, 'delete_unused_photos', hashes)
+            LOGGER.debug('All places of UserID: %s have bean deleted.', user_id)
         except Exception as err:
-            self._conn.rollback()
             LOGGER.error(msg=f'Problem with deleting user\'s places. UserID: {user_id}. Error: {err}')
 
     def get_near_places(self, user_id: str, area: list) -> dict:
         """ Getting all places near location (places which wre located into some area) """
-        LOGGER.debug(msg=f'Getting places near location. UserID: {user_id}.')
+        LOGGER.debug('Getting places near location. UserID: %s.', user_id)
+        cells = loc.get_area_cells(area)
         try:
-            self._cursor.execute(
-                f"""
-                select lat, long, place_description, photo
-                    from places
-                    where user_id = {user_id}
-                        and (lat between {area[0]} and {area[2]})
-                        and (long between {area[1]} and {area[3]})
-                    order by created_at desc
-                    limit 10;
-                """
-            )
-            result = self._cursor.fetchall()
-            for i in range(len(result)):
-                result[i] = {
-                    'lat': str(result[i][0]),
-                    'long': str(result[i][1]),
-                    'description': result[i][2],
-                    'photo': result[i][3]
-                }
-            LOGGER.debug(msg=f'Getting places near location. UserID: {user_id} - Success.')
+            with self._pool.cursor() as cursor:
+                if cells:
+                    execute(cursor, 'get_near_places_cells', user_id, *area, cells)
+                else:
+                    execute(cursor, 'get_near_places', user_id, *area)
+                result = list(starmap(Place, cursor.fetchall()))
+            LOGGER.debug('Getting places near location. UserID: %s - Success.', user_id)
             return result
         except Exception as err:
-            self._conn.rollback()
             LOGGER.error(msg=f'Problem getting places near location. UserID: {user_id}. Error: {err}')
 
-    def create_new_place(self, user_id: str, content: dict) -> None:
-        """ Creating a new place in DB """
-        LOGGER.debug(msg=f'Creating new place. UserID: {user_id}.')
-        try:
-            if 'photo' in content.keys():
-                self._cursor.execute(
-                    f"""
-                    insert into places
-                    (user_id, lat, long, place_description, photo)
-                    values
-                    (%(id)s, %(lat)s, %(long)s, %(desc)s, %(photo)s)
-                    """,
-                    {'id': user_id, 'lat': content['lat'], 'long': content['long'],  'desc': content['description'],
-                     'photo': psycopg2.Binary(content['photo'])}
-                )
-                self._conn.commit()
-            else:
-                self._cursor.execute(
-                    """
-                    insert into places
-                    (user_id, lat, long, place_description)
-                    values
-                    (%(id)s, %(lat)s, %(long)s, %(desc)s)
-                    """,
-                    {'id': user_id, 'lat': content['lat'], 'long': content['long'],  'desc': content['description']}
-                )
-                self._conn.commit()
-                LOGGER.debug(msg=f'Creating new place. UserID: {user_id} - Success.')
-        except Exception as err:
-            self._conn.rollback()
+    def get_nearest_places(self, user_id: str, lat: float, long: float, limit: int = 10,
+                           radii: tuple = NEAR_RADII) -> list:
+        """
+        Getting up to `limit` places closest to the location, ordered by distance.
+        The search ring grows until enough places are found.
+        """
+        LOGGER.debug('Getting nearest places. UserID: %s.', user_id)
+        try:
+            result = []
+            with self._pool.cursor() as cursor:
+                for radius, area in zip(radii, geodesy.search_areas(lat, long, radii)):
+                    cells = loc.get_area_cells(area)
+                    params = (user_id, float(lat), float(long), *area, radius, limit)
+                    if cells:
+                        execute(cursor, 'get_nearest_places_cells', *params, cells)
+                    else:
+                        execute(cursor, 'get_nearest_places', *params)
+                    result = cursor.fetchall()
+                    if len(result) >= limit:
+                        break
+            result = list(starmap(Place, result))
+            LOGGER.debug('Getting nearest places. UserID: %s - Success.', user_id)
+            return result
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting nearest places. UserID: {user_id}. Error: {err}')
+
+    @staticmethod
+    def _place_row(user_id: str, content: dict, photo_hash: str = None) -> tuple:
+        return (user_id, content['lat'], content['long'], loc.get_cell_id(content['lat'], content['long']),
+                content['description'], photo_hash, content.get('photo_file_id'))
+
+    def _insert_places(self, cursor, places: list) -> None:
+        """ Inserting (user_id, content) pairs and their photos, two statements for the whole batch """
+        photos, rows = {}, []
+        for user_id, content in places:
+            photo = photo_row(content)
+            if photo is not None:
+                photos[photo[0]] = psycopg2.Binary(photo[1])
+            rows.append(self._place_row(user_id, content, photo[0] if photo else None))
+        if photos:
+            psycopg2.extras.execute_values(cursor, INSERT_PHOTOS_SQL, list(photos.items()), page_size=len(photos))
+        psycopg2.extras.execute_values(cursor, INSERT_PLACES_SQL, rows, page_size=len(rows))
+
+    def create_new_place(self, user_id: str, content: dict, callback=None) -> None:
+        """
+        Creating a new place in DB.
+        With the write buffer the place is inserted later in a batch;
+        callback(saved: bool) is called after the commit either way.
+        """
+        LOGGER.debug('Creating new place. UserID: %s.', user_id)
+        if self._flusher is not None:
+            with self._write_cond:
+                self._write_buffer.append((user_id, content, callback, time.monotonic()))
+                # The flusher waits for the first place and for a full buffer.
+                if len(self._write_buffer) in (1, self._write_buffer_size):
+                    self._write_cond.notify()
+            return
+        try:
+            photo = photo_row(content)
+            with self._pool.cursor() as cursor:
+                if photo is not None:
+                    execute(cursor, 'save_photo', photo[0], psycopg2.Binary(photo[1]))
+                execute(cursor, 'create_new_place', *self._place_row(user_id, content, photo[0] if photo else None))
+            LOGGER.debug('Creating new place. UserID: %s - Success.', user_id)
+            saved = True
+        except Exception as err:
+            LOGGER.error(msg=f'Problem creating new place. UserID: {user_id}. Error: {err}')
+            saved = False
+        if callback is not None:
+            callback(saved)
+
+    def import_places(self, user_id: str, places, batch_size: int = 1000) -> int:
+        """
+        Inserting places from the iterable in batches, with one statement for the places of a batch;
+        batches holding photos are smaller.
+        All batches are one transaction; the number of places is returned, None on errors.
+        """
+        LOGGER.debug('Importing places. UserID: %s.', user_id)
+        count = 0
+        try:
+            with self._pool.cursor() as cursor:
+                for batch in place_batches(places, batch_size):
+                    self._insert_places(cursor, [(user_id, content) for content in batch])
+                    count += len(batch)
+            LOGGER.debug('Importing places. UserID: %s - Success.', user_id)
+            return count
+        except Exception as err:
+            LOGGER.error(msg=f'Problem importing places. UserID: {user_id}. Error: {err}')
+
+    def flush(self) -> None:
+        """
+        Inserting all buffered places in one transaction.
+        If it fails, every place is inserted in its own transaction, so only the broken places are not saved.
+        """
+        with self._write_cond:
+            batch, self._write_buffer = self._write_buffer, []
+        if not batch:
+            return
+        try:
+            with self._pool.cursor() as cursor:
+                self._insert_places(cursor, [(user_id, content) for user_id, content, _, _ in batch])
+            LOGGER.debug('Creating %s buffered places - Success.', len(batch))
+            results = [True] * len(batch)
+        except Exception as err:
+            LOGGER.warning(msg=f'Problem creating {len(batch)} buffered places, they are created one by one. '
+                               f'Error: {err}')
+            results = [self._insert_place(user_id, content) for user_id, content, _, _ in batch]
+        for (user_id, _, callback, _), saved in zip(batch, results):
+            if callback is not None:
+                try:
+                    callback(saved)
+                except Exception as err:
+                    LOGGER.error(msg=f'Problem confirming new place. UserID: {user_id}. Error: {err}')
+
+    def _insert_place(self, user_id: str, content: dict) -> bool:
+        """ Inserting one buffered place in its own transaction """
+        try:
+            with self._pool.cursor() as cursor:
+                self._insert_places(cursor, [(user_id, content)])
+            return True
+        except Exception as err:
             LOGGER.error(msg=f'Problem creating new place. UserID: {user_id}. Error: {err}')
+            return False
+
+    def _flush_periodically(self) -> None:
+        """ Flushing the write buffer when it is full or its oldest place waits too long """
+        while not self._stopped.is_set():
+            with self._write_cond:
+                if not self._write_buffer:
+                    self._write_cond.wait(self._write_buffer_delay)
+                    continue
+                waited = time.monotonic() - self._write_buffer[0][3]
+                if len(self._write_buffer) < self._write_buffer_size and waited < self._write_buffer_delay:
+                    self._write_cond.wait(self._write_buffer_delay - waited)
+                    continue
+            self.flush()
+
+    def search_places(self, user_id: str, text: str, limit: int = 10, offset: int = 0) -> list:
+        """ Getting places whose description has the words of the text, best matches first """
+        LOGGER.debug('Searching places. UserID: %s.', user_id)
+        query = get_search_query(text)
+        if not query:
+            return []
+        try:
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'search_places', user_id, query, limit, offset)
+                result = list(starmap(Place, cursor.fetchall()))
+            LOGGER.debug('Searching places. UserID: %s - Success.', user_id)
+            return result
+        except Exception as err:
+            LOGGER.error(msg=f'Problem searching places. UserID: {user_id}. Error: {err}')
+
+    def get_place_photo(self, place_id: int) -> bytes:
+        """ Getting photo bytes of the place, only when they have to be uploaded """
+        LOGGER.debug('Getting place photo. PlaceID: %s.', place_id)
+        try:
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'get_place_photo', place_id)
+                row = cursor.fetchone()
+            return bytes(row[0]) if row and row[0] is not None else None
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting place photo. PlaceID: {place_id}. Error: {err}')
+
+    def set_photo_file_id(self, place_id: int, file_id: str) -> None:
+        """ Saving Telegram file_id of the place photo to send it without uploading """
+        LOGGER.debug('Saving photo file_id. PlaceID: %s.', place_id)
+        try:
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'set_photo_file_id', file_id, place_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem saving photo file_id. PlaceID: {place_id}. Error: {err}')
+
+    def get_session(self, user_id: str, ttl: float) -> str:
+        """ Getting content of the user session which has not expired """
+        try:
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'get_session', user_id, ttl)
+                row = cursor.fetchone()
+            return row[0] if row else None
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting session. UserID: {user_id}. Error: {err}')
+
+    def has_session(self, user_id: str, ttl: float) -> bool:
+        """ Checking that the user has a session which has not expired, without reading its content """
+        try:
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'has_session', user_id, ttl)
+                return cursor.fetchone() is not None
+        except Exception as err:
+            LOGGER.error(msg=f'Problem checking session. UserID: {user_id}. Error: {err}')
+            return False
+
+    def save_session(self, user_id: str, content: str) -> None:
+        """ Saving content of the user session """
+        try:
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'save_session', user_id, content)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem saving session. UserID: {user_id}. Error: {err}')
+
+    def delete_session(self, user_id: str) -> None:
+        """ Deleting the user session """
+        try:
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'delete_session', user_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem deleting session. UserID: {user_id}. Error: {err}')
+
+    def delete_expired_sessions(self, ttl: float) -> None:
+        """ Deleting sessions abandoned for longer than ttl seconds """
+        try:
+            with self._pool.cursor() as cursor:
+                execute(cursor, 'delete_expired_sessions', ttl)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem deleting expired sessions. Error: {err}')
+
+    def listen_changes(self, callback) -> None:
+        """
+        Calling back with user id on every change of places, made by any process.
+        The callback gets None when notifications could have been lost.
+        """
+        threading.Thread(target=self._listen_changes, args=(callback,), name='db-listen', daemon=True).start()
+
+    def _listen_changes(self, callback) -> None:
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self._db_url, sslmode='require')
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'listen {CHANGES_CHANNEL}')
+                # Changes made while there was no listener are unknown.
+                callback(None)
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 1) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        callback(int(conn.notifies.pop(0).payload))
+            except Exception as err:
+                LOGGER.error(msg=f'Problem listening to changes of places. Error: {err}')
+                callback(None)
+                self._stopped.wait(3)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def stats(self) -> dict:
+        """ Connection pool counters """
+        if self._pool is None:
+            return {}
+        return self._pool.stats()
 
     def close(self) -> None:
-        """ Closing connection to DB """
+        """ Closing connection to DB; buffered places are written before """
+        self._stopped.set()
+        if self._flusher is not None:
+            with self._write_cond:
+                self._write_cond.notify()
+            self._flusher.join()
+            self.flush()
         try:
-            self._conn.close()
+            self._pool.close()
             LOGGER.info(msg=f'The connection to DB has been closed.')
         except Exception as err:
             LOGGER.error(msg=f'Problem with closing DB connection. Error: {err}')
@@ -0,0 +1,93 @@
+"""
+Module of program which contains the dispatcher of incoming updates.
+Every chat is served by one worker lane, so updates of a chat are handled
+one by one and in order, while different chats are handled in parallel.
+"""
+
+import logging
+import queue
+import threading
+
+LOGGER = logging.getLogger('dispatcher.py')
+
+# 2**64 divided by the golden ratio: multiplying by it mixes all bits of the chat id into the high ones.
+FIBONACCI_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def get_lane_num(chat_id: int, lanes: int) -> int:
+    """
+    Lane of the chat. The chat id is hashed: the supervisor shards chats by chat_id % processes,
+    so in a worker process the low part of the id is the same for all chats.
+    """
+    return ((chat_id * FIBONACCI_MULTIPLIER) % 2 ** 64 >> 32) % lanes
+
+
+class Dispatcher:
+    """ Pool of worker lanes; a chat always goes to the same lane """
+
+    def __init__(self, workers: int = 8, lane_size: int = 100) -> None:
+        LOGGER.info(msg=f'Dispatcher initialisation. Workers: {workers}, lane size: {lane_size}.')
+        self._lanes = [queue.Queue(maxsize=lane_size) for _ in range(workers)]
+        # Keys of queued tasks, to drop duplicates (e.g. repeated taps of one button).
+        self._pending_keys = set()
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._coalesced = 0
+        self._errors = 0
+        self._workers = [
+            threading.Thread(target=self._work, args=(lane,), name=f'lane-{num}', daemon=True)
+            for num, lane in enumerate(self._lanes)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, chat_id: int, func, *args, key=None) -> bool:
+        """
+        Queueing a task to the lane of the chat.
+        Blocks while the lane is full; returns False if the task was coalesced.
+        """
+        if key is not None:
+            with self._lock:
+                if key in self._pending_keys:
+                    self._coalesced += 1
+                    LOGGER.debug('UserID: %s - duplicate task skipped.', chat_id)
+                    return False
+                self._pending_keys.add(key)
+        self._lanes[get_lane_num(chat_id, len(self._lanes))].put((key, func, args))
+        return True
+
+    def _work(self, lane: queue.Queue) -> None:
+        while True:
+            task = lane.get()
+            if task is None:
+                return
+            key, func, args = task
+            try:
+                func(*args)
+            except Exception as err:
+                LOGGER.error(msg=f'Problem handling update. Error: {err}', exc_info=True)
+                with self._lock:
+                    self._errors += 1
+            finally:
+                with self._lock:
+                    self._processed += 1
+                    self._pending_keys.discard(key)
+
+    def stats(self) -> dict:
+        """ Lane depth and task counters """
+        with self._lock:
+            return {
+                'lanes': len(self._lanes),
+                'queued': sum(lane.qsize() for lane in self._lanes),
+                'max_lane_depth': max(lane.qsize() for lane in self._lanes),
+                'processed': self._processed,
+                'coalesced': self._coalesced,
+                'errors': self._errors,
+            }
+
+    def close(self, timeout: float = 10.0) -> None:
+        """ Handling the queued tasks and stopping the workers """
+        for lane in self._lanes:
+            lane.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
@@ -0,0 +1,313 @@
+"""
+Module of program which contains export and import of places in GeoJSON, GPX and CSV.
+Places are written and parsed one by one, so memory doesn't depend on their number.
+A zip archive holds the places file and, optionally, the photos in 'photos/'.
+"""
+
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+from zipfile import ZIP_DEFLATED, ZipFile
+
+LOGGER = logging.getLogger('exchange.py')
+
+FORMATS = ('geojson', 'gpx', 'csv')
+CSV_FIELDS = ('lat', 'long', 'description', 'created_at', 'photo')
+GPX_NS = 'http://www.topografix.com/GPX/1/1'
+DESCRIPTION_SIZE = 250
+CHUNK_SIZE = 64 * 1024
+MAX_PHOTO_SIZE = 10 * 1024 * 1024  # Telegram limit of photo size.
+MAX_FILE_SIZE = 20 * 1024 * 1024  # Telegram limit of files downloaded by bots.
+
+
+def _photo_path(place_id: int) -> str:
+    return f'photos/{place_id}.jpg'
+
+
+def _created_at(place) -> str:
+    created_at = place.created_at
+    return created_at.isoformat() if hasattr(created_at, 'isoformat') else created_at
+
+
+def write_geojson(places, file, with_photos: bool = False) -> int:
+    """ Writing places as GeoJSON FeatureCollection, one feature per line """
+    count = 0
+    file.write('{"type": "FeatureCollection", "features": [\n')
+    for place in places:
+        properties = {'description': place.description, 'created_at': _created_at(place)}
+        if with_photos and place.has_photo:
+            properties['photo'] = _photo_path(place.id)
+        feature = {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [place.long, place.lat]},
+            'properties': properties,
+        }
+        file.write((',\n' if count else '') + json.dumps(feature, ensure_ascii=False))
+        count += 1
+    file.write('\n]}\n')
+    return count
+
+
+def write_gpx(places, file, with_photos: bool = False) -> int:
+    """ Writing places as GPX waypoints """
+    count = 0
+    file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+               f'<gpx version="1.1" creator="places bot" xmlns="{GPX_NS}">\n')
+    for place in places:
+        file.write(f'<wpt lat="{place.lat}" lon="{place.long}">')
+        if place.created_at:
+            file.write(f'<time>{escape(_created_at(place))}</time>')
+        file.write(f"<name>{escape(place.description or '')}</name>")
+        if with_photos and place.has_photo:
+            file.write(f'<link href={quoteattr(_photo_path(place.id))}/>')
+        file.write('</wpt>\n')
+        count += 1
+    file.write('</gpx>\n')
+    return count
+
+
+def write_csv(places, file, with_photos: bool = False) -> int:
+    """ Writing places as CSV with a header """
+    count = 0
+    writer = csv.writer(file)
+    writer.writerow(CSV_FIELDS)
+    for place in places:
+        writer.writerow((place.lat, place.long, place.description, _created_at(place),
+                         _photo_path(place.id) if with_photos and place.has_photo else ''))
+        count += 1
+    return count
+
+
+WRITERS = {'geojson': write_geojson, 'gpx': write_gpx, 'csv': write_csv}
+
+
+def _content(lat, long, description, photo: str = None) -> dict:
+    """ Content of a new place like the one made by the bot; None if the values are wrong """
+    try:
+        lat, long = float(lat), float(long)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= long <= 180):
+        return None
+    content = {'lat': lat, 'long': long, 'description': (description or '')[:DESCRIPTION_SIZE]}
+    if photo:
+        content['photo_path'] = photo
+    return content
+
+
+def read_geojson(file):
+    """
+    Generator of places from a GeoJSON FeatureCollection of points.
+    Features are decoded one by one from the text read in chunks.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    index = -1
+    # Looking for the array of features.
+    while index < 0:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        buffer += chunk
+        start = buffer.find('"features"')
+        if start >= 0:
+            index = buffer.find('[', start)
+    index += 1
+    while True:
+        while index < len(buffer) and buffer[index] in ' \t\r\n,':
+            index += 1
+        if index < len(buffer) and buffer[index] == ']':
+            return
+        try:
+            if index == len(buffer):
+                raise json.JSONDecodeError('Unexpected end of the features', buffer, index)
+            feature, index = decoder.raw_decode(buffer, index)
+        except json.JSONDecodeError:
+            # The feature continues in the next chunk.
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                raise
+            buffer = buffer[index:] + chunk
+            index = 0
+            continue
+        geometry = feature.get('geometry') if isinstance(feature, dict) else None
+        if not isinstance(geometry, dict) or geometry.get('type') != 'Point':
+            yield None
+            continue
+        coordinates = geometry.get('coordinates')
+        if not isinstance(coordinates, list) or len(coordinates) < 2:
+            yield None
+            continue
+        properties = feature.get('properties')
+        if not isinstance(properties, dict):
+            properties = {}
+        long, lat = coordinates[:2]
+        yield _content(lat, long, properties.get('description') or properties.get('name'),
+                       properties.get('photo'))
+
+
+def read_gpx(file):
+    """ Generator of places from GPX waypoints, parsed incrementally """
+    root = None
+    for event, element in ET.iterparse(file, events=('start', 'end')):
+        if root is None:
+            root = element
+        if event != 'end' or element.tag.rsplit('}', 1)[-1] != 'wpt':
+            continue
+        description = None
+        photo = None
+        for child in element:
+            tag = child.tag.rsplit('}', 1)[-1]
+            if tag in ('name', 'desc') and description is None:
+                description = child.text
+            elif tag == 'link':
+                photo = child.get('href')
+        yield _content(element.get('lat'), element.get('lon'), description, photo)
+        # Parsed waypoints are dropped from the tree.
+        root.clear()
+
+
+def read_csv(file):
+    """ Generator of places from CSV with 'lat', 'long' (or 'lon') and 'description' columns """
+    for row in csv.DictReader(file):
+        yield _content(row.get('lat'), row.get('long') or row.get('lon'),
+                       row.get('description') or row.get('name'), row.get('photo'))
+
+
+READERS = {'geojson': read_geojson, 'json': read_geojson, 'gpx': read_gpx, 'csv': read_csv}
+
+
+def get_format(file_name: str) -> str:
+    """ Format by the file extension; None if it isn't supported """
+    extension = os.path.splitext(file_name or '')[1].lower().lstrip('.')
+    return extension if extension in READERS or extension == 'zip' else None
+
+
+def export_places(db, user_id: int, file, file_format: str = 'geojson', with_photos: bool = False) -> int:
+    """
+    Writing places of the user to the binary file as a zip archive.
+    Places are streamed by db.iter_places; photos are read one by one.
+    """
+    photo_ids = []
+
+    def places():
+        for place in db.iter_places(user_id=user_id):
+            if with_photos and place.has_photo:
+                photo_ids.append(place.id)
+            yield place
+
+    with ZipFile(file, 'w', compression=ZIP_DEFLATED) as zip_file:
+        with zip_file.open(f'places.{file_format}', 'w') as places_file:
+            with io.TextIOWrapper(places_file, encoding='utf-8', newline='') as text_file:
+                count = WRITERS[file_format](places(), text_file, with_photos=with_photos)
+        for place_id in photo_ids:
+            photo = db.get_place_photo(place_id=place_id)
+            if photo is not None:
+                zip_file.writestr(_photo_path(place_id), photo)
+    LOGGER.info(msg=f'UserID: {user_id}. {count} places have been exported.')
+    return count
+
+
+def read_places(file, file_name: str):
+    """
+    Generator of places from the binary file of a supported format, zip included.
+    Wrong places are given as None so they can be counted.
+    """
+    file_format = get_format(file_name)
+    if file_format is None:
+        raise ValueError(f'Format of {file_name} is not supported.')
+    if file_format == 'gpx':
+        yield from read_gpx(file)
+        return
+    if file_format != 'zip':
+        yield from READERS[file_format](io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+        return
+    with ZipFile(file) as zip_file:
+        names = [name for name in zip_file.namelist() if get_format(name) not in (None, 'zip')]
+        if not names:
+            raise ValueError(f'There is no places file in {file_name}.')
+        photos = set(zip_file.namelist())
+        with zip_file.open(names[0]) as places_file:
+            for content in read_places(places_file, names[0]):
+                photo_path = content.pop('photo_path', None) if content else None
+                if photo_path in photos:
+                    photo = _read_photo(zip_file, photo_path)
+                    if photo is not None:
+                        content['photo'] = photo
+                yield content
+
+
+def _read_photo(zip_file, photo_path: str) -> bytes:
+    """ Photo from the archive; None if it is bigger than MAX_PHOTO_SIZE when unpacked """
+    with zip_file.open(photo_path) as photo_file:
+        photo = photo_file.read(MAX_PHOTO_SIZE + 1)
+    if len(photo) > MAX_PHOTO_SIZE:
+        LOGGER.warning(msg=f'Photo {photo_path} is bigger than {MAX_PHOTO_SIZE} bytes, it is not imported.')
+        return None
+    return photo
+
+
+def import_places(db, user_id: int, file, file_name: str, batch_size: int = 1000) -> tuple:
+    """ Importing places from the file through the batched insert of the DB; (imported, skipped) """
+    skipped = 0
+
+    def places():
+        nonlocal skipped
+        for content in read_places(file, file_name):
+            if content is None:
+                skipped += 1
+                continue
+            content.pop('photo_path', None)
+            yield content
+
+    imported = db.import_places(user_id=user_id, places=places(), batch_size=batch_size)
+    LOGGER.info(msg=f'UserID: {user_id}. {imported} places have been imported, {skipped} skipped.')
+    return imported, skipped
+
+
+async def _take(places, limit: int) -> list:
+    """ Up to `limit` next items of the async generator """
+    chunk = []
+    async for place in places:
+        chunk.append(place)
+        if len(chunk) == limit:
+            break
+    return chunk
+
+
+class BlockingDatabase:
+    """
+    Blocking view of an async DB (core.aiodatabase.AsyncDatabase) for the export and import,
+    which run in threads outside the event loop.
+    Every call waits for its coroutine run by the loop; places are taken from the loop in chunks.
+    """
+
+    def __init__(self, db, loop: asyncio.AbstractEventLoop) -> None:
+        self._db = db
+        self._loop = loop
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def iter_places(self, user_id: int, chunk_size: int = 1000):
+        """ Generator of all places of the user, as the iter_places of the async DB """
+        places = self._db.iter_places(user_id=user_id, chunk_size=chunk_size)
+        try:
+            while True:
+                chunk = self._call(_take(places, chunk_size))
+                yield from chunk
+                if len(chunk) < chunk_size:
+                    return
+        finally:
+            self._call(places.aclose())
+
+    def get_place_photo(self, place_id: int) -> bytes:
+        return self._call(self._db.get_place_photo(place_id=place_id))
+
+    def import_places(self, user_id: int, places, batch_size: int = 1000) -> int:
+        return self._call(self._db.import_places(user_id=user_id, places=places, batch_size=batch_size))
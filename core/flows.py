@@ -0,0 +1,263 @@
+"""
+Module of program which contains the conversation logic shared by the threaded and the asyncio bots.
+Flows take the results of the database calls and change the sessions; they return the replies
+to send, which every runtime sends in its own way. So both bots give the same answers.
+"""
+
+from typing import NamedTuple
+
+import core.menus as menus
+import core.routes as routes
+from core.metrics import stats_text
+
+ALBUM_SIZE = 10  # Telegram limit of photos in one media group.
+DESCRIPTION_SIZE = 250
+
+WELCOME_TEXT = 'Welcome!'
+PLACES_TEXT = 'Your places:'
+PLACES_NOT_FOUND_TEXT = 'Your places were not found.'
+PLACES_DELETED_TEXT = 'All your places have been deleted!'
+ASK_LOCATION_TEXT = 'Please, send your location'
+LOCATION_RECEIVED_TEXT = 'Location received.'
+DESCRIPTION_RECEIVED_TEXT = 'Description received.'
+PHOTO_RECEIVED_TEXT = 'Photo received.'
+ASK_PLACE_LOCATION_TEXT = 'Please, send place location.'
+ASK_PLACE_DESCRIPTION_TEXT = f'Please, send place description (less than {DESCRIPTION_SIZE} symbols).'
+ASK_PLACE_PHOTO_TEXT = 'Please, send place photo.'
+PLACE_EXPIRED_TEXT = 'Adding of the place has expired, please start again.'
+PHOTO_FAILED_TEXT = 'The photo could not be processed, the place is saved without it.'
+PLACE_SAVED_TEXT = 'Your place has been saved!'
+PLACE_NOT_SAVED_TEXT = 'Your place was not saved, please try again.'
+NOT_EXPORTED_TEXT = 'Your places were not exported, please try later.'
+NOT_IMPORTED_TEXT = 'Places were not imported, please check the file.'
+ADMIN_PROMPT_TEXT = '#>'
+NO_STATS_TEXT = 'No stats yet.'
+PROFILER_RUNNING_TEXT = 'The profiler is already running.'
+MEMORY_STARTED_TEXT = 'Memory tracing started. Press "Memory" again to get the growth.'
+
+
+class Text(NamedTuple):
+    """ Text message with an optional keyboard """
+
+    text: str
+    reply_markup: object = None
+
+
+class Venue(NamedTuple):
+    """ Place sent as a venue """
+
+    latitude: float
+    longitude: float
+    title: str
+    address: str
+
+
+class Album(NamedTuple):
+    """ Up to ALBUM_SIZE (place, caption) pairs whose photos are sent together """
+
+    places: list
+
+
+def main_menu() -> list:
+    """ Main menu """
+    return [Text(routes.MAIN_MENU_TEXT, menus.main_menu())]
+
+
+def help_message() -> list:
+    """ Help, then the main menu """
+    return [Text(menus.HELP_TEXT)] + main_menu()
+
+
+def welcome() -> list:
+    """ Greeting of a new user """
+    return [Text(WELCOME_TEXT)] + help_message()
+
+
+def places_list(places: list, menu: tuple = None) -> list:
+    """ Replies with the places: photos by albums, then venues; then the menu (text, keyboard) or the main menu """
+    replies = []
+    if places:
+        replies.append(Text(PLACES_TEXT))
+        photo_places = [(place, menus.place_caption(num, place))
+                        for num, place in enumerate(places) if place.has_photo]
+        replies.extend(Album(photo_places[start:start + ALBUM_SIZE])
+                       for start in range(0, len(photo_places), ALBUM_SIZE))
+        replies.extend(Venue(place.lat, place.long, menus.place_caption(num, place), f'{place.lat}, {place.long}')
+                       for num, place in enumerate(places))
+    else:
+        replies.append(Text(PLACES_NOT_FOUND_TEXT))
+    return replies + ([Text(*menu)] if menu else main_menu())
+
+
+def places_page(places: list) -> list:
+    """ Replies with a page of the last places, fetched with one extra place which tells of older ones """
+    places = places or []
+    page = places[:routes.PLACES_PAGE_SIZE]
+    has_next_page = len(places) > routes.PLACES_PAGE_SIZE
+    menu = (routes.MORE_PLACES_TEXT, menus.more_places_menu(page[-1].id)) if has_next_page else None
+    return places_list(page, menu=menu)
+
+
+def search_usage() -> list:
+    """ Usage of /search without words """
+    return [Text(menus.SEARCH_USAGE_TEXT)] + main_menu()
+
+
+def search_page(places: list, words: str, page: int) -> list:
+    """ Replies with a page of search results, fetched with one extra place which tells of the next page """
+    places = places or []
+    has_next_page = len(places) > routes.SEARCH_PAGE_SIZE
+    menu = (routes.search_text(words, page), menus.search_menu(has_next_page)) if places else None
+    return places_list(places[:routes.SEARCH_PAGE_SIZE], menu=menu)
+
+
+def ask_location() -> list:
+    """ Asking the location to search places near it """
+    return [Text(ASK_LOCATION_TEXT, menus.cancel_menu())]
+
+
+def nearest_places(places: list) -> list:
+    """ Replies with the places nearest to the received location """
+    return [Text(LOCATION_RECEIVED_TEXT)] + places_list(places)
+
+
+def places_deleted() -> list:
+    """ Confirmation of deleting all places """
+    return [Text(PLACES_DELETED_TEXT)] + main_menu()
+
+
+def export_failed(count: int) -> list:
+    """ Replies when there is no archive to send: no places (0) or an error (None) """
+    return [Text(PLACES_NOT_FOUND_TEXT if count == 0 else NOT_EXPORTED_TEXT)] + main_menu()
+
+
+def import_formats() -> list:
+    """ Formats of files which can be imported """
+    return [Text(menus.IMPORT_FORMATS_TEXT)] + main_menu()
+
+
+def imported(count: int, skipped: int) -> list:
+    """ Replies after an import; count is None on errors """
+    if count is None:
+        text = NOT_IMPORTED_TEXT
+    else:
+        text = f'{count} places have been imported.' + (f' {skipped} were skipped.' if skipped else '')
+    return [Text(text)] + main_menu()
+
+
+def place_menu(content: dict) -> list:
+    """ Menu of the place in progress; 'Save' is there once location and description are added """
+    can_save = 'lat' in content.keys() and 'description' in content.keys()
+    return [Text(routes.PLACE_MENU_TEXT, menus.place_menu(can_save=can_save))]
+
+
+def start_place(sessions, chat_id: int) -> list:
+    """ Starting a new place in the session """
+    sessions.set(chat_id, {})
+    return [Text(menus.ADD_PLACE_TEXT)] + place_menu({})
+
+
+def update_place(sessions, chat_id: int, fields: dict, text: str) -> tuple:
+    """ Adding fields to the place in the session; (False, replies) if the session has expired """
+    content = sessions.get(chat_id)
+    if content is None:
+        return False, [Text(PLACE_EXPIRED_TEXT)] + main_menu()
+    content.update(fields)
+    sessions.set(chat_id, content)
+    return True, [Text(text)] + place_menu(content)
+
+
+def place_location(sessions, chat_id: int, lat: float, long: float) -> tuple:
+    """ Adding the location to the place in progress """
+    return update_place(sessions, chat_id, {'lat': lat, 'long': long}, LOCATION_RECEIVED_TEXT)
+
+
+def place_description(sessions, chat_id: int, text: str) -> tuple:
+    """ Adding the description, cut to DESCRIPTION_SIZE, to the place in progress """
+    return update_place(sessions, chat_id, {'description': text[:DESCRIPTION_SIZE]}, DESCRIPTION_RECEIVED_TEXT)
+
+
+def place_photo(sessions, chat_id: int, file_id: str) -> tuple:
+    """ Adding the photo to the place in progress """
+    # Only file_id is kept in the session; the processed photo is taken when the place is saved.
+    return update_place(sessions, chat_id, {'photo_file_id': file_id}, PHOTO_RECEIVED_TEXT)
+
+
+def take_place(sessions, chat_id: int) -> dict:
+    """ Content of the place to save, removed from the session; None if the session has expired """
+    content = sessions.get(chat_id)
+    if content is not None:
+        sessions.delete(chat_id)
+    return content
+
+
+def photo_failed(content: dict) -> list:
+    """ The place is saved without the photo which could not be processed """
+    del content['photo_file_id']
+    return [Text(PHOTO_FAILED_TEXT)]
+
+
+def place_saved(success: bool) -> list:
+    """ Confirmation sent after the commit of the place """
+    return [Text(PLACE_SAVED_TEXT if success else PLACE_NOT_SAVED_TEXT)] + main_menu()
+
+
+def cancel_place(sessions, chat_id: int) -> str:
+    """ Dropping the place in progress; the file_id of its photo is returned to discard the photo """
+    content = sessions.get(chat_id) or {}
+    sessions.delete(chat_id)
+    return content.get('photo_file_id')
+
+
+def ask_place_location() -> list:
+    """ Asking the location of the place """
+    return [Text(ASK_PLACE_LOCATION_TEXT)]
+
+
+def ask_place_description() -> list:
+    """ Asking the description of the place """
+    return [Text(ASK_PLACE_DESCRIPTION_TEXT)]
+
+
+def ask_place_photo() -> list:
+    """ Asking the photo of the place """
+    return [Text(ASK_PLACE_PHOTO_TEXT)]
+
+
+def admin_prompt(admin_set: set, chat_id: int) -> list:
+    """ Asking the admin PIN """
+    admin_set.add(chat_id)
+    return [Text(ADMIN_PROMPT_TEXT)]
+
+
+def admin_menu() -> list:
+    """ Admin menu """
+    return [Text(routes.ADMIN_MENU_TEXT, menus.admin_menu())]
+
+
+def check_admin_pin(admin_set: set, chat_id: int, text: str, pin: str) -> list:
+    """ The admin menu for the right PIN; the user leaves the admin mode otherwise """
+    if text == pin:
+        return admin_menu()
+    admin_set.discard(chat_id)
+    return main_menu()
+
+
+def admin_exit(admin_set: set, chat_id: int) -> list:
+    """ Leaving the admin mode """
+    admin_set.discard(chat_id)
+    return main_menu()
+
+
+def admin_stats(stats: dict, summary: str) -> list:
+    """ Stats and histograms summary, then the admin menu """
+    return [Text(stats_text(stats, summary) or NO_STATS_TEXT)] + admin_menu()
+
+
+def profile_started(started: bool, seconds: float) -> list:
+    """ Replies on the 'Profile' button; started is False if the profiler is already running """
+    if started:
+        text = f'Profiling for {seconds:g} s, the collapsed stacks will be sent as a document.'
+    else:
+        text = PROFILER_RUNNING_TEXT
+    return [Text(text)] + admin_menu()
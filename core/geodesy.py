@@ -0,0 +1,73 @@
+""" A module for batch geodesy calculations with NumPy
+The same model as core.locationcalc, applied to many points at once:
+bounding areas, great-circle distances and radius masks.
+"""
+import logging
+
+import numpy as np
+
+from core.locationcalc import R_EARTH
+
+LOGGER = logging.getLogger('geodesy.py')
+
+LAT_METERS_IN_DEGREE = round(40_000 / 360 * 1000)
+
+
+def bounding_boxes(lats, longs, distance) -> np.ndarray:
+    """
+    Function for calculating the bounding area corners of many points.
+    Returns an array of rows (min_lat, min_long, max_lat, max_long).
+    An area which reaches a pole covers all longitudes; an area which crosses
+    the antimeridian has min_long > max_long, as in core.locationcalc.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    long_meters_in_degree = np.abs(np.round(LAT_METERS_IN_DEGREE * np.cos(np.radians(lats))))
+    d_lat = np.round(np.asarray(distance, dtype=np.float64) / LAT_METERS_IN_DEGREE, 6)
+    d_lat = np.broadcast_to(d_lat, lats.shape)
+    with np.errstate(divide='ignore'):
+        d_long = np.where(
+            long_meters_in_degree > 0,
+            np.round(distance / np.maximum(long_meters_in_degree, 1), 6),
+            180.0
+        )
+    min_lats = np.maximum(np.round(lats - d_lat, 6), -90.0)
+    max_lats = np.minimum(np.round(lats + d_lat, 6), 90.0)
+    min_longs = np.round(longs - d_long, 6)
+    max_longs = np.round(longs + d_long, 6)
+    min_longs = np.where(min_longs < -180, np.round(min_longs + 360, 6), min_longs)
+    max_longs = np.where(max_longs > 180, np.round(max_longs - 360, 6), max_longs)
+    all_longs = (d_long >= 180) | (min_lats == -90) | (max_lats == 90)
+    return np.stack((min_lats, np.where(all_longs, -180.0, min_longs),
+                     max_lats, np.where(all_longs, 180.0, max_longs)), axis=-1)
+
+
+def distances(lat: float, long: float, lats, longs) -> np.ndarray:
+    """ Function for calculating great-circle distances in meters from one point to many """
+    lat_1, long_1 = np.radians(float(lat)), np.radians(float(long))
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    longs = np.radians(np.asarray(longs, dtype=np.float64))
+    hav = np.sin((lats - lat_1) / 2) ** 2 \
+        + np.cos(lat_1) * np.cos(lats) * np.sin((longs - long_1) / 2) ** 2
+    return 2 * R_EARTH * np.arcsin(np.minimum(1.0, np.sqrt(hav)))
+
+
+def within_radius(lat: float, long: float, lats, longs, radius: float) -> np.ndarray:
+    """ Function for calculating a mask of points which are not farther than radius """
+    return distances(lat, long, lats, longs) <= radius
+
+
+def search_areas(lat: float, long: float, radii) -> list:
+    """ Bounding areas of the search rings around one point, all rings in one call """
+    count = len(radii)
+    return [tuple(area) for area in bounding_boxes([float(lat)] * count, [float(long)] * count, radii).tolist()]
+
+
+def bounding_box(lat: str, long: str, distance: int) -> tuple:
+    """ Scalar wrapper of bounding_boxes, compatible with locationcalc.get_area_coord """
+    return tuple(float(value) for value in bounding_boxes([float(lat)], [float(long)], distance)[0])
+
+
+def distance(lat_1: str, long_1: str, lat_2: str, long_2: str) -> float:
+    """ Scalar wrapper of distances """
+    return float(distances(lat_1, long_1, [float(lat_2)], [float(long_2)])[0])
@@ -2,7 +2,7 @@
 Math is better than external services API
 https://en.wikipedia.org/wiki/Circle_of_latitude
 """
-from math import cos, radians
+from math import asin, cos, floor, radians, sin, sqrt
 
 import logging
 
@@ -11,6 +11,16 @@ LOGGER = logging.getLogger('locationcalc.py')
 
 R_EARTH = 6_371_000  # Earth radius in meters.
 
+# Fixed grid used as a spatial key of places.
+GRID_STEP = 0.01  # Cell size in degrees (about 1.1 km along a meridian).
+GRID_ROWS = 18_000  # 180 / GRID_STEP
+GRID_COLUMNS = 36_000  # 360 / GRID_STEP
+MAX_AREA_CELLS = 400  # Bigger areas are searched without the grid.
+
+# Search rings (meters) of the nearest places search, checked one by one.
+NEAR_RADII = (500, 2_000, 10_000, 50_000)
+
+
 def get_area_coord(lat: str, long: str, distance: int) -> tuple:
     """ Function for calculating the bounding area corners coordinates """
     LOGGER.debug(msg='Location calculation is using.')
@@ -21,8 +31,74 @@ def get_area_coord(lat: str, long: str, distance: int) -> tuple:
         round(lat_meters_in_degree * cos(radians(lat)))
     )
     d_lat = round((distance / lat_meters_in_degree), 6)
-    d_long = round((distance / long_meters_in_degree), 6)
-    area = (round((lat - d_lat), 6), round((long - d_long), 6),
-            round((lat + d_lat), 6), round((long + d_long), 6))
+    # Near the poles a degree of longitude is shorter than a meter.
+    d_long = round((distance / long_meters_in_degree), 6) if long_meters_in_degree else 180.0
+    min_lat, max_lat = max(round((lat - d_lat), 6), -90.0), min(round((lat + d_lat), 6), 90.0)
+    if d_long >= 180 or min_lat == -90 or max_lat == 90:
+        # The area reaches a pole, so it covers all longitudes.
+        area = (min_lat, -180.0, max_lat, 180.0)
+    else:
+        area = (min_lat, wrap_long(round((long - d_long), 6)), max_lat, wrap_long(round((long + d_long), 6)))
     LOGGER.debug(msg='Location area was calculated.')
     return area
+
+
+def wrap_long(long: float) -> float:
+    """ Longitude brought into [-180, 180] """
+    if long < -180:
+        return round(long + 360, 6)
+    if long > 180:
+        return round(long - 360, 6)
+    return long
+
+
+def split_area(area: tuple) -> list:
+    """
+    Areas which don't cross the antimeridian. An area which crosses it has min_long > max_long,
+    like bounding boxes of GeoJSON, and is split in two.
+    """
+    min_lat, min_long, max_lat, max_long = area
+    if min_long <= max_long:
+        return [area]
+    return [(min_lat, min_long, max_lat, 180.0), (min_lat, -180.0, max_lat, max_long)]
+
+
+def get_distance(lat_1: str, long_1: str, lat_2: str, long_2: str) -> float:
+    """ Function for calculating the great-circle distance in meters (haversine formula) """
+    lat_1, long_1 = radians(float(lat_1)), radians(float(long_1))
+    lat_2, long_2 = radians(float(lat_2)), radians(float(long_2))
+    hav = sin((lat_2 - lat_1) / 2) ** 2 + cos(lat_1) * cos(lat_2) * sin((long_2 - long_1) / 2) ** 2
+    return 2 * R_EARTH * asin(min(1.0, sqrt(hav)))
+
+
+def _get_cell_row(lat: float) -> int:
+    return min(max(int(floor((lat + 90) / GRID_STEP)), 0), GRID_ROWS - 1)
+
+
+def _get_cell_column(long: float) -> int:
+    return int(floor((long + 180) / GRID_STEP)) % GRID_COLUMNS
+
+
+def get_cell_id(lat: str, long: str) -> int:
+    """ Function for calculating the grid cell which contains the location """
+    return _get_cell_row(float(lat)) * GRID_COLUMNS + _get_cell_column(float(long))
+
+
+def get_area_cells(area: tuple) -> list:
+    """
+    Function for calculating the grid cells which cover the bounding area.
+    Returns None if the area covers too many cells to be worth listing.
+    """
+    first_row, last_row = _get_cell_row(area[0]), _get_cell_row(area[2])
+    first_column = int(floor((area[1] + 180) / GRID_STEP))
+    last_column = int(floor((area[3] + 180) / GRID_STEP))
+    if area[1] > area[3]:
+        # The area crosses the antimeridian.
+        last_column += GRID_COLUMNS
+    columns_count = min(last_column - first_column + 1, GRID_COLUMNS)
+    if (last_row - first_row + 1) * columns_count > MAX_AREA_CELLS:
+        return None
+    columns = [(first_column + i) % GRID_COLUMNS for i in range(columns_count)]
+    return [row * GRID_COLUMNS + column
+            for row in range(first_row, last_row + 1)
+            for column in columns]
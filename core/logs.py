@@ -0,0 +1,169 @@
+"""
+Module of program which contains the logging pipeline.
+Loggers only put records to a queue; one listener thread formats and writes them,
+so handler threads never wait for the disk. Log files are rotated by size and by
+time, and the rotated ones are compressed by gzip.
+"""
+
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_DIR = 'logs'
+LOG_FILE = 'bot.log'
+LOG_FORMAT = '%(levelname)s ; %(asctime)s ; %(name)s ; %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formatter of records as JSON lines """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc_info'] = record.exc_text
+        if record.stack_info:
+            entry['stack_info'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """
+    Handler which rotates the file when it is bigger than max_bytes
+    or older than interval seconds; rotated files are compressed.
+    The size is counted on writes, so records are neither formatted twice
+    nor followed by a stat and a flush like in RotatingFileHandler.
+    """
+
+    def __init__(self, filename: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 10,
+                 interval: float = 24 * 60 * 60) -> None:
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self._size = os.path.getsize(self.baseFilename) if os.path.exists(self.baseFilename) else 0
+        self._interval = interval
+        self._rollover_at = time.time() + interval if interval else None
+
+    def namer(self, default_name: str) -> str:
+        return f'{default_name}.gz'
+
+    def rotator(self, source: str, dest: str) -> None:
+        with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+            shutil.copyfileobj(source_file, dest_file)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self._rollover_at is not None and time.time() >= self._rollover_at:
+            return self._size > 0
+        return 0 < self.maxBytes <= self._size
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self._size = 0
+        if self._rollover_at is not None:
+            self._rollover_at = time.time() + self._interval
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # The stream is flushed by the listener when the queue is empty, not after every record.
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            msg = self.format(record) + self.terminator
+            self.stream.write(msg)
+            # max_bytes is compared with the file size, so bytes are counted, not characters.
+            self._size += len(msg.encode(self.encoding or 'utf-8'))
+        except Exception:
+            self.handleError(record)
+
+
+class _QueueHandler(QueueHandler):
+    """ Handler which only merges the message; the record is formatted by the listener """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Other handlers of the logger still get the record as it was logged.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        # Tracebacks are passed as text, so records can go to other processes.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _Listener(QueueListener):
+    """ Listener which flushes the handlers when the queue is empty """
+
+    def dequeue(self, block: bool):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush()
+            return self.queue.get(block)
+
+    def stop(self) -> None:
+        super().stop()
+        for handler in self.handlers:
+            handler.flush()
+
+
+def attach_queue(log_queue, level='INFO') -> None:
+    """
+    Sending records of the process to the queue instead of other handlers.
+    Worker processes call it with the queue of the main process.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(level)
+
+
+def start_listener(log_queue, path: str = LOG_DIR, json_format: bool = False, max_bytes: int = 10 * 1024 * 1024,
+                   backup_count: int = 10, interval: float = 24 * 60 * 60) -> QueueListener:
+    """ Starting the thread which writes records from the queue to the rotated file """
+    os.makedirs(path, exist_ok=True)
+    handler = CompressedRotatingFileHandler(
+        os.path.join(path, LOG_FILE), max_bytes=max_bytes, backup_count=backup_count, interval=interval
+    )
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT))
+    listener = _Listener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+def setup_logging(level='INFO', **kwargs) -> QueueListener:
+    """ Queue-based logging of the process; the listener has to be stopped on exit """
+    log_queue = queue.SimpleQueue()
+    attach_queue(log_queue, level)
+    return start_listener(log_queue, **kwargs)
+
+
+class _LocalHandler(logging.Handler):
+    """ Handler passing records from other processes to the loggers of this process """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+def forward_records(log_queue) -> QueueListener:
+    """ Starting the thread which passes records of worker processes to the local loggers """
+    listener = QueueListener(log_queue, _LocalHandler())
+    listener.start()
+    return listener
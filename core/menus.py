@@ -0,0 +1,112 @@
+"""
+Module of program which contains texts and keyboards of the bot menus.
+The threaded and the asyncio bots share it.
+"""
+
+import telebot as tb
+
+from core.place import Place
+
+HELP_TEXT = """
+        I am a bot that will help you save interesting places.
+I can:
++ Save information about some place for you.
++ Provide you list of your 10 last places.
++ Provide you list of your 10 places closest to your current location.
++ Find your places by words of their description: /search <words>
++ Export your places: /export [geojson|gpx|csv] [photos]
++ Import places: send a GeoJSON, GPX, CSV or zip file.
+"""
+
+IMPORT_FORMATS_TEXT = 'Please, send a file in GeoJSON, GPX, CSV or zip format (up to 20 MB).'
+
+SEARCH_USAGE_TEXT = 'Please, send words of the place description after the command, e.g. /search cafe'
+
+
+ADD_PLACE_TEXT = """
+In order to add a new place you need to add the following parameters:
++ location (required)
++ description (required, less than 250 symbols)
++ photo (optional)
+"""
+
+
+def main_menu() -> tb.types.InlineKeyboardMarkup:
+    """ Keyboard of the main menu """
+    keyboard = tb.types.InlineKeyboardMarkup(row_width=1)
+    keyboard.add(
+        tb.types.InlineKeyboardButton(text='Add new place', callback_data='add_place'),
+        tb.types.InlineKeyboardButton(text='Get list of your 10 last places',
+                                      callback_data='get_places'),
+        tb.types.InlineKeyboardButton(text='Get your places near your current location',
+                                      callback_data='get_places_location'),
+        tb.types.InlineKeyboardButton(text='Delete all your places', callback_data='delete_places'),
+        tb.types.InlineKeyboardButton(text='Help', callback_data='help'))
+    return keyboard
+
+
+def cancel_menu() -> tb.types.InlineKeyboardMarkup:
+    """ Keyboard with the only 'Cancel' button """
+    keyboard = tb.types.InlineKeyboardMarkup(row_width=1)
+    keyboard.add(
+        tb.types.InlineKeyboardButton(text='Cancel', callback_data='cancel')
+    )
+    return keyboard
+
+
+def place_menu(can_save: bool) -> tb.types.InlineKeyboardMarkup:
+    """ Keyboard of the adding new place menu """
+    keyboard = tb.types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        tb.types.InlineKeyboardButton(text='Add location', callback_data='location'),
+        tb.types.InlineKeyboardButton(text='Add description', callback_data='description'),
+        tb.types.InlineKeyboardButton(text='Add photo', callback_data='photo'),
+        tb.types.InlineKeyboardButton(text='Cancel', callback_data='cancel')
+    )
+    if can_save:
+        keyboard.add(tb.types.InlineKeyboardButton(text='Save', callback_data='save'))
+    return keyboard
+
+
+def admin_menu() -> tb.types.InlineKeyboardMarkup:
+    """ Keyboard of the admin menu """
+    keyboard = tb.types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        tb.types.InlineKeyboardButton(text='Get logs', callback_data='logs'),
+        tb.types.InlineKeyboardButton(text='Stats', callback_data='stats'),
+        tb.types.InlineKeyboardButton(text='Profile', callback_data='profile'),
+        tb.types.InlineKeyboardButton(text='Memory', callback_data='memory'),
+        tb.types.InlineKeyboardButton(text='Exit', callback_data='exit')
+    )
+    return keyboard
+
+
+def search_menu(has_next_page: bool) -> tb.types.InlineKeyboardMarkup:
+    """ Keyboard of the search results """
+    keyboard = tb.types.InlineKeyboardMarkup(row_width=2)
+    buttons = [tb.types.InlineKeyboardButton(text='Main menu', callback_data='menu')]
+    if has_next_page:
+        buttons.append(tb.types.InlineKeyboardButton(text='Next page', callback_data='next_page'))
+    keyboard.add(*buttons)
+    return keyboard
+
+
+def more_places_menu(last_place_id: int) -> tb.types.InlineKeyboardMarkup:
+    """ Keyboard of the list of places which has older places """
+    keyboard = tb.types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        tb.types.InlineKeyboardButton(text='Main menu', callback_data='menu'),
+        tb.types.InlineKeyboardButton(text='Next page', callback_data=f'next_page:{last_place_id}')
+    )
+    return keyboard
+
+
+def place_caption(num: int, place: Place) -> str:
+    """ Caption of the place in lists """
+    caption = f'#{num + 1} - {place.description}'
+    if place.distance is not None:
+        if place.distance < 1000:
+            caption += f' ({place.distance} m)'
+        else:
+            caption += f' ({place.distance / 1000:.1f} km)'
+    return caption
@@ -0,0 +1,369 @@
+"""
+Module of program which contains counters and histograms of the hot paths.
+They are kept in REGISTRY and served as Prometheus text:
+https://prometheus.io/docs/instrumenting/exposition_formats/
+An observation is a dict lookup, a bisect and a locked add, so they stay on in production.
+"""
+
+import inspect
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOGGER = logging.getLogger('metrics.py')
+
+# Upper bounds of histogram buckets in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer:
+    """ Context manager observing the time spent in its block """
+
+    __slots__ = ('_histogram', '_started')
+
+    def __init__(self, histogram) -> None:
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+class _CounterChild:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        """ Adding the amount """
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ('_lock', '_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: tuple) -> None:
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """ Counting the value in its bucket """
+        index = bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> _Timer:
+        """ Context manager observing the time spent in its block """
+        return _Timer(self)
+
+
+class _Metric(ABC):
+    """ Family of metric children, one per set of label values """
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _new_child(self):
+        """ Child of new label values """
+
+    def labels(self, *values):
+        """ Child of the label values, created on first use """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def children(self) -> list:
+        """ (label values, child) pairs """
+        with self._lock:
+            return list(self._children.items())
+
+
+class Counter(_Metric):
+    """ Monotonic counter """
+
+    kind = 'counter'
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        """ Adding the amount to the counter without labels """
+        self.labels().inc(amount)
+
+    def samples(self) -> list:
+        """ (sample name, value) pairs """
+        return [(self.name + _labels_text(self.label_names, values), child.value)
+                for values, child in self.children()]
+
+
+class Histogram(_Metric):
+    """ Histogram with cumulative buckets, a sum and a count """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        """ Observing the value of the histogram without labels """
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        """ Context manager observing the time of the histogram without labels """
+        return self.labels().time()
+
+    def samples(self) -> list:
+        """ (sample name, value) pairs """
+        result = []
+        for values, child in self.children():
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_number(bound)}"'
+                result.append((f'{self.name}_bucket' + _labels_text(self.label_names, values, le), cumulative))
+            labels = _labels_text(self.label_names, values)
+            result.append((f'{self.name}_sum{labels}', total))
+            result.append((f'{self.name}_count{labels}', count))
+        return result
+
+
+def flatten_stats(stats: dict, prefix: str = '') -> list:
+    """ (name, value) pairs of the numbers in the nested stats; names are joined by '_' """
+    result = []
+    for key, value in stats.items():
+        name = f'{prefix}_{key}' if prefix else str(key)
+        if isinstance(value, dict):
+            result.extend(flatten_stats(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            result.append((name, value))
+    return result
+
+
+class Registry:
+    """ Metrics of the process by name """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        """ Counter registered by name; the same object is returned for the same name """
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """ Histogram registered by name; the same object is returned for the same name """
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def samples(self) -> dict:
+        """ Values of all samples by name; worker processes report them to the supervisor """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {name: value for metric in metrics for name, value in metric.samples()}
+
+    def render(self, samples: dict = None, stats: dict = None, prefix: str = 'bot') -> str:
+        """
+        Prometheus text of the samples (the own ones by default)
+        and of the numbers in the stats as gauges.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        if samples is None:
+            families = [(metric, metric.samples()) for metric in metrics]
+        else:
+            # Samples are grouped by the names of their metrics.
+            names = {}
+            for metric in metrics:
+                suffixes = ('',) if metric.kind == 'counter' else ('_bucket', '_sum', '_count')
+                names.update((metric.name + suffix, metric.name) for suffix in suffixes)
+            grouped = {}
+            for name, value in samples.items():
+                metric_name = names.get(name.split('{', 1)[0])
+                if metric_name is not None:
+                    grouped.setdefault(metric_name, []).append((name, value))
+            families = [(metric, grouped.get(metric.name, [])) for metric in metrics]
+        lines = []
+        for metric, family in families:
+            if not family:
+                continue
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name} {_number(value)}' for name, value in family)
+        for name, value in flatten_stats(stats or {}, prefix):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """ Short text of the histograms: calls and mean time by labels """
+        with self._lock:
+            metrics = [metric for metric in self._metrics.values() if metric.kind == 'histogram']
+        lines = []
+        for metric in metrics:
+            for values, child in sorted(metric.children()):
+                if child.count:
+                    lines.append(f"{metric.name} {' '.join(map(str, values))}: "
+                                 f'{child.count} calls, {child.sum / child.count * 1000:.1f} ms avg')
+        return '\n'.join(lines)
+
+
+def stats_text(stats: dict, summary: str = '', max_size: int = 4000) -> str:
+    """ Text of the stats and of the histograms summary, cut to the size of a Telegram message """
+    lines = [f'{name}: {round(value, 4) if isinstance(value, float) else value}'
+             for name, value in flatten_stats(stats)]
+    text = '\n'.join(lines + ([summary] if summary else []))
+    return text if len(text) <= max_size else text[:max_size - 1] + '…'
+
+
+REGISTRY = Registry()
+
+DB_QUERY_SECONDS = REGISTRY.histogram('db_query_seconds', 'Time of database methods.', ('method',))
+HANDLER_SECONDS = REGISTRY.histogram('handler_seconds', 'Time of update handlers.', ('action',))
+HANDLER_ERRORS = REGISTRY.counter('handler_errors_total', 'Update handlers which raised.', ('action',))
+API_CALL_SECONDS = REGISTRY.histogram('api_call_seconds', 'Time of Telegram API calls.', ('method',))
+API_ERRORS = REGISTRY.counter('api_errors_total', 'Failed Telegram API calls.', ('method',))
+
+
+class InstrumentedDatabase:
+    """
+    Database backend whose public methods are timed by DB_QUERY_SECONDS; coroutines of an async backend
+    are timed until they return. Wrapped methods are kept on the instance, so __getattr__ is called once per name.
+    """
+
+    def __init__(self, db) -> None:
+        self._db = db
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._db, name)
+        # Generators are not timed: the time of their consumers would be counted.
+        if (name.startswith('_') or not callable(attr) or inspect.isgeneratorfunction(attr)
+                or inspect.isasyncgenfunction(attr)):
+            return attr
+        histogram = DB_QUERY_SECONDS.labels(name)
+
+        if inspect.iscoroutinefunction(attr):
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await attr(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+        else:
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+
+        timed.__name__ = name
+        timed.__doc__ = attr.__doc__
+        setattr(self, name, timed)
+        return timed
+
+
+class MetricsServer:
+    """ HTTP server of the metrics text at /metrics """
+
+    def __init__(self, render, host: str = '0.0.0.0', port: int = 9100) -> None:
+        LOGGER.info(msg=f'Metrics server initialisation. Address: {host}:{port}.')
+        self._render = render
+        self._server = ThreadingHTTPServer((host, port), self._request_handler_class())
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        """ Port the server listens on """
+        return self._server.server_address[1]
+
+    def _request_handler_class(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            """ Handler of metrics requests """
+
+            def do_GET(self) -> None:
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                try:
+                    body = server._render().encode()
+                except Exception as err:
+                    LOGGER.error(msg=f'Problem rendering metrics. Error: {err}')
+                    self.send_response(500)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                LOGGER.debug('%s - ' + format, self.address_string(), *args)
+
+        return RequestHandler
+
+    def start(self) -> None:
+        """ Serving requests in a background thread """
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """ Stopping the server """
+        self._server.shutdown()
+        self._server.server_close()
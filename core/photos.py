@@ -0,0 +1,170 @@
+"""
+Module of program which contains the pipeline of place photos.
+A photo is downloaded, resized and hashed in a thread pool while the user goes on adding the place.
+Photos are stored once per SHA-256 of their content, so an image of several places is kept once.
+Resizing needs Pillow; without it the chosen size is stored as Telegram sent it.
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LOGGER = logging.getLogger('photos.py')
+
+MAX_SIDE = 1280  # Telegram shows photos up to 1280 px on the longer side.
+QUALITY = 85
+# Photo bytes held by one batch of imported places.
+BATCH_PHOTO_BYTES = 8 * 1024 * 1024
+
+
+def choose_variant(sizes: list, max_side: int = MAX_SIDE):
+    """ The biggest of the Telegram photo sizes which fits into max_side, the smallest if none fits """
+    fitting = [size for size in sizes if max(size.width, size.height) <= max_side]
+    if fitting:
+        return max(fitting, key=lambda size: size.width * size.height)
+    return min(sizes, key=lambda size: size.width * size.height)
+
+
+def encode_photo(data: bytes, max_side: int = MAX_SIDE, quality: int = QUALITY) -> bytes:
+    """ JPEG of the photo shrunk into max_side; the original bytes if they are smaller or there is no Pillow """
+    if Image is None:
+        return data
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image.thumbnail((max_side, max_side))
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            buffer = BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True)
+    except Exception as err:
+        LOGGER.warning(msg=f'Problem encoding photo, it is kept as it is. Error: {err}')
+        return data
+    encoded = buffer.getvalue()
+    return encoded if len(encoded) < len(data) else data
+
+
+def photo_hash(data: bytes) -> str:
+    """ Hex SHA-256 of the photo bytes, the key of the photos table """
+    return hashlib.sha256(data).hexdigest()
+
+
+def prepare_photo(data: bytes, max_side: int = MAX_SIDE, quality: int = QUALITY) -> tuple:
+    """ (hash, bytes) of the photo as it is stored """
+    data = encode_photo(data, max_side, quality)
+    return photo_hash(data), data
+
+
+def photo_row(content: dict) -> tuple:
+    """ (hash, bytes) of the photo in the place content, None if the place has no photo """
+    data = content.get('photo')
+    if data is None:
+        return None
+    return content.get('photo_hash') or photo_hash(data), data
+
+
+def place_batches(places, batch_size: int, max_bytes: int = BATCH_PHOTO_BYTES):
+    """ Generator of lists of up to batch_size places; a batch ends earlier once its photos take max_bytes """
+    batch = []
+    size = 0
+    for content in places:
+        batch.append(content)
+        size += len(content.get('photo') or b'')
+        if len(batch) == batch_size or size >= max_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+class PhotoPipeline:
+    """
+    Thread pool which downloads and prepares photos by their Telegram file_id.
+    Results wait in memory until they are taken; the oldest are dropped over max_pending
+    and are processed again if they are asked for.
+    """
+
+    def __init__(self, download, workers: int = 2, max_side: int = MAX_SIDE, quality: int = QUALITY,
+                 max_pending: int = 1000, timeout: float = 60) -> None:
+        LOGGER.info(msg=f'Photo pipeline initialisation. Workers: {workers}, Pillow: {Image is not None}.')
+        if Image is None and quality != QUALITY:
+            LOGGER.warning(msg='Pillow is not installed, photos are not re-encoded and PHOTO_QUALITY is ignored.')
+        self.max_side = max_side
+        self._download = download
+        self._quality = quality
+        self._max_pending = max_pending
+        self._timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photos')
+        self._futures = OrderedDict()
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._failed = 0
+
+    def _process(self, file_id: str) -> tuple:
+        try:
+            result = prepare_photo(self._download(file_id), self.max_side, self._quality)
+        except Exception:
+            with self._lock:
+                self._failed += 1
+            raise
+        with self._lock:
+            self._processed += 1
+        return result
+
+    def submit(self, file_id: str) -> None:
+        """ Starting to process the photo in the background """
+        with self._lock:
+            if file_id in self._futures:
+                self._futures.move_to_end(file_id)
+                return
+            self._futures[file_id] = self._executor.submit(self._process, file_id)
+            while len(self._futures) > self._max_pending:
+                _, future = self._futures.popitem(last=False)
+                future.cancel()
+
+    def result(self, file_id: str) -> tuple:
+        """
+        (hash, bytes) of the photo, waiting only if it is still processed;
+        a photo which was not submitted is processed now. None on errors.
+        """
+        with self._lock:
+            future = self._futures.pop(file_id, None)
+        if future is None:
+            future = self._executor.submit(self._process, file_id)
+        try:
+            return future.result(self._timeout)
+        except FutureTimeoutError:
+            LOGGER.error(msg=f'Photo was not processed in {self._timeout} s. FileID: {file_id}.')
+        except Exception as err:
+            LOGGER.error(msg=f'Problem processing photo. FileID: {file_id}. Error: {err}')
+        return None
+
+    def discard(self, file_id: str) -> None:
+        """ Forgetting the photo of a cancelled place """
+        with self._lock:
+            future = self._futures.pop(file_id, None)
+        if future is not None:
+            future.cancel()
+
+    def stats(self) -> dict:
+        """ Counters of processed photos """
+        with self._lock:
+            return {
+                'pending': sum(not future.done() for future in self._futures.values()),
+                'ready': sum(future.done() for future in self._futures.values()),
+                'processed': self._processed,
+                'failed': self._failed,
+            }
+
+    def close(self) -> None:
+        """ Waiting for the photos in progress """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,22 @@
+"""
+Module of program which contains the type of places read from the databases.
+A place is a named tuple: rows are decoded into it without a dict per row.
+"""
+
+from datetime import datetime
+from typing import NamedTuple
+
+
+class Place(NamedTuple):
+    """ Place of a user; the first six fields are the columns of a place row """
+
+    id: int
+    lat: float
+    long: float
+    description: str
+    has_photo: bool = False
+    photo_file_id: str = None
+    # Meters from the searched location, only in results of nearest places.
+    distance: int = None
+    # Only in streamed places.
+    created_at: datetime = None
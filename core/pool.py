@@ -0,0 +1,185 @@
+"""
+Module of program which contains a thread-safe pool of PostgreSQL connections.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+LOGGER = logging.getLogger('pool.py')
+
+
+class PoolTimeoutError(Exception):
+    """ Raised when no connection becomes free within the checkout timeout """
+
+
+class ConnectionPool:
+    """ Pool of PostgreSQL connections shared between handler threads """
+
+    def __init__(self, db_url: str, min_conn: int = 1, max_conn: int = 10,
+                 timeout: float = 10.0, on_connect=None, probe_after: float = 30.0,
+                 connect=psycopg2.connect, **connect_kwargs) -> None:
+        LOGGER.info(msg=f'Connection pool initialisation. Min: {min_conn}, max: {max_conn}.')
+        self._db_url = db_url
+        self._min_conn = min_conn
+        self._max_conn = max(min_conn, max_conn)
+        self._timeout = timeout
+        # Connections idle longer than that are probed by the server before they are given out.
+        self._probe_after = probe_after
+        self._connect_func = connect
+        self._connect_kwargs = connect_kwargs
+        # Called with every new connection, e.g. to prepare statements.
+        self._on_connect = on_connect
+        self._cond = threading.Condition()
+        # (connection, time it was returned), the most recently returned last.
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        # Counters for sizing the pool.
+        self._checkouts = 0
+        self._timeouts = 0
+        self._broken = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        for _ in range(self._min_conn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        conn = self._connect_func(self._db_url, **self._connect_kwargs)
+        if self._on_connect is not None:
+            try:
+                self._on_connect(conn)
+                conn.commit()
+            except Exception:
+                self._discard(conn)
+                raise
+        return conn
+
+    def _is_healthy(self, conn, idle_time: float) -> bool:
+        """
+        Checking that the connection is still usable before giving it out.
+        The server is asked only if the connection has been idle longer than probe_after;
+        a connection lost meanwhile is closed by psycopg2 on its first error and is not returned to the pool.
+        """
+        if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if idle_time < self._probe_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('select 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """ Taking a connection from the pool, waiting up to the checkout timeout """
+        started = time.monotonic()
+        deadline = started + self._timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError('The connection pool is closed.')
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self._max_conn:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(
+                        f'No free DB connection within {self._timeout} seconds.'
+                    )
+                self._cond.wait(remaining)
+            waited = time.monotonic() - started
+            self._checkouts += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+
+        try:
+            if conn is not None and not self._is_healthy(conn, time.monotonic() - returned_at):
+                LOGGER.warning(msg='Broken DB connection has been found in the pool. Reconnecting.')
+                self._broken += 1
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn) -> None:
+        """ Returning a connection to the pool """
+        with self._cond:
+            if self._closed or conn.closed:
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """ Context manager which commits on success and rolls back on error """
+        conn = self.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.putconn(conn)
+
+    @contextmanager
+    def cursor(self):
+        """ Context manager which gives a per-call cursor on a pooled connection """
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
+
+    def stats(self) -> dict:
+        """ Pool wait-time and utilisation counters """
+        with self._cond:
+            in_use = self._size - len(self._idle)
+            return {
+                'size': self._size,
+                'max_size': self._max_conn,
+                'in_use': in_use,
+                'idle': len(self._idle),
+                'utilisation': in_use / self._max_conn,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'broken': self._broken,
+                'wait_time_total': self._wait_time,
+                'wait_time_avg': self._wait_time / self._checkouts if self._checkouts else 0.0,
+                'wait_time_max': self._max_wait_time,
+            }
+
+    def close(self) -> None:
+        """ Closing all idle connections; busy ones are closed when returned """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+                self._size -= 1
+            self._cond.notify_all()
@@ -0,0 +1,123 @@
+"""
+Module of program which contains on-demand profilers of the running bot.
+SamplingProfiler takes stacks of all threads from sys._current_frames() and counts
+them as collapsed stacks (flamegraph.pl and speedscope read them).
+MemoryTracer compares tracemalloc snapshots to find memory growth.
+Nothing runs until a profiler is started, so there is no cost when they are off.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+LOGGER = logging.getLogger('profiling.py')
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class SamplingProfiler:
+    """ Sampling profiler of all threads of the process """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        """ True while the profiler is sampling """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float, callback=None) -> bool:
+        """
+        Sampling for `duration` seconds or until stop(); then callback(collapsed stacks) is called.
+        Returns False if the profiler is already running.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks = Counter()
+            self._samples = 0
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._sample, args=(duration, callback),
+                                            name='profiler', daemon=True)
+            self._thread.start()
+        LOGGER.info(msg=f'Sampling profiler started for {duration} s.')
+        return True
+
+    def stop(self) -> str:
+        """ Stopping the sampling; the collapsed stacks are returned """
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        return self.collapsed()
+
+    def _sample(self, duration: float, callback) -> None:
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stopped.wait(self._interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self._samples += 1
+        LOGGER.info(msg=f'Sampling profiler stopped. Samples: {self._samples}.')
+        if callback is not None:
+            try:
+                callback(self.collapsed())
+            except Exception as err:
+                LOGGER.error(msg=f'Problem passing the profile. Error: {err}')
+
+    def collapsed(self) -> str:
+        """ Collapsed stacks 'thread;frame;...;frame count', the most frequent first """
+        return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+
+class MemoryTracer:
+    """ Tracer of memory growth between a baseline snapshot and now """
+
+    def __init__(self, frames: int = 10) -> None:
+        self._frames = frames
+        self._baseline = None
+
+    @property
+    def running(self) -> bool:
+        """ True while allocations are traced """
+        return self._baseline is not None
+
+    def start(self) -> None:
+        """ Tracing allocations and taking the baseline snapshot """
+        tracemalloc.start(self._frames)
+        self._baseline = tracemalloc.take_snapshot()
+        LOGGER.info(msg='Memory tracing started.')
+
+    def stop(self, limit: int = 30) -> str:
+        """ Stopping the tracing; the biggest growths since the baseline are returned """
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        filters = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        stats = snapshot.filter_traces(filters).compare_to(self._baseline.filter_traces(filters), 'traceback')
+        self._baseline = None
+        LOGGER.info(msg='Memory tracing stopped.')
+        lines = []
+        for stat in stats[:limit]:
+            lines.append(f'{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} blocks, '
+                         f'{stat.size / 1024:.1f} KiB now')
+            lines.extend(f'    {line}' for line in stat.traceback.format(most_recent_first=True))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,130 @@
+"""
+Module of program which contains the routing of incoming updates to bot actions.
+The threaded and the asyncio bots share it, so both follow the same logic.
+An action is the name of a bot method without the leading underscore.
+"""
+
+MAIN_MENU_TEXT = 'What do you want to do?'
+PLACE_MENU_TEXT = 'Please, choose action.'
+ADMIN_MENU_TEXT = 'Admin action.'
+# Search results end with 'Search: <words>\nPage: <number>', which keeps the state of the search.
+SEARCH_TEXT_PREFIX = 'Search: '
+SEARCH_PAGE_SIZE = 10
+MORE_PLACES_TEXT = 'Show older places?'
+PLACES_PAGE_SIZE = 10
+
+# Menu text -> callback data -> action.
+CALLBACK_ROUTES = {
+    MAIN_MENU_TEXT: {
+        'add_place': 'add_new_place_start',
+        'get_places': 'list_last_places',
+        'get_places_location': 'ask_location',
+        'delete_places': 'delete_users_data',
+        'help': 'help_massage',
+    },
+    PLACE_MENU_TEXT: {
+        'location': 'ask_place_location',
+        'description': 'ask_place_description',
+        'photo': 'ask_place_photo',
+        'save': 'add_new_place_save',
+        'cancel': 'add_new_place_cancel',
+    },
+    # The data of 'next_page' carries the id of the last shown place: 'next_page:<id>'.
+    MORE_PLACES_TEXT: {
+        'next_page': 'list_older_places',
+        'menu': 'main_menu',
+    },
+    ADMIN_MENU_TEXT: {
+        'logs': 'admin_get_logs',
+        'stats': 'admin_stats',
+        'profile': 'admin_profile',
+        'memory': 'admin_memory',
+        'exit': 'admin_exit',
+    },
+}
+
+# Callback data of the search results menu -> action.
+SEARCH_ROUTES = {
+    'next_page': 'search_next_page',
+    'menu': 'main_menu',
+}
+
+# Commands -> action.
+COMMAND_ROUTES = {
+    'start': 'create_new_user',
+    'admin': 'call_admin_menu',
+    'search': 'search_places',
+    'export': 'export_places',
+}
+
+# Content types of messages sent while adding a place -> action.
+SESSION_ROUTES = {
+    'location': 'add_new_place_location',
+    'text': 'add_new_place_description',
+    'photo': 'add_new_place_photo',
+}
+
+
+def get_command(text: str) -> str:
+    """ Getting the command name from '/command@bot_name arguments' text """
+    if not text or not text.startswith('/'):
+        return None
+    return text.split()[0][1:].split('@')[0]
+
+
+def split_callback_data(data: str) -> tuple:
+    """ Splitting 'name:argument' callback data; the argument is None if there is no one """
+    name, _, argument = (data or '').partition(':')
+    return name, argument or None
+
+
+def get_command_argument(text: str) -> str:
+    """ Getting the arguments from '/command arguments' text """
+    parts = text.split(maxsplit=1) if text else []
+    return parts[1].strip() if len(parts) > 1 else ''
+
+
+def search_text(words: str, page: int) -> str:
+    """ Text of the search results menu """
+    return f'{SEARCH_TEXT_PREFIX}{words}\nPage: {page}'
+
+
+def parse_search_text(text: str) -> tuple:
+    """ Getting (words, page) back from the text of the search results menu """
+    words, _, page = text[len(SEARCH_TEXT_PREFIX):].rpartition('\nPage: ')
+    return words, int(page)
+
+
+def route_callback(question: str, answer: str, has_session) -> str:
+    """
+    Getting the action for the answer on the menu.
+    `has_session` is called only if the answer needs a place in progress.
+    """
+    if question and question.startswith(SEARCH_TEXT_PREFIX):
+        return SEARCH_ROUTES.get(answer, 'main_menu')
+    if question not in CALLBACK_ROUTES:
+        return 'main_menu'
+    if question == PLACE_MENU_TEXT and not has_session():
+        return None
+    return CALLBACK_ROUTES[question].get(answer)
+
+
+def route_message(content_type: str, text: str, has_session, is_admin) -> str:
+    """
+    Getting the action for the message.
+    `has_session` and `is_admin` are called only when it matters.
+    """
+    command = get_command(text) if content_type == 'text' else None
+    if command in COMMAND_ROUTES:
+        return COMMAND_ROUTES[command]
+    if content_type in SESSION_ROUTES and has_session():
+        return SESSION_ROUTES[content_type]
+    if content_type == 'document':
+        return 'import_places'
+    if content_type == 'text' and is_admin():
+        return 'check_admin_pin'
+    if content_type == 'location':
+        return 'location_received'
+    if content_type == 'text':
+        return 'main_menu'
+    return None
@@ -0,0 +1,216 @@
+"""
+Module of program which contains the outbound queue of Telegram API calls.
+Calls are sent by worker threads within the global and per-chat rate limits,
+in the order they were queued for every chat.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from functools import partial
+
+import telebot as tb
+
+from core.metrics import API_CALL_SECONDS, API_ERRORS
+
+LOGGER = logging.getLogger('sender.py')
+
+
+def get_retry_after(err) -> float:
+    """ Getting 'retry_after' from the 'Too Many Requests' answer of the API """
+    try:
+        if err.result.status_code == 429:
+            return float(err.result.json().get('parameters', {}).get('retry_after', 1))
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+
+class TokenBucket:
+    """ Token bucket rate limiter """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """ Taking a token; returns how many seconds to wait before using it """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0.0
+            return max(delay, self._paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        """ Holding all tokens back, e.g. after 'Too Many Requests' from the API """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def is_full(self) -> bool:
+        """ True if the bucket has been idle long enough to be forgotten """
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens >= self._capacity
+
+
+class Sender:
+    """ Queue of outbound Telegram API calls """
+
+    def __init__(self, bot, workers: int = 4, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 3, max_retries: int = 3) -> None:
+        LOGGER.info(msg=f'Sender initialisation. Workers: {workers}.')
+        self._bot = bot
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._pending = {}
+        self._ready = []
+        self._busy = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        # Counters for the stats.
+        self._depth = 0
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._workers = [
+            threading.Thread(target=self._work, name=f'sender-{num}', daemon=True)
+            for num in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _schedule(self, chat_id: int) -> None:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        heapq.heappush(self._ready, (time.monotonic() + bucket.reserve(), next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _forget_idle_chats(self) -> None:
+        if len(self._chat_buckets) > 10_000:
+            for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                            if chat_id not in self._pending and bucket.is_full()]:
+                del self._chat_buckets[chat_id]
+
+    def submit(self, chat_id: int, func, *args, **kwargs) -> None:
+        """ Queueing a call; calls of one chat are made in the order they were queued """
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('The sender is closed.')
+            queue = self._pending.setdefault(chat_id, deque())
+            queue.append((time.monotonic(), 0, func, args, kwargs))
+            self._depth += 1
+            if len(queue) == 1 and chat_id not in self._busy:
+                self._schedule(chat_id)
+
+    def send_message(self, chat_id: int, **kwargs) -> None:
+        """ Queueing send_message """
+        self.submit(chat_id, partial(self._bot.send_message, chat_id=chat_id, **kwargs))
+
+    def send_venue(self, chat_id: int, **kwargs) -> None:
+        """ Queueing send_venue """
+        self.submit(chat_id, partial(self._bot.send_venue, chat_id=chat_id, **kwargs))
+
+    def _next_item(self):
+        with self._cond:
+            while True:
+                if self._stopped and not self._depth:
+                    return None, None
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    self._busy.add(chat_id)
+                    return chat_id, self._pending[chat_id].popleft()
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _call(self, chat_id: int, func, args, kwargs, attempt: int):
+        """ True if the call is made, False if it failed, the delay asked by the API if it must be retried """
+        method = getattr(func, 'func', func).__name__.lstrip('_')
+        time.sleep(self._global_bucket.reserve())
+        try:
+            with API_CALL_SECONDS.labels(method).time():
+                func(*args, **kwargs)
+            return True
+        except tb.apihelper.ApiException as err:
+            API_ERRORS.labels(method).inc()
+            retry_after = get_retry_after(err)
+            if retry_after is None or attempt == self._max_retries:
+                LOGGER.error(msg=f'UserID: {chat_id}. API Exception: {err}')
+                return False
+            LOGGER.warning(msg=f'UserID: {chat_id}. Too Many Requests, retry after {retry_after} s.')
+            return retry_after
+        except Exception as err:
+            API_ERRORS.labels(method).inc()
+            LOGGER.error(msg=f'UserID: {chat_id}. Problem sending to Telegram. Error: {err}')
+            return False
+
+    def _work(self) -> None:
+        while True:
+            chat_id, item = self._next_item()
+            if item is None:
+                return
+            queued_at, attempt, func, args, kwargs = item
+            result = self._call(chat_id, func, args, kwargs, attempt)
+            with self._cond:
+                self._busy.discard(chat_id)
+                if not isinstance(result, bool):
+                    # 'Too Many Requests' limits the chat: only it waits, first with the same call.
+                    self._retries += 1
+                    self._chat_buckets[chat_id].pause(result)
+                    self._pending[chat_id].appendleft((queued_at, attempt + 1, func, args, kwargs))
+                    self._schedule(chat_id)
+                    continue
+                latency = time.monotonic() - queued_at
+                self._depth -= 1
+                if result:
+                    self._sent += 1
+                else:
+                    self._failed += 1
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+                if self._pending[chat_id]:
+                    self._schedule(chat_id)
+                else:
+                    del self._pending[chat_id]
+                    self._forget_idle_chats()
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """ Queue depth and send latency counters """
+        with self._cond:
+            done = self._sent + self._failed
+            return {
+                'queue_depth': self._depth,
+                'chats_pending': len(self._pending),
+                'sent': self._sent,
+                'failed': self._failed,
+                'retries': self._retries,
+                'latency_avg': self._latency_total / done if done else 0.0,
+                'latency_max': self._latency_max,
+            }
+
+    def close(self, timeout: float = 10.0) -> None:
+        """ Sending the queued calls and stopping the workers """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
@@ -0,0 +1,129 @@
+"""
+Module of program which contains stores of user sessions.
+A session keeps the content of a place while the user is adding it.
+"""
+
+import base64
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+LOGGER = logging.getLogger('session.py')
+
+
+class SessionStore(ABC):
+    """ Interface of session stores """
+
+    @abstractmethod
+    def get(self, user_id: int) -> dict:
+        """ Getting the session content, None if there is no session """
+
+    @abstractmethod
+    def set(self, user_id: int, content: dict) -> None:
+        """ Saving the session content """
+
+    @abstractmethod
+    def delete(self, user_id: int) -> None:
+        """ Deleting the session """
+
+    def __contains__(self, user_id: int) -> bool:
+        """ Checking that the user has a session; stores override it to check without prolonging the session """
+        return self.get(user_id) is not None
+
+
+class MemorySessionStore(SessionStore):
+    """ Session store in process memory with TTL and LRU eviction """
+
+    def __init__(self, ttl: float = 3600, max_size: int = 10_000) -> None:
+        self._ttl = ttl
+        self._max_size = max_size
+        # The oldest touched sessions are first, so they also expire first.
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float) -> None:
+        while self._sessions:
+            user_id, (expires_at, _) = next(iter(self._sessions.items()))
+            if expires_at > now and len(self._sessions) <= self._max_size:
+                break
+            del self._sessions[user_id]
+            LOGGER.debug('UserID: %s - session evicted.', user_id)
+
+    def get(self, user_id: int) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            session = self._sessions.get(user_id)
+            if session is None:
+                return None
+            # Reading a session also prolongs it.
+            self._sessions[user_id] = (now + self._ttl, session[1])
+            self._sessions.move_to_end(user_id)
+            return session[1]
+
+    def set(self, user_id: int, content: dict) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._sessions[user_id] = (now + self._ttl, content)
+            self._sessions.move_to_end(user_id)
+            self._evict(now)
+
+    def delete(self, user_id: int) -> None:
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def __contains__(self, user_id: int) -> bool:
+        # Routing only checks the session, so it is neither prolonged nor moved in the LRU order.
+        with self._lock:
+            session = self._sessions.get(user_id)
+            return session is not None and session[0] > time.monotonic()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._evict(time.monotonic())
+            return len(self._sessions)
+
+
+def encode_content(content: dict) -> str:
+    """ Serializing session content to JSON; bytes are kept as base64 """
+    return json.dumps({
+        key: {'base64': base64.b64encode(value).decode()} if isinstance(value, bytes) else value
+        for key, value in content.items()
+    })
+
+
+def decode_content(data: str) -> dict:
+    """ Deserializing session content from JSON """
+    return {
+        key: base64.b64decode(value['base64']) if isinstance(value, dict) and 'base64' in value else value
+        for key, value in json.loads(data).items()
+    }
+
+
+class DatabaseSessionStore(SessionStore):
+    """ Session store in the database, shared by all bot processes """
+
+    def __init__(self, db, ttl: float = 3600) -> None:
+        self._db = db
+        self._ttl = ttl
+        self._purged_at = time.monotonic()
+
+    def get(self, user_id: int) -> dict:
+        data = self._db.get_session(user_id=user_id, ttl=self._ttl)
+        return None if data is None else decode_content(data)
+
+    def set(self, user_id: int, content: dict) -> None:
+        self._db.save_session(user_id=user_id, content=encode_content(content))
+        if time.monotonic() - self._purged_at > self._ttl / 10:
+            self._purged_at = time.monotonic()
+            self._db.delete_expired_sessions(ttl=self._ttl)
+
+    def delete(self, user_id: int) -> None:
+        self._db.delete_session(user_id=user_id)
+
+    def __contains__(self, user_id: int) -> bool:
+        # The content is not read nor decoded when routing only checks the session.
+        return self._db.has_session(user_id=user_id, ttl=self._ttl)
@@ -0,0 +1,492 @@
+"""
+Module of program which contains class to work with SQLite Database.
+It has the same methods as core.database.Database and needs no server,
+so it is used on single-node deployments, in tests and in load tests.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import core.locationcalc as loc
+from core import geodesy
+from core.photos import photo_hash, photo_row, place_batches
+from core.place import Place
+
+LOGGER = logging.getLogger('sqlitedb.py')
+
+# Statements which create the tables, executed on start in order.
+SQLITE_SCHEMA = (
+    """
+    create table if not exists users (
+        user_id integer not null primary key,
+        created_at timestamp default current_timestamp
+    )
+    """,
+    # Photos are stored once by the hex SHA-256 of their bytes; places refer to them.
+    """
+    create table if not exists photos (
+        hash text not null primary key,
+        data blob not null,
+        created_at timestamp default current_timestamp
+    )
+    """,
+    """
+    create table if not exists places (
+        id integer primary key,
+        user_id integer not null references users(user_id),
+        lat real not null,
+        long real not null,
+        cell integer,
+        place_description text,
+        photo blob,
+        photo_file_id text,
+        photo_hash text references photos(hash),
+        created_at timestamp default (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+    )
+    """,
+    'create index if not exists idx_places_keyset on places(user_id, created_at, id)',
+    'drop index if exists idx_places',
+    'create index if not exists idx_places_photo on places(photo_hash)',
+    # R*Tree spatial index of places, kept in sync by the triggers.
+    'create virtual table if not exists places_rtree using rtree(id, min_lat, max_lat, min_long, max_long)',
+    """
+    create trigger if not exists places_rtree_insert after insert on places begin
+        insert into places_rtree values (new.id, new.lat, new.lat, new.long, new.long);
+    end
+    """,
+    """
+    create trigger if not exists places_rtree_delete after delete on places begin
+        delete from places_rtree where id = old.id;
+    end
+    """,
+    # Full-text index of descriptions, kept in sync by the triggers.
+    """
+    create virtual table if not exists places_fts using fts5(
+        place_description, content='places', content_rowid='id', prefix='2 3'
+    )
+    """,
+    """
+    create trigger if not exists places_fts_insert after insert on places begin
+        insert into places_fts (rowid, place_description) values (new.id, new.place_description);
+    end
+    """,
+    """
+    create trigger if not exists places_fts_delete after delete on places begin
+        insert into places_fts (places_fts, rowid, place_description)
+            values ('delete', old.id, old.place_description);
+    end
+    """,
+    """
+    create trigger if not exists places_fts_update after update of place_description on places begin
+        insert into places_fts (places_fts, rowid, place_description)
+            values ('delete', old.id, old.place_description);
+        insert into places_fts (rowid, place_description) values (new.id, new.place_description);
+    end
+    """,
+    """
+    create table if not exists sessions (
+        user_id integer not null primary key,
+        content text not null,
+        updated_at real not null
+    )
+    """,
+)
+
+PLACE_COLUMNS = ('places.id, places.lat, places.long, places.place_description, places.photo_hash is not null,'
+                 ' places.photo_file_id')
+
+# Places in the bounding area, found by the R*Tree. Its boxes are rounded outward
+# to 32-bit floats, so the exact bounds are checked on the places table too.
+# An area which crosses the antimeridian is two boxes; otherwise the second one is empty.
+NEAR_PLACES_FROM = """
+    from places
+    where places.id in (
+            select id from places_rtree
+                where min_lat <= :max_lat and max_lat >= :min_lat
+                    and min_long <= :max_long and max_long >= :min_long
+            union all
+            select id from places_rtree
+                where min_lat <= :max_lat and max_lat >= :min_lat
+                    and min_long <= :max_long_2 and max_long >= :min_long_2
+        )
+        and places.user_id = :id
+        and (lat between :min_lat and :max_lat)
+        and (long between :min_long and :max_long or long between :min_long_2 and :max_long_2)
+    """
+
+NEAR_PLACES_SQL = f'select {PLACE_COLUMNS} {NEAR_PLACES_FROM}'
+
+# Places of the area within the radius, closest first; distance() is registered on every connection.
+NEAREST_PLACES_SQL = f"""
+    select * from (
+        select {PLACE_COLUMNS}, distance(:lat, :long, places.lat, places.long) as distance
+        {NEAR_PLACES_FROM}
+    )
+    where distance <= :radius
+    order by distance
+    limit :limit
+    """
+
+
+INSERT_PLACE_SQL = """
+    insert into places
+    (user_id, lat, long, cell, place_description, photo_hash, photo_file_id)
+    values
+    (?, ?, ?, ?, ?, ?, ?)
+    """
+
+INSERT_PHOTO_SQL = 'insert into photos (hash, data) values (?, ?) on conflict do nothing'
+
+
+def get_search_query(text: str) -> str:
+    """ FTS5 query matching places with all words of the text, also as prefixes; '' if there are no words """
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text.lower()))
+
+
+def _place_from_row(row: tuple) -> Place:
+    # SQLite has no booleans: has_photo comes as 0 or 1.
+    return Place(row[0], row[1], row[2], row[3], bool(row[4]), *row[5:])
+
+
+def _area_params(user_id: int, area: tuple) -> dict:
+    boxes = loc.split_area(area)
+    # An empty range matches nothing.
+    _, min_long_2, _, max_long_2 = boxes[1] if len(boxes) > 1 else (None, 1.0, None, 0.0)
+    return {'id': user_id, 'min_lat': area[0], 'min_long': boxes[0][1], 'max_lat': area[2], 'max_long': boxes[0][3],
+            'min_long_2': min_long_2, 'max_long_2': max_long_2}
+
+
+class SqliteDatabase:
+    """ class to work with SQLite Database """
+
+    def __init__(self, path: str, timeout: float = 10.0, create_schema: bool = True) -> None:
+        LOGGER.info(msg=f'SqliteDatabase class initialisation. Path: {path}.')
+        self._path = path
+        self._timeout = timeout
+        # Connections are not shared between threads: every thread opens its own one.
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        if create_schema:
+            self._create_schema()
+
+    def _create_schema(self) -> None:
+        """ Creating the tables and indexes, with the migrations of older files """
+        try:
+            with self._connection() as conn:
+                has_fts = conn.execute("select 1 from sqlite_master where name = 'places_fts'").fetchone()
+                columns = {row[1] for row in conn.execute('pragma table_info(places)')}
+                move_photos = columns and 'photo_hash' not in columns
+                if move_photos:
+                    conn.execute('alter table places add column photo_hash text references photos(hash)')
+                for statement in SQLITE_SCHEMA:
+                    conn.execute(statement)
+                if not has_fts:
+                    # Indexing places which were saved before the full-text index existed.
+                    conn.execute("insert into places_fts (places_fts) values ('rebuild')")
+                if move_photos:
+                    # Photos are moved once, when the column is added, not scanned for on every start.
+                    self._move_photos(conn)
+                if conn.execute('pragma user_version').fetchone()[0] < 1:
+                    # Descriptions were saved in quotes before.
+                    conn.execute("""
+                        update places
+                            set place_description = substr(place_description, 2, length(place_description) - 2)
+                            where length(place_description) >= 2 and place_description like '''%'''
+                    """)
+                    conn.execute('pragma user_version = 1')
+            LOGGER.info(msg='The tables have been created.')
+        except Exception as err:
+            LOGGER.error(msg=f'Problem connecting to database. Error: {err}')
+
+    @staticmethod
+    def _move_photos(conn: sqlite3.Connection) -> None:
+        """ Moving photos which were saved in places to the photos table """
+        for place_id, data in conn.execute('select id, photo from places where photo is not null').fetchall():
+            data_hash = photo_hash(data)
+            conn.execute(INSERT_PHOTO_SQL, (data_hash, data))
+            conn.execute('update places set photo_hash = ?, photo = null where id = ?', (data_hash, place_id))
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Connection of the current thread; used as a context manager it commits or rolls back """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=self._timeout, check_same_thread=False)
+            conn.execute('pragma journal_mode = wal')
+            conn.execute('pragma synchronous = normal')
+            conn.execute('pragma foreign_keys = on')
+            conn.create_function('distance', 4, loc.get_distance, deterministic=True)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def create_user(self, user_id: int) -> None:
+        """ Creating new user in DB """
+        LOGGER.debug('Creating user. UserID: %s.', user_id)
+        try:
+            with self._connection() as conn:
+                conn.execute('insert into users (user_id) values (?) on conflict (user_id) do nothing', (user_id,))
+            LOGGER.debug('UserID: %s has bean created.', user_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem creating user. UserID: {user_id}. Error: {err}')
+
+    def get_last_places(self, user_id: int, limit: int = 10, before_id: int = None) -> list:
+        """ Getting last places; the next page starts before the place with `before_id` """
+        LOGGER.debug('Getting last places. UserID: %s, before: %s.', user_id, before_id)
+        try:
+            rows = self._connection().execute(
+                f"""
+                select {PLACE_COLUMNS}
+                    from places
+                    where user_id = :id
+                        {'and (created_at, id) < (select created_at, id from places where id = :before_id)'
+                         if before_id is not None else ''}
+                    order by created_at desc, id desc
+                    limit :limit
+                """,
+                {'id': user_id, 'before_id': before_id, 'limit': limit}
+            ).fetchall()
+            LOGGER.debug('Getting last places. UserID: %s - Success.', user_id)
+            return [_place_from_row(row) for row in rows]
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting last places. UserID: {user_id}. Error: {err}')
+
+    def iter_places(self, user_id: int, chunk_size: int = 1000):
+        """ Generator of all places of the user, oldest first, with created_at; rows are read in chunks """
+        LOGGER.debug('Streaming places. UserID: %s.', user_id)
+        try:
+            cursor = self._connection().execute(
+                f'select {PLACE_COLUMNS}, null, created_at from places where user_id = ? order by created_at, id',
+                (user_id,)
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield _place_from_row(row)
+            LOGGER.debug('Streaming places. UserID: %s - Success.', user_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem streaming places. UserID: {user_id}. Error: {err}')
+            raise
+
+    def delete_places(self, user_id: int) -> None:
+        """ Deleting all places of user and their photos which no other place has """
+        LOGGER.debug('Deleting all places of user. UserID: %s.', user_id)
+        try:
+            with self._connection() as conn:
+                hashes = [row[0] for row in conn.execute(
+                    'select distinct photo_hash from places where user_id = ? and photo_hash is not null', (user_id,)
+                )]
+                conn.execute('delete from places where user_id = ?', (user_id,))
+                conn.executemany(
+                    'delete from photos where hash = ? and not exists (select 1 from places where photo_hash = ?)',
+                    [(data_hash, data_hash) for data_hash in hashes]
+                )
+            LOGGER.debug('All places of UserID: %s have bean deleted.', user_id)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem with deleting user\'s places. UserID: {user_id}. Error: {err}')
+
+    def get_near_places(self, user_id: int, area: tuple) -> list:
+        """ Getting all places near location (places which wre located into some area) """
+        LOGGER.debug('Getting places near location. UserID: %s.', user_id)
+        try:
+            rows = self._connection().execute(
+                NEAR_PLACES_SQL + ' order by created_at desc, places.id desc limit 10',
+                _area_params(user_id, area)
+            ).fetchall()
+            LOGGER.debug('Getting places near location. UserID: %s - Success.', user_id)
+            return [_place_from_row(row) for row in rows]
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting places near location. UserID: {user_id}. Error: {err}')
+
+    def get_nearest_places(self, user_id: int, lat: float, long: float, limit: int = 10,
+                           radii: tuple = loc.NEAR_RADII) -> list:
+        """
+        Getting up to `limit` places closest to the location, ordered by distance.
+        The search ring grows until enough places are found.
+        """
+        LOGGER.debug('Getting nearest places. UserID: %s.', user_id)
+        try:
+            rows = []
+            conn = self._connection()
+            for radius, area in zip(radii, geodesy.search_areas(lat, long, radii)):
+                params = dict(_area_params(user_id, area), lat=float(lat), long=float(long), radius=radius, limit=limit)
+                rows = conn.execute(NEAREST_PLACES_SQL, params).fetchall()
+                if len(rows) >= limit:
+                    break
+            LOGGER.debug('Getting nearest places. UserID: %s - Success.', user_id)
+            return [_place_from_row(row[:6] + (round(row[6]),)) for row in rows]
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting nearest places. UserID: {user_id}. Error: {err}')
+
+    @staticmethod
+    def _place_row(user_id: int, content: dict, photo_hash: str = None) -> tuple:
+        return (user_id, float(content['lat']), float(content['long']),
+                loc.get_cell_id(content['lat'], content['long']), content['description'],
+                photo_hash, content.get('photo_file_id'))
+
+    def _insert_places(self, conn: sqlite3.Connection, user_id: int, places: list) -> None:
+        """ Inserting the places and their photos """
+        photos, rows = {}, []
+        for content in places:
+            photo = photo_row(content)
+            if photo is not None:
+                photos[photo[0]] = photo[1]
+            rows.append(self._place_row(user_id, content, photo[0] if photo else None))
+        conn.executemany(INSERT_PHOTO_SQL, photos.items())
+        conn.executemany(INSERT_PLACE_SQL, rows)
+
+    def create_new_place(self, user_id: int, content: dict, callback=None) -> None:
+        """ Creating a new place in DB; callback(saved: bool) is called after the commit """
+        LOGGER.debug('Creating new place. UserID: %s.', user_id)
+        try:
+            with self._connection() as conn:
+                self._insert_places(conn, user_id, [content])
+            LOGGER.debug('Creating new place. UserID: %s - Success.', user_id)
+            saved = True
+        except Exception as err:
+            LOGGER.error(msg=f'Problem creating new place. UserID: {user_id}. Error: {err}')
+            saved = False
+        if callback is not None:
+            callback(saved)
+
+    def import_places(self, user_id: int, places, batch_size: int = 1000) -> int:
+        """
+        Inserting places from the iterable in batches, smaller ones when they hold photos.
+        All batches are one transaction; the number of places is returned, None on errors.
+        """
+        LOGGER.debug('Importing places. UserID: %s.', user_id)
+        count = 0
+        try:
+            with self._connection() as conn:
+                for batch in place_batches(places, batch_size):
+                    self._insert_places(conn, user_id, batch)
+                    count += len(batch)
+            LOGGER.debug('Importing places. UserID: %s - Success.', user_id)
+            return count
+        except Exception as err:
+            LOGGER.error(msg=f'Problem importing places. UserID: {user_id}. Error: {err}')
+
+    def search_places(self, user_id: int, text: str, limit: int = 10, offset: int = 0) -> list:
+        """ Getting places whose description has the words of the text, best matches first """
+        LOGGER.debug('Searching places. UserID: %s.', user_id)
+        query = get_search_query(text)
+        if not query:
+            return []
+        try:
+            rows = self._connection().execute(
+                f"""
+                select {PLACE_COLUMNS}
+                    from places_fts
+                    join places on places.id = places_fts.rowid
+                    where places_fts match ? and places.user_id = ?
+                    order by places_fts.rank, places.created_at desc, places.id desc
+                    limit ?
+                    offset ?
+                """,
+                (query, user_id, limit, offset)
+            ).fetchall()
+            LOGGER.debug('Searching places. UserID: %s - Success.', user_id)
+            return [_place_from_row(row) for row in rows]
+        except Exception as err:
+            LOGGER.error(msg=f'Problem searching places. UserID: {user_id}. Error: {err}')
+
+    def get_place_photo(self, place_id: int) -> bytes:
+        """ Getting photo bytes of the place, only when they have to be uploaded """
+        LOGGER.debug('Getting place photo. PlaceID: %s.', place_id)
+        try:
+            row = self._connection().execute(
+                'select photos.data from places join photos on photos.hash = places.photo_hash where places.id = ?',
+                (place_id,)
+            ).fetchone()
+            return bytes(row[0]) if row and row[0] is not None else None
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting place photo. PlaceID: {place_id}. Error: {err}')
+
+    def set_photo_file_id(self, place_id: int, file_id: str) -> None:
+        """ Saving Telegram file_id of the place photo to send it without uploading """
+        LOGGER.debug('Saving photo file_id. PlaceID: %s.', place_id)
+        try:
+            with self._connection() as conn:
+                conn.execute('update places set photo_file_id = ? where id = ?', (file_id, place_id))
+        except Exception as err:
+            LOGGER.error(msg=f'Problem saving photo file_id. PlaceID: {place_id}. Error: {err}')
+
+    def get_session(self, user_id: int, ttl: float) -> str:
+        """ Getting content of the user session which has not expired """
+        try:
+            row = self._connection().execute(
+                'select content from sessions where user_id = ? and updated_at > ?',
+                (user_id, time.time() - ttl)
+            ).fetchone()
+            return row[0] if row else None
+        except Exception as err:
+            LOGGER.error(msg=f'Problem getting session. UserID: {user_id}. Error: {err}')
+
+    def has_session(self, user_id: int, ttl: float) -> bool:
+        """ Checking that the user has a session which has not expired, without reading its content """
+        try:
+            return self._connection().execute(
+                'select 1 from sessions where user_id = ? and updated_at > ?',
+                (user_id, time.time() - ttl)
+            ).fetchone() is not None
+        except Exception as err:
+            LOGGER.error(msg=f'Problem checking session. UserID: {user_id}. Error: {err}')
+            return False
+
+    def save_session(self, user_id: int, content: str) -> None:
+        """ Saving content of the user session """
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    """
+                    insert into sessions (user_id, content, updated_at) values (?, ?, ?)
+                        on conflict (user_id) do update
+                        set content = excluded.content, updated_at = excluded.updated_at
+                    """,
+                    (user_id, content, time.time())
+                )
+        except Exception as err:
+            LOGGER.error(msg=f'Problem saving session. UserID: {user_id}. Error: {err}')
+
+    def delete_session(self, user_id: int) -> None:
+        """ Deleting the user session """
+        try:
+            with self._connection() as conn:
+                conn.execute('delete from sessions where user_id = ?', (user_id,))
+        except Exception as err:
+            LOGGER.error(msg=f'Problem deleting session. UserID: {user_id}. Error: {err}')
+
+    def delete_expired_sessions(self, ttl: float) -> None:
+        """ Deleting sessions abandoned for longer than ttl seconds """
+        try:
+            with self._connection() as conn:
+                conn.execute('delete from sessions where updated_at < ?', (time.time() - ttl,))
+        except Exception as err:
+            LOGGER.error(msg=f'Problem deleting expired sessions. Error: {err}')
+
+    def stats(self) -> dict:
+        """ Number of thread connections and size of the DB file """
+        with self._lock:
+            connections = len(self._connections)
+        return {
+            'connections': connections,
+            'file_size': os.path.getsize(self._path) if os.path.exists(self._path) else 0,
+        }
+
+    def close(self) -> None:
+        """ Closing connections of all threads """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as err:
+                LOGGER.error(msg=f'Problem with closing DB connection. Error: {err}')
+        LOGGER.info(msg=f'The connection to DB has been closed.')
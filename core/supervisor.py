@@ -0,0 +1,207 @@
+"""
+Module of program which contains the supervisor of bot worker processes.
+The supervisor receives updates and routes every chat to the same worker
+process, so the state of a user stays local to one process.
+"""
+
+import logging
+import multiprocessing
+import queue
+import signal
+import statistics
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import telebot as tb
+
+import core.logs as logs
+from core.backends import create_schema
+from core.metrics import REGISTRY
+from core.webhook import WebhookServer, set_webhook
+
+LOGGER = logging.getLogger('supervisor.py')
+
+# How the stats of workers are merged, by the name of the stat; the other numbers are summed.
+STATS_MERGE = {
+    'max_lane_depth': max,
+    'wait_time_max': max,
+    'latency_max': max,
+    'wait_time_avg': statistics.fmean,
+    'latency_avg': statistics.fmean,
+    'hit_ratio_avg': statistics.fmean,
+    'utilisation': statistics.fmean,
+    # Workers share one SQLite file.
+    'file_size': max,
+}
+
+
+def get_update_chat_id(update: dict) -> int:
+    """ Getting chat id from update JSON, None if the update has no chat """
+    for key in ('message', 'edited_message'):
+        if key in update:
+            return update[key]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    return None
+
+
+def get_worker_num(chat_id: int, workers: int) -> int:
+    """ Worker process of the chat """
+    return chat_id % workers
+
+
+def aggregate_stats(stats_list: list) -> dict:
+    """ Aggregating stats of workers by the rules of STATS_MERGE """
+    result = {}
+    keys = {key for stats in stats_list for key in stats}
+    for key in keys:
+        values = [stats[key] for stats in stats_list if key in stats]
+        if all(isinstance(value, dict) for value in values):
+            result[key] = aggregate_stats(values)
+        elif not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            continue
+        else:
+            result[key] = STATS_MERGE.get(key, sum)(values)
+    return result
+
+
+def _worker_main(num: int, create_bot, config: dict, updates, metrics, log_queue, log_level: int) -> None:
+    """ Entry point of a worker process """
+    # Records are written by the supervisor process.
+    logs.attach_queue(log_queue, log_level)
+    LOGGER.info(msg=f'Worker #{num} starting.')
+    # Supervisor stops workers by SIGTERM; exiting normally lets the bot write buffered places.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    # The schema was created by the supervisor.
+    bot = create_bot(config, create_schema=False)
+    bot.serve_queue(updates, metrics=metrics, worker_num=num)
+
+
+class Supervisor:
+    """ Supervisor of bot worker processes sharded by chat id """
+
+    def __init__(self, token: str, create_bot, config: dict, workers: int,
+                 webhook_url: str = None, webhook_host: str = '0.0.0.0', webhook_port: int = 8443,
+                 webhook_secret: str = None, metrics_interval: float = 60) -> None:
+        LOGGER.info(msg=f'Supervisor initialisation. Workers: {workers}.')
+        self._token = token
+        self._create_bot = create_bot
+        self._config = config
+        self._webhook_url = webhook_url
+        self._webhook_host = webhook_host
+        self._webhook_port = webhook_port
+        self.__webhook_secret = webhook_secret
+        self._metrics_interval = metrics_interval
+        self._updates = [multiprocessing.Queue(maxsize=1000) for _ in range(workers)]
+        self._metrics = multiprocessing.Queue()
+        self._logs = multiprocessing.Queue()
+        self._processes = [None] * workers
+        self._worker_stats = {}
+        self._restarts = 0
+        self._stopped = threading.Event()
+
+    def _start_worker(self, num: int) -> None:
+        process = multiprocessing.Process(
+            target=_worker_main,
+            args=(num, self._create_bot, self._config, self._updates[num], self._metrics,
+                  self._logs, logging.getLogger().level),
+            name=f'bot-worker-{num}',
+            daemon=True
+        )
+        process.start()
+        self._processes[num] = process
+
+    def _watch_workers(self) -> None:
+        """ Restarting crashed workers; their queued updates wait in the queues """
+        while not self._stopped.wait(1):
+            for num, process in enumerate(self._processes):
+                if not process.is_alive():
+                    LOGGER.error(msg=f'Worker #{num} exited with code {process.exitcode}. Restarting.')
+                    self._restarts += 1
+                    self._start_worker(num)
+
+    def _collect_metrics(self) -> None:
+        logged_at = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                num, stats = self._metrics.get(timeout=1)
+                self._worker_stats[num] = stats
+            except queue.Empty:
+                pass
+            if time.monotonic() - logged_at > self._metrics_interval:
+                logged_at = time.monotonic()
+                stats = self.stats()
+                # Metric samples are served by the metrics server only.
+                stats.pop('metrics', None)
+                LOGGER.info(msg=f'Workers stats: {stats}')
+
+    def stats(self) -> dict:
+        """ Stats aggregated over all workers """
+        result = aggregate_stats(list(self._worker_stats.values()))
+        result['workers'] = len(self._processes)
+        result['workers_reporting'] = len(self._worker_stats)
+        result['restarts'] = self._restarts
+        result['queued'] = sum(updates.qsize() for updates in self._updates)
+        return result
+
+    def metrics(self) -> str:
+        """ Prometheus text of the metric samples and the stats summed over all workers """
+        stats = self.stats()
+        return REGISTRY.render(samples=stats.pop('metrics', {}), stats=stats)
+
+    def route(self, update: dict) -> None:
+        """ Passing an update to the worker of its chat """
+        chat_id = get_update_chat_id(update)
+        if chat_id is None:
+            return
+        self._updates[get_worker_num(chat_id, len(self._updates))].put(update)
+
+    def _polling(self) -> None:
+        offset = None
+        tb.apihelper.delete_webhook(self._token)
+        while True:
+            try:
+                updates = tb.apihelper.get_updates(self._token, offset=offset, timeout=10)
+            except Exception as err:
+                LOGGER.error(msg=f'Problem getting updates. Error: {err}')
+                time.sleep(3)
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.route(update)
+
+    def run(self) -> None:
+        """ Starting the workers and routing updates to them """
+        log_listener = logs.forward_records(self._logs)
+        # Workers skip the schema: migrations run by all of them at once would lock each other.
+        create_schema(self._config['DATABASE_URL'])
+        for num in range(len(self._processes)):
+            self._start_worker(num)
+        threading.Thread(target=self._watch_workers, name='watch-workers', daemon=True).start()
+        threading.Thread(target=self._collect_metrics, name='collect-metrics', daemon=True).start()
+        try:
+            if self._webhook_url:
+                server = WebhookServer(
+                    handler=self.route,
+                    host=self._webhook_host,
+                    port=self._webhook_port,
+                    path=urlparse(self._webhook_url).path or '/',
+                    secret_token=self.__webhook_secret
+                )
+                LOGGER.info(msg='Webhook setting')
+                set_webhook(self._token, self._webhook_url, server.secret_token)
+                server.serve_forever()
+            else:
+                self._polling()
+        finally:
+            self._stopped.set()
+            for process in self._processes:
+                process.terminate()
+            for process in self._processes:
+                process.join(10)
+            log_listener.stop()
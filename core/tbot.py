@@ -4,13 +4,30 @@ Based on https://github.com/eternnoir/pyTelegramBotAPI
 """
 
 import logging
+import queue
 import sys
 import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlparse
 from zipfile import ZipFile
 
 import telebot as tb
 
-import core.locationcalc as loc
+import core.exchange as exchange
+import core.flows as flows
+import core.logs as logs
+import core.photos as photos
+import core.routes as routes
+from core.dispatcher import Dispatcher
+from core.metrics import HANDLER_ERRORS, HANDLER_SECONDS, REGISTRY
+from core.place import Place
+from core.profiling import MemoryTracer, SamplingProfiler
+from core.sender import Sender, get_retry_after
+from core.session import MemorySessionStore
+from core.webhook import WebhookServer, set_webhook
 
 LOGGER = logging.getLogger('tbot.py')
 
@@ -18,364 +35,493 @@ LOGGER = logging.getLogger('tbot.py')
 class TelegramBot:
     """ Class of Telegram  bot """
 
-    def __init__(self, token: str, db, proxy_type: str, proxy_url: str, adm_pin: str) -> None:
+    def __init__(self, token: str, db, proxy_type: str, proxy_url: str, adm_pin: str,
+                 workers: int = 8, queue_size: int = 100, sessions=None, webhook_url: str = None,
+                 webhook_host: str = '0.0.0.0', webhook_port: int = 8443, webhook_secret: str = None,
+                 profile_seconds: float = 30, send_rate: float = 30, chat_send_rate: float = 1,
+                 photo_workers: int = 2, photo_max_side: int = photos.MAX_SIDE,
+                 photo_quality: int = photos.QUALITY, exchange_workers: int = 2) -> None:
         LOGGER.info(msg='Telegram bot initialisation.')
         self._token = token
         self._db = db
         self._proxy_type = proxy_type
         self._proxy_url = proxy_url
         self.__adm_pin = adm_pin
-        # A dictionary that contains temporary data before adding to the database.
-        self._place_content_dict = {}
-        # This set contains users who are in the progress of adding a new place.
-        self._user_in_progress_set = set()
+        self._webhook_url = webhook_url
+        self._webhook_host = webhook_host
+        self._webhook_port = webhook_port
+        self.__webhook_secret = webhook_secret
+        # Sessions of users who are in the progress of adding a new place.
+        # They contain temporary data before adding to the database.
+        self._sessions = sessions if sessions is not None else MemorySessionStore()
         # This set contains users who ask admin mode.
         self._admin_set = set()
+        # Profilers started from the admin menu; they are off until then.
+        self._profiler = SamplingProfiler()
+        self._memory_tracer = MemoryTracer()
+        self._profile_seconds = profile_seconds
 
         if proxy_type and proxy_url:
             tb.apihelper.proxy = {proxy_type: proxy_url}
 
-        self._bot = tb.TeleBot(self._token)
+        # Handlers are called by the dispatcher lanes, not by the telebot thread pool.
+        self._bot = tb.TeleBot(self._token, threaded=False)
+        self._bot.process_new_updates = self._dispatch_updates
+        self._dispatcher = Dispatcher(workers=workers, lane_size=queue_size)
+        # Outbound API calls are queued and sent within Telegram rate limits.
+        self._sender = Sender(self._bot, global_rate=send_rate, chat_rate=chat_send_rate)
+        # Photos are downloaded and prepared in the background while the user goes on adding the place.
+        self._photos = photos.PhotoPipeline(self._download_photo, workers=photo_workers,
+                                            max_side=photo_max_side, quality=photo_quality)
+        # Export and import take long, so they run in their own threads and don't hold the dispatcher lanes.
+        self._exchange = ThreadPoolExecutor(max_workers=exchange_workers, thread_name_prefix='exchange')
+
+    def _dispatch_updates(self, updates) -> None:
+        """ Passing updates to the dispatcher lane of their chat """
+        for update in updates:
+            if update.update_id > self._bot.last_update_id:
+                self._bot.last_update_id = update.update_id
+            key = None
+            if update.message:
+                chat_id = update.message.chat.id
+            elif update.callback_query and update.callback_query.message:
+                chat_id = update.callback_query.message.chat.id
+                key = (chat_id, update.callback_query.message.message_id, update.callback_query.data)
+            else:
+                continue
+            self._dispatcher.submit(chat_id, self._process_update, update, key=key)
+
+    def _receive_update(self, update_json: dict) -> None:
+        """ Taking an update received by the webhook server """
+        self._dispatch_updates([tb.types.Update.de_json(update_json)])
+
+    def _process_update(self, update) -> None:
+        if update.message:
+            self._bot.process_new_messages([update.message])
+        if update.callback_query:
+            self._bot.process_new_callback_query([update.callback_query])
+
+    def _reply(self, message, replies: list) -> None:
+        """ Queueing the replies of a flow of core.flows to the chat of the message """
+        chat_id = message.chat.id
+        for reply in replies:
+            if isinstance(reply, flows.Text):
+                self._sender.send_message(chat_id=chat_id, text=reply.text, reply_markup=reply.reply_markup)
+            elif isinstance(reply, flows.Venue):
+                self._sender.send_venue(chat_id=chat_id, **reply._asdict())
+            else:
+                self._sender.submit(chat_id, self._send_place_album, chat_id, reply.places)
 
     def _main_menu(self, message) -> None:
-        LOGGER.debug(msg=f'Main menu. UserID: {message.chat.id} - main menu')
-        keyboard = tb.types.InlineKeyboardMarkup(row_width=1)
-        keyboard.add(
-            tb.types.InlineKeyboardButton(text='Add new place', callback_data='add_place'),
-            tb.types.InlineKeyboardButton(text='Get list of your 10 last places',
-                                          callback_data='get_places'),
-            tb.types.InlineKeyboardButton(text='Get your places near your current location',
-                                          callback_data='get_places_location'),
-            tb.types.InlineKeyboardButton(text='Delete all your places', callback_data='delete_places'),
-            tb.types.InlineKeyboardButton(text='Help', callback_data='help'))
-        self._bot.send_message(
-            chat_id=message.chat.id,
-            text='What do you want to do?',
-            reply_markup=keyboard
-        )
+        LOGGER.debug('Main menu. UserID: %s - main menu', message.chat.id)
+        self._reply(message, flows.main_menu())
 
     def _help_massage(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - help message')
-        help_message_text = """
-        I am a bot that will help you save interesting places.
-I can:
-+ Save information about some place for you.
-+ Provide you list of your 10 last places.
-+ Provide you list of your 10 places near your current location.
-"""
-        self._bot.send_message(chat_id=message.chat.id, text=help_message_text)
-        self._main_menu(message)
-
-    def _send_places(self, message, places) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - Send places')
+        LOGGER.debug('UserID: %s - help message', message.chat.id)
+        self._reply(message, flows.help_message())
+
+    def _send_place_photo(self, chat_id: int, place: Place, caption: str) -> None:
+        """ Sending photo by cached Telegram file_id, uploading the stored bytes only if needed """
+        if place.photo_file_id:
+            try:
+                self._bot.send_photo(chat_id=chat_id, photo=place.photo_file_id, caption=caption)
+                return
+            except tb.apihelper.ApiException as err:
+                if get_retry_after(err) is not None:
+                    raise
+                LOGGER.warning(msg=f'UserID: {chat_id}. Photo file_id was rejected: {err}')
+        photo = self._db.get_place_photo(place_id=place.id)
+        if photo is None:
+            LOGGER.warning(msg=f'UserID: {chat_id}. Photo of the place {place.id} was not found.')
+            return
+        sent = self._bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
+        self._db.set_photo_file_id(place_id=place.id, file_id=sent.photo[-1].file_id)
+
+    def _send_place_album(self, chat_id: int, photo_places: list) -> None:
+        """ Sending up to 10 photos as one album, with the same file_id fallback; missing photos are skipped """
+        if len(photo_places) == 1:
+            self._send_place_photo(chat_id, *photo_places[0])
+            return
+
+        def album(use_file_ids: bool) -> list:
+            items = []
+            for place, caption in photo_places:
+                if use_file_ids and place.photo_file_id:
+                    photo = place.photo_file_id
+                else:
+                    photo = self._db.get_place_photo(place_id=place.id)
+                if photo is None:
+                    LOGGER.warning(msg=f'UserID: {chat_id}. Photo of the place {place.id} was not found.')
+                    continue
+                items.append((place, tb.types.InputMediaPhoto(media=photo, caption=caption)))
+            return items
+
+        def send(items: list) -> list:
+            # Telegram takes albums of 2 to 10 photos.
+            if len(items) == 1:
+                media = items[0][1]
+                return [self._bot.send_photo(chat_id=chat_id, photo=media.media, caption=media.caption)]
+            return self._bot.send_media_group(chat_id, [media for _, media in items]) if items else []
+
+        cached = any(place.photo_file_id for place, _ in photo_places)
+        items = album(use_file_ids=True)
         try:
-            if places:
-                self._bot.send_message(chat_id=message.chat.id, text='Your places:')
-                for num, place in enumerate(places):
-                    if place['photo'] is not None:
-                        self._bot.send_photo(
-                            chat_id=message.chat.id,
-                            photo=place['photo'],
-                            caption=f"#{num + 1} - {place['description']}"
-                        )
-                        self._bot.send_location(
-                            message.chat.id, place['lat'], place['long']
-                        )
-                    else:
-                        self._bot.send_message(
-                            chat_id=message.chat.id,
-                            text=f"#{num + 1} - {place['description']}"
-                        )
-                        self._bot.send_location(
-                            message.chat.id, place['lat'], place['long']
-                        )
-            else:
-                self._bot.send_message(
-                    chat_id=message.chat.id, text='Your places were not found.'
-                )
-            self._main_menu(message)
+            sent = send(items)
         except tb.apihelper.ApiException as err:
-            LOGGER.error(msg=f'UserID: {message.chat.id}. API Exception: {err}')
-            self._main_menu(message)
+            if not cached or get_retry_after(err) is not None:
+                raise
+            LOGGER.warning(msg=f'UserID: {chat_id}. Album file_id was rejected: {err}')
+            cached = False
+            items = album(use_file_ids=False)
+            sent = send(items)
+        for (place, _), sent_message in zip(items, sent):
+            if not cached or not place.photo_file_id:
+                self._db.set_photo_file_id(place_id=place.id, file_id=sent_message.photo[-1].file_id)
 
     def _list_last_places(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - list last places')
-        places = self._db.get_last_places(user_id=message.chat.id)
-        self._send_places(message, places)
+        LOGGER.debug('UserID: %s - list last places', message.chat.id)
+        self._send_places_page(message)
 
-    def _ask_location(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - ask location')
-        keyboard = tb.types.InlineKeyboardMarkup(row_width=1)
-        keyboard.add(
-            tb.types.InlineKeyboardButton(text='Cancel', callback_data='cancel')
-        )
-        self._bot.send_message(
-            chat_id=message.chat.id,
-            text='Please, send your location',
-            reply_markup=keyboard
+    def _list_older_places(self, message, before_id: str) -> None:
+        LOGGER.debug('UserID: %s - list places before %s', message.chat.id, before_id)
+        self._send_places_page(message, before_id=int(before_id))
+
+    def _send_places_page(self, message, before_id: int = None) -> None:
+        # One extra place tells whether there are older places.
+        places = self._db.get_last_places(
+            user_id=message.chat.id,
+            limit=routes.PLACES_PAGE_SIZE + 1,
+            before_id=before_id
         )
+        self._reply(message, flows.places_page(places))
+
+    def _ask_location(self, message) -> None:
+        LOGGER.debug('UserID: %s - ask location', message.chat.id)
+        self._reply(message, flows.ask_location())
 
-    def _places_near_location(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - places near location.')
-        area = loc.get_area_coord(
+    def _location_received(self, message) -> None:
+        LOGGER.debug('UserID: %s - places near location.', message.chat.id)
+        places = self._db.get_nearest_places(
+            user_id=message.chat.id,
             lat=message.location.latitude,
-            long=message.location.longitude,
-            distance=500
+            long=message.location.longitude
+        )
+        self._reply(message, flows.nearest_places(places))
+
+    def _search_places(self, message) -> None:
+        LOGGER.debug('UserID: %s - search places', message.chat.id)
+        words = routes.get_command_argument(message.text)
+        if not words:
+            self._reply(message, flows.search_usage())
+            return
+        self._send_search_page(message, words, page=1)
+
+    def _search_next_page(self, message) -> None:
+        LOGGER.debug('UserID: %s - search next page', message.chat.id)
+        words, page = routes.parse_search_text(message.text)
+        self._send_search_page(message, words, page=page + 1)
+
+    def _send_search_page(self, message, words: str, page: int) -> None:
+        # One extra place tells whether there is the next page.
+        places = self._db.search_places(
+            user_id=message.chat.id,
+            text=words,
+            limit=routes.SEARCH_PAGE_SIZE + 1,
+            offset=(page - 1) * routes.SEARCH_PAGE_SIZE
         )
-        places = self._db.get_near_places(user_id=message.chat.id, area=area)
-        self._send_places(message, places)
+        self._reply(message, flows.search_page(places, words, page))
+
+    def _export_places(self, message) -> None:
+        LOGGER.debug('UserID: %s - export places', message.chat.id)
+        options = routes.get_command_argument(message.text).lower().split()
+        file_format = next((option for option in options if option in exchange.FORMATS), 'geojson')
+        self._exchange.submit(self._write_export, message, file_format, 'photos' in options)
+
+    def _write_export(self, message, file_format: str, with_photos: bool) -> None:
+        """ Exporting places to a zip archive and sending it; called by the exchange threads """
+        # The archive goes to disk when it is bigger than 1 MB.
+        file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        try:
+            count = exchange.export_places(self._db, message.chat.id, file, file_format, with_photos=with_photos)
+        except Exception as err:
+            LOGGER.error(msg=f'UserID: {message.chat.id}. Problem exporting places. Error: {err}')
+            count = None
+        if count:
+            self._sender.submit(message.chat.id, self._send_document, message.chat.id, file,
+                                f'places_{file_format}.zip')
+            self._main_menu(message)
+        else:
+            file.close()
+            self._reply(message, flows.export_failed(count))
+
+    def _send_document(self, chat_id: int, file, file_name: str) -> None:
+        file.seek(0)
+        self._bot.send_document(chat_id, (file_name, file))
+        file.close()
+
+    def _import_places(self, message) -> None:
+        LOGGER.debug('UserID: %s - import places', message.chat.id)
+        document = message.document
+        if exchange.get_format(document.file_name) is None or (document.file_size or 0) > exchange.MAX_FILE_SIZE:
+            self._reply(message, flows.import_formats())
+            return
+        self._exchange.submit(self._read_import, message, document)
+
+    def _read_import(self, message, document) -> None:
+        """ Downloading the file and importing its places; called by the exchange threads """
+        self._db.create_user(user_id=message.chat.id)
+        try:
+            file_info = self._bot.get_file(document.file_id)
+            data = self._bot.download_file(file_info.file_path)
+            imported, skipped = exchange.import_places(self._db, message.chat.id, BytesIO(data),
+                                                       document.file_name)
+        except Exception as err:
+            LOGGER.error(msg=f'UserID: {message.chat.id}. Problem importing places. Error: {err}')
+            imported, skipped = None, 0
+        self._reply(message, flows.imported(imported, skipped))
 
     def _delete_users_data(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - delete user\'s data')
+        LOGGER.debug('UserID: %s - delete user\'s data', message.chat.id)
         self._db.delete_places(user_id=message.chat.id)
-        self._bot.send_message(
-            chat_id=message.chat.id,
-            text='All your places have been deleted!'
-        )
-        self._main_menu(message)
+        self._reply(message, flows.places_deleted())
 
     def _add_new_place_start(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - adding new place start')
-        self._place_content_dict[message.chat.id] = {}
-        self._user_in_progress_set.add(message.chat.id)
-        add_location_text = """
-In order to add a new place you need to add the following parameters:
-+ location (required)
-+ description (required, less than 250 symbols)
-+ photo (optional)
-"""
-        self._bot.send_message(chat_id=message.chat.id, text=add_location_text)
-        self._add_new_place_menu(message)
-
-    def _add_new_place_menu(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - adding new place menu')
-        keyboard = tb.types.InlineKeyboardMarkup(row_width=2)
-        keyboard.add(
-            tb.types.InlineKeyboardButton(text='Add location', callback_data='location'),
-            tb.types.InlineKeyboardButton(text='Add description', callback_data='description'),
-            tb.types.InlineKeyboardButton(text='Add photo', callback_data='photo'),
-            tb.types.InlineKeyboardButton(text='Cancel', callback_data='cancel')
-        )
-        if 'lat' in self._place_content_dict[message.chat.id].keys(
-        ) and 'description' in self._place_content_dict[message.chat.id].keys():
-            keyboard.add(tb.types.InlineKeyboardButton(text='Save', callback_data='save'))
-        self._bot.send_message(
-            chat_id=message.chat.id,
-            text='Please, choose action.',
-            reply_markup=keyboard
-        )
+        LOGGER.debug('UserID: %s - adding new place start', message.chat.id)
+        self._reply(message, flows.start_place(self._sessions, message.chat.id))
 
     def _add_new_place_location(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - adding new place location')
-        self._place_content_dict[message.chat.id].update({
-            'lat': message.location.latitude,
-            'long': message.location.longitude
-        })
-        self._bot.send_message(
-            chat_id=message.chat.id,
-            text='Location received.')
-        self._add_new_place_menu(message)
+        LOGGER.debug('UserID: %s - adding new place location', message.chat.id)
+        _, replies = flows.place_location(self._sessions, message.chat.id,
+                                          message.location.latitude, message.location.longitude)
+        self._reply(message, replies)
 
     def _add_new_place_description(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - adding new place description')
-        self._place_content_dict[message.chat.id].update({
-            'description': f"'{message.text[:250]}'"
-        })
-        self._bot.send_message(
-            chat_id=message.chat.id,
-            text='Description received.'
-        )
-        self._add_new_place_menu(message)
+        LOGGER.debug('UserID: %s - adding new place description', message.chat.id)
+        _, replies = flows.place_description(self._sessions, message.chat.id, message.text)
+        self._reply(message, replies)
+
+    def _download_photo(self, file_id: str) -> bytes:
+        """ Downloading a photo; called by the threads of the photo pipeline """
+        return self._bot.download_file(self._bot.get_file(file_id).file_path)
 
     def _add_new_place_photo(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - adding new place photo')
+        LOGGER.debug('UserID: %s - adding new place photo', message.chat.id)
+        file_id = photos.choose_variant(message.photo, self._photos.max_side).file_id
+        added, replies = flows.place_photo(self._sessions, message.chat.id, file_id)
+        if added:
+            self._photos.submit(file_id)
+        self._reply(message, replies)
 
-        # message.photo[0] = small size 'height': 320, 'width': 180
-        photo_id_small = message.photo[0].file_id
-        photo_info = self._bot.get_file(photo_id_small)
-        photo_binary = self._bot.download_file(photo_info.file_path)
+    def _add_new_place_save(self, message) -> None:
+        LOGGER.debug('UserID: %s - adding new place save', message.chat.id)
+        content = flows.take_place(self._sessions, message.chat.id)
+        if content is None:
+            self._main_menu(message)
+            return
+        if 'photo_file_id' in content.keys():
+            photo = self._photos.result(content['photo_file_id'])
+            if photo is None:
+                self._reply(message, flows.photo_failed(content))
+            else:
+                content['photo_hash'], content['photo'] = photo
 
-        self._place_content_dict[message.chat.id].update({'photo': photo_binary})
-        self._bot.send_message(chat_id=message.chat.id, text='Photo received.')
-        self._add_new_place_menu(message)
+        def saved(success: bool) -> None:
+            # Called after the commit, which can be later with the DB write buffer.
+            self._reply(message, flows.place_saved(success))
 
-    def _add_new_place_save(self, message) -> None:
-        LOGGER.debug(msg=f'UserID: {message.chat.id} - adding new place save')
-        self._db.create_new_place(
-            user_id=message.chat.id,
-            content=self._place_content_dict[message.chat.id]
-        )
-        self._bot.send_message(
-            chat_id=message.chat.id,
-            text='Your place has been saved!'
-        )
-        self._place_content_dict.pop(message.chat.id)
-        self._user_in_progress_set.remove(message.chat.id)
+        self._db.create_new_place(user_id=message.chat.id, content=content, callback=saved)
+
+    def _add_new_place_cancel(self, message) -> None:
+        LOGGER.debug('UserID: %s - adding new place cancel', message.chat.id)
+        file_id = flows.cancel_place(self._sessions, message.chat.id)
+        if file_id is not None:
+            self._photos.discard(file_id)
         self._main_menu(message)
 
+    def _ask_place_location(self, message) -> None:
+        self._reply(message, flows.ask_place_location())
+
+    def _ask_place_description(self, message) -> None:
+        self._reply(message, flows.ask_place_description())
+
+    def _ask_place_photo(self, message) -> None:
+        self._reply(message, flows.ask_place_photo())
+
+    def _create_new_user(self, message) -> None:
+        LOGGER.debug('UserID: %s - start point', message.chat.id)
+        self._db.create_user(user_id=message.chat.id)
+        self._reply(message, flows.welcome())
+
+    def _call_admin_menu(self, message) -> None:
+        LOGGER.debug('UserID: %s - admin command got', message.chat.id)
+        self._reply(message, flows.admin_prompt(self._admin_set, message.chat.id))
+
+    def _check_admin_pin(self, message) -> None:
+        if message.text == self.__adm_pin:
+            LOGGER.warning(msg=f'UserID: {message.chat.id} - admin menu')
+        else:
+            LOGGER.warning(msg=f'UserID: {message.chat.id} - admin login unsuccessful!')
+        self._reply(message, flows.check_admin_pin(self._admin_set, message.chat.id, message.text, self.__adm_pin))
+
+    def _admin_exit(self, message) -> None:
+        self._reply(message, flows.admin_exit(self._admin_set, message.chat.id))
+
     def _admin_menu(self, message) -> None:
-        LOGGER.warning(msg=f'UserID: {message.chat.id} - admin menu')
-        keyboard = tb.types.InlineKeyboardMarkup(row_width=2)
-        keyboard.add(
-            tb.types.InlineKeyboardButton(text='Get logs', callback_data='logs'),
-            tb.types.InlineKeyboardButton(text='Exit', callback_data='exit')
-        )
-        self._bot.send_message(
-            chat_id=message.chat.id,
-            text='Admin action.',
-            reply_markup=keyboard
-        )
+        self._reply(message, flows.admin_menu())
 
     def _admin_get_logs(self, message):
         with ZipFile('logs.zip', 'w') as zip_file:
-            for dir_name, _, file_list in os.walk('../logs'):
+            for dir_name, _, file_list in os.walk(logs.LOG_DIR):
                 for file in file_list:
                     file_patch = os.path.join(dir_name, file)
                     zip_file.write(file_patch)
         if os.path.exists('logs.zip'):
-            with open('logs.zip', 'rb') as file:
-                self._bot.send_document(message.chat.id, file)
+            self._sender.submit(message.chat.id, self._send_file, message.chat.id, 'logs.zip')
         self._admin_menu(message)
 
-    def run(self) -> None:
-        """
-        The main method for the bot.
-        The method contains bot's work logic
-        """
-        LOGGER.info(msg='Bot starting.')
+    def _admin_stats(self, message) -> None:
+        self._reply(message, flows.admin_stats(self.stats(), REGISTRY.summary()))
+
+    def _admin_profile(self, message) -> None:
+        chat_id = message.chat.id
+
+        def send_profile(collapsed: str) -> None:
+            self._sender.submit(chat_id, self._send_document, chat_id, BytesIO(collapsed.encode()), 'profile.txt')
+
+        started = self._profiler.start(self._profile_seconds, callback=send_profile)
+        self._reply(message, flows.profile_started(started, self._profile_seconds))
+
+    def _admin_memory(self, message) -> None:
+        chat_id = message.chat.id
+        if self._memory_tracer.running:
+            diff = self._memory_tracer.stop()
+            self._sender.submit(chat_id, self._send_document, chat_id, BytesIO(diff.encode()), 'memory.txt')
+        else:
+            self._memory_tracer.start()
+            self._reply(message, [flows.Text(flows.MEMORY_STARTED_TEXT)])
+        self._admin_menu(message)
 
-        def user_in_set(user_id, some_set) -> bool:
-            if user_id in some_set:
-                return True
-            return False
+    def _send_file(self, chat_id: int, file_path: str) -> None:
+        with open(file_path, 'rb') as file:
+            self._bot.send_document(chat_id, file)
+
+    def _handle(self, action: str, message, *args) -> None:
+        """ Calling the handler of the action, timed by HANDLER_SECONDS """
+        started = time.perf_counter()
+        try:
+            getattr(self, f'_{action}')(message, *args)
+        except Exception:
+            HANDLER_ERRORS.labels(action).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(action).observe(time.perf_counter() - started)
+
+    def _register_handlers(self) -> None:
+        """ Registering handlers of updates; the actions are chosen by core.routes """
 
         @self._bot.callback_query_handler(func=lambda x: True)
         def callback_handler(callback_query) -> None:
             """ This method provide interaction menu for each cases """
             chat_id = callback_query.message.chat.id
             text_question = callback_query.message.text
-            text_answer = callback_query.data
-            LOGGER.debug(
-                msg=f'Callback received. UserID: {chat_id}, text question: {text_question},'
-                f' text answer: {text_answer}'
+            text_answer, argument = routes.split_callback_data(callback_query.data)
+            LOGGER.debug('Callback received. UserID: %s, text question: %s, text answer: %s',
+                         chat_id, text_question, callback_query.data)
+            action = routes.route_callback(
+                text_question, text_answer, has_session=lambda: chat_id in self._sessions
             )
-            if text_question == 'What do you want to do?':
-                if text_answer == 'add_place':
-                    self._add_new_place_start(callback_query.message)
-                elif text_answer == 'get_places':
-                    self._list_last_places(callback_query.message)
-                elif text_answer == 'get_places_location':
-                    self._ask_location(callback_query.message)
-                elif text_answer == 'delete_places':
-                    self._delete_users_data(callback_query.message)
-                elif text_answer == 'help':
-                    self._help_massage(callback_query.message)
-
-            elif text_question == 'Please, choose action.':
-                if text_answer == 'location' and \
-                        user_in_set(callback_query.message.chat.id, self._user_in_progress_set):
-                    self._bot.send_message(
-                        chat_id=callback_query.message.chat.id,
-                        text='Please, send place location.'
-                    )
-                elif text_answer == 'description' and \
-                        user_in_set(callback_query.message.chat.id, self._user_in_progress_set):
-                    self._bot.send_message(
-                        chat_id=callback_query.message.chat.id,
-                        text='Please, send place description (less than 250 symbols).'
-                    )
-                elif text_answer == 'photo' and \
-                        user_in_set(callback_query.message.chat.id, self._user_in_progress_set):
-                    self._bot.send_message(
-                        chat_id=callback_query.message.chat.id,
-                        text='Please, send place photo.'
-                    )
-                elif text_answer == 'save' and \
-                        user_in_set(callback_query.message.chat.id, self._user_in_progress_set):
-                    self._add_new_place_save(callback_query.message)
-                elif text_answer == 'cancel' and \
-                        user_in_set(callback_query.message.chat.id, self._user_in_progress_set):
-                    self._place_content_dict.pop(callback_query.message.chat.id)
-                    self._user_in_progress_set.remove(callback_query.message.chat.id)
-                    self._main_menu(callback_query.message)
-
-            elif text_question == 'Admin action.':
-                if text_answer == 'logs':
-                    self._admin_get_logs(callback_query.message)
-                elif text_answer == 'exit':
-                    self._admin_set.remove(callback_query.message.chat.id)
-                    self._main_menu(callback_query.message)
-
-            else:
-                self._main_menu(callback_query.message)
-
-        @self._bot.message_handler(commands=['start'])
-        def create_new_user(message) -> None:
-            LOGGER.debug(msg=f'UserID: {message.chat.id} - start point')
-            self._db.create_user(user_id=message.chat.id)
-            self._bot.send_message(chat_id=message.chat.id, text='Welcome!')
-            self._help_massage(message)
-
-        @self._bot.message_handler(commands=['admin'])
-        def call_admin_menu(message) -> None:
-            LOGGER.debug(msg=f'UserID: {message.chat.id} - admin command got')
-            self._admin_set.add(message.chat.id)
-            self._bot.send_message(chat_id=message.chat.id, text='#>')
-
-        @self._bot.message_handler(
-            func=lambda message: user_in_set(message.chat.id, self._user_in_progress_set),
-            content_types=['location'])
-        def call_add_place_location(message) -> None:
-            LOGGER.debug(msg=f'UserID: {message.chat.id} - text: {message.text}')
-            self._add_new_place_location(message)
-
-        @self._bot.message_handler(
-            func=lambda message: user_in_set(message.chat.id, self._user_in_progress_set),
-            content_types=['text'])
-        def call_add_place_description(message) -> None:
-            LOGGER.debug(msg=f'UserID: {message.chat.id} - text: {message.text}')
-            self._add_new_place_description(message)
-
-        @self._bot.message_handler(
-            func=lambda message: user_in_set(message.chat.id, self._user_in_progress_set),
-            content_types=['photo'])
-        def call_add_place_photo(message) -> None:
-            LOGGER.debug(msg=f'UserID: {message.chat.id} - text: {message.text}')
-            self._add_new_place_photo(message)
-
-        @self._bot.message_handler(
-            func=lambda message: user_in_set(message.chat.id, self._admin_set),
-            content_types=['text'])
-        def check_admin_pin(message) -> None:
-            LOGGER.debug(msg=f'UserID: {message.chat.id} - text: {message.text}')
-            if message.text == self.__adm_pin:
-                self._admin_menu(message)
-            else:
-                LOGGER.warning(
-                    msg=f'UserID: {message.chat.id} - admin login unsuccessful!')
-                self._admin_set.remove(message.chat.id)
-                self._main_menu(message)
-
-        @self._bot.message_handler(content_types=['location'])
-        def call_location_method(message) -> None:
-            LOGGER.debug(msg=f'UserID: {message.chat.id} - text: {message.text}')
-            self._bot.send_message(
-                chat_id=message.chat.id,
-                text='Location received.'
+            if action:
+                self._handle(action, callback_query.message, *([argument] if argument else []))
+
+        @self._bot.message_handler(content_types=['text', 'location', 'photo', 'document'])
+        def message_handler(message) -> None:
+            """ This method provide reaction on commands and user's data """
+            chat_id = message.chat.id
+            LOGGER.debug('UserID: %s - text: %s', chat_id, message.text)
+            action = routes.route_message(
+                message.content_type, message.text,
+                has_session=lambda: chat_id in self._sessions,
+                is_admin=lambda: chat_id in self._admin_set
             )
-            self._places_near_location(message)
-
-        @self._bot.message_handler()
-        def any_massage(message) -> None:
-            LOGGER.debug(msg=f'UserID: {message.chat.id} - text: {message.text}')
-            self._main_menu(message)
+            if action:
+                self._handle(action, message)
+
+    def _run_webhook(self) -> None:
+        """ Receiving updates by the embedded webhook server instead of polling """
+        server = WebhookServer(
+            handler=self._receive_update,
+            host=self._webhook_host,
+            port=self._webhook_port,
+            path=urlparse(self._webhook_url).path or '/',
+            secret_token=self.__webhook_secret
+        )
+        LOGGER.info(msg='Webhook setting')
+        set_webhook(self._token, self._webhook_url, server.secret_token)
+        server.serve_forever()
+
+    def stop(self) -> None:
+        """ Stopping the polling; run() returns after the queued updates and messages are handled """
+        self._bot.stop_polling()
+
+    def stats(self) -> dict:
+        """ Counters of the DB pool, the outbound queue, the dispatcher and the photo pipeline """
+        return {
+            'db': self._db.stats(),
+            'sender': self._sender.stats(),
+            'dispatcher': self._dispatcher.stats(),
+            'photos': self._photos.stats(),
+        }
+
+    def metrics(self) -> str:
+        """ Prometheus text of the metrics and of the stats """
+        return REGISTRY.render(stats=self.stats())
+
+    def serve_queue(self, updates, metrics=None, worker_num: int = 0, metrics_interval: float = 10) -> None:
+        """
+        The main method for the bot in a worker process of core.supervisor.
+        Updates are taken from the queue; stats and metric samples are reported to the metrics queue.
+        """
+        LOGGER.info(msg=f'Bot worker #{worker_num} starting.')
+        self._register_handlers()
+        reported_at = time.monotonic()
+        try:
+            while True:
+                try:
+                    self._receive_update(updates.get(timeout=metrics_interval))
+                except queue.Empty:
+                    pass
+                if metrics is not None and time.monotonic() - reported_at >= metrics_interval:
+                    reported_at = time.monotonic()
+                    metrics.put((worker_num, dict(self.stats(), metrics=REGISTRY.samples())))
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        """ Finishing queued updates, then buffered DB writes, whose confirmations are sent last """
+        self._dispatcher.close()
+        self._exchange.shutdown()
+        self._photos.close()
+        self._db.close()
+        self._profiler.stop()
+        self._sender.close()
 
+    def run(self) -> None:
+        """
+        The main method for the bot.
+        The method contains bot's work logic
+        """
+        LOGGER.info(msg='Bot starting.')
+        self._register_handlers()
         try:
-            LOGGER.info(msg='Polling starting')
-            self._bot.remove_webhook()
-            self._bot.polling(none_stop=True, timeout=10)
+            if self._webhook_url:
+                self._run_webhook()
+            else:
+                LOGGER.info(msg='Polling starting')
+                self._bot.remove_webhook()
+                self._bot.polling(none_stop=True, timeout=10)
         except Exception as err:
             LOGGER.critical(msg=f'Problem with Telegram bot. Error: {err}')
             LOGGER.critical(msg='Exiting!')
-            self._db.close()
             sys.exit()
+        finally:
+            self._close()
@@ -0,0 +1,109 @@
+"""
+Module of program which contains an HTTP server receiving updates by webhook.
+https://core.telegram.org/bots/api#setwebhook
+"""
+
+import hmac
+import json
+import logging
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telebot as tb
+
+LOGGER = logging.getLogger('webhook.py')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_SIZE = 1024 * 1024
+
+
+def set_webhook(token: str, url: str, secret_token: str = None) -> None:
+    """ Registering the webhook URL in Telegram """
+    params = {'url': url, 'allowed_updates': json.dumps(['message', 'callback_query'])}
+    if secret_token:
+        params['secret_token'] = secret_token
+    # pyTelegramBotAPI 3.6.7 doesn't know 'secret_token' parameter of setWebhook.
+    tb.apihelper._make_request(token, 'setWebhook', method='post', params=params)
+
+
+class WebhookServer:
+    """
+    HTTP server which passes updates from Telegram to the handler.
+    Requests are accepted only with the secret token; without a configured one a random token is generated,
+    it has to be registered by set_webhook(..., server.secret_token).
+    """
+
+    def __init__(self, handler, host: str = '0.0.0.0', port: int = 8443,
+                 path: str = '/', secret_token: str = None) -> None:
+        LOGGER.info(msg=f'Webhook server initialisation. Address: {host}:{port}{path}.')
+        if not secret_token:
+            LOGGER.warning(msg='WEBHOOK_SECRET is not set, a random secret token is generated.')
+            secret_token = secrets.token_urlsafe(32)
+        self._handler = handler
+        self._path = path
+        self._secret_token = secret_token
+        self._server = ThreadingHTTPServer((host, port), self._request_handler_class())
+        self._thread = None
+
+    @property
+    def secret_token(self) -> str:
+        """ Token which Telegram has to send in the secret header """
+        return self._secret_token
+
+    @property
+    def port(self) -> int:
+        """ Port the server listens on """
+        return self._server.server_address[1]
+
+    def _request_handler_class(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            """ Handler of webhook requests """
+
+            def do_POST(self) -> None:
+                self.send_response(server._receive(self))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args) -> None:
+                LOGGER.debug('%s - ' + format, self.address_string(), *args)
+
+        return RequestHandler
+
+    def _receive(self, request) -> int:
+        if request.path != self._path:
+            return 404
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, '').encode(), self._secret_token.encode()):
+            LOGGER.warning(msg=f'Webhook request with a wrong secret token from {request.address_string()}.')
+            return 403
+        length = int(request.headers.get('Content-Length', 0))
+        if length > MAX_BODY_SIZE:
+            return 413
+        try:
+            update = json.loads(request.rfile.read(length))
+        except ValueError as err:
+            LOGGER.warning(msg=f'Webhook request with broken JSON. Error: {err}')
+            return 400
+        try:
+            self._handler(update)
+        except Exception as err:
+            LOGGER.error(msg=f'Problem handling webhook update. Error: {err}')
+            return 500
+        return 200
+
+    def serve_forever(self) -> None:
+        """ Serving requests in the current thread """
+        LOGGER.info(msg='Webhook server starting.')
+        self._server.serve_forever()
+
+    def start(self) -> None:
+        """ Serving requests in a background thread """
+        self._thread = threading.Thread(target=self.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """ Stopping the server """
+        self._server.shutdown()
+        self._server.server_close()
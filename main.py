@@ -6,14 +6,70 @@ and environment variables and assign this data to the classes.
 
 import json
 import os
+import queue
+import signal
 import sys
 import logging
-from datetime import datetime
 
-from core.database import Database
+import core.logs as logs
+from core.backends import is_sqlite_url, open_database
+from core.cache import CachedDatabase, ResultCache
+from core.metrics import InstrumentedDatabase, MetricsServer
+from core.session import DatabaseSessionStore, MemorySessionStore
+from core.supervisor import Supervisor
 from core.tbot import TelegramBot
 
 
+def create_bot(config: dict, create_schema: bool = True) -> TelegramBot:
+    """
+    Creating the bot with threads from configuration.
+    It is also called in every worker process of core.supervisor.Supervisor, without creating the schema.
+    """
+    session_ttl = float(config.get('SESSION_TTL') or 3600)
+    database = open_database(
+        db_url=config['DATABASE_URL'],
+        min_conn=int(config.get('DB_POOL_MIN') or 1),
+        max_conn=int(config.get('DB_POOL_MAX') or 10),
+        pool_timeout=float(config.get('DB_POOL_TIMEOUT') or 10),
+        write_buffer_size=int(config.get('WRITE_BUFFER_SIZE') or 0),
+        write_buffer_delay=float(config.get('WRITE_BUFFER_DELAY') or 1),
+        create_schema=create_schema
+    )
+    # Methods of the backend are timed below the cache, so cache hits are not counted as queries.
+    database = InstrumentedDatabase(database)
+    if config.get('SESSION_STORE') == 'database':
+        sessions = DatabaseSessionStore(db=database, ttl=session_ttl)
+    else:
+        sessions = MemorySessionStore(ttl=session_ttl)
+    cache_size = int(config.get('CACHE_SIZE') or 0)
+    if cache_size > 0:
+        database = CachedDatabase(database, ResultCache(
+            max_size=cache_size,
+            ttl=float(config.get('CACHE_TTL') or 60)
+        ))
+    return TelegramBot(
+        token=config.get('TOKEN'),
+        db=database,
+        proxy_type=config.get('PROXY_TYPE'),
+        proxy_url=config.get('PROXY_URL'),
+        adm_pin=config.get('ADMIN_PIN'),
+        workers=int(config.get('DISPATCH_WORKERS') or 8),
+        queue_size=int(config.get('DISPATCH_QUEUE_SIZE') or 100),
+        sessions=sessions,
+        webhook_url=config.get('WEBHOOK_URL'),
+        webhook_host=config.get('WEBHOOK_HOST') or '0.0.0.0',
+        webhook_port=int(config.get('WEBHOOK_PORT') or 8443),
+        webhook_secret=config.get('WEBHOOK_SECRET'),
+        profile_seconds=float(config.get('PROFILE_SECONDS') or 30),
+        send_rate=float(config.get('SEND_RATE') or 30),
+        chat_send_rate=float(config.get('CHAT_SEND_RATE') or 1),
+        photo_workers=int(config.get('PHOTO_WORKERS') or 2),
+        photo_max_side=int(config.get('PHOTO_MAX_SIDE') or 1280),
+        photo_quality=int(config.get('PHOTO_QUALITY') or 85),
+        exchange_workers=int(config.get('EXCHANGE_WORKERS') or 2)
+    )
+
+
 def main() -> None:
     """
     Main function of program.
@@ -53,7 +109,38 @@ def main() -> None:
                 'PROXY_TYPE': os.environ.get('PROXY_TYPE'),
                 'PROXY_URL': os.environ.get('PROXY_URL'),
                 'DATABASE_URL': os.environ.get('DATABASE_URL'),
-                'ADMIN_PIN': os.environ.get('ADMIN_PIN')
+                'ADMIN_PIN': os.environ.get('ADMIN_PIN'),
+                'DB_POOL_MIN': os.environ.get('DB_POOL_MIN'),
+                'DB_POOL_MAX': os.environ.get('DB_POOL_MAX'),
+                'DB_POOL_TIMEOUT': os.environ.get('DB_POOL_TIMEOUT'),
+                'DISPATCH_WORKERS': os.environ.get('DISPATCH_WORKERS'),
+                'DISPATCH_QUEUE_SIZE': os.environ.get('DISPATCH_QUEUE_SIZE'),
+                'SESSION_STORE': os.environ.get('SESSION_STORE'),
+                'SESSION_TTL': os.environ.get('SESSION_TTL'),
+                'RUNTIME': os.environ.get('RUNTIME'),
+                'WEBHOOK_URL': os.environ.get('WEBHOOK_URL'),
+                'WEBHOOK_HOST': os.environ.get('WEBHOOK_HOST'),
+                'WEBHOOK_PORT': os.environ.get('WEBHOOK_PORT'),
+                'WEBHOOK_SECRET': os.environ.get('WEBHOOK_SECRET'),
+                'WORKER_PROCESSES': os.environ.get('WORKER_PROCESSES'),
+                'CACHE_SIZE': os.environ.get('CACHE_SIZE'),
+                'CACHE_TTL': os.environ.get('CACHE_TTL'),
+                'WRITE_BUFFER_SIZE': os.environ.get('WRITE_BUFFER_SIZE'),
+                'WRITE_BUFFER_DELAY': os.environ.get('WRITE_BUFFER_DELAY'),
+                'LOG_LEVEL': os.environ.get('LOG_LEVEL'),
+                'LOG_JSON': os.environ.get('LOG_JSON'),
+                'LOG_MAX_BYTES': os.environ.get('LOG_MAX_BYTES'),
+                'LOG_BACKUP_COUNT': os.environ.get('LOG_BACKUP_COUNT'),
+                'LOG_ROTATE_INTERVAL': os.environ.get('LOG_ROTATE_INTERVAL'),
+                'METRICS_HOST': os.environ.get('METRICS_HOST'),
+                'METRICS_PORT': os.environ.get('METRICS_PORT'),
+                'PROFILE_SECONDS': os.environ.get('PROFILE_SECONDS'),
+                'SEND_RATE': os.environ.get('SEND_RATE'),
+                'CHAT_SEND_RATE': os.environ.get('CHAT_SEND_RATE'),
+                'PHOTO_WORKERS': os.environ.get('PHOTO_WORKERS'),
+                'PHOTO_MAX_SIDE': os.environ.get('PHOTO_MAX_SIDE'),
+                'PHOTO_QUALITY': os.environ.get('PHOTO_QUALITY'),
+                'EXCHANGE_WORKERS': os.environ.get('EXCHANGE_WORKERS')
             }
             logger.info('Trying to get configuration from Environment - Successful.')
             return config_dict
@@ -64,38 +151,96 @@ def main() -> None:
             logger.critical(msg='Exiting!')
             sys.exit()
 
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-
     logger = logging.getLogger('main.py')
-    logging.basicConfig(
-        filename=f'./logs/{datetime.now()}.log',
-        level=logging.INFO,
-        format='%(levelname)s ; %(asctime)s ; %(name)s ; %(message)s',
-    )
+    # Records wait in the queue until the configuration of the log file is read.
+    log_queue = queue.SimpleQueue()
+    logs.attach_queue(log_queue)
     logger.info('Started.')
+    # Stopping by SIGTERM runs the shutdown of the bot, which writes buffered places.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
 
-    if os.path.exists('config.json'):
-        config = get_data_from_json()
-    else:
-        logger.warning(msg='JSON configuration file not found!')
-        config = get_data_from_env()
-
-    if config:
-        database = Database(db_url=config['DATABASE_URL'])
-        bot = TelegramBot(
-            token=config.get('TOKEN'),
-            db=database,
-            proxy_type=config.get('PROXY_TYPE'),
-            proxy_url=config.get('PROXY_URL'),
-            adm_pin=config.get('ADMIN_PIN')
-        )
-        bot.run()
+    log_listener = None
+    try:
+        if os.path.exists('config.json'):
+            config = get_data_from_json()
+        else:
+            logger.warning(msg='JSON configuration file not found!')
+            config = get_data_from_env()
 
-    else:
-        logger.critical(msg='Configuration not found!')
-        logger.critical(msg='Exiting!')
-        sys.exit()
+        if config:
+            logging.getLogger().setLevel(str(config.get('LOG_LEVEL') or 'INFO').upper())
+            log_listener = logs.start_listener(
+                log_queue,
+                json_format=str(config.get('LOG_JSON') or '').lower() in ('1', 'true', 'yes'),
+                max_bytes=int(config.get('LOG_MAX_BYTES') or 10 * 1024 * 1024),
+                backup_count=int(config.get('LOG_BACKUP_COUNT') or 10),
+                interval=float(config.get('LOG_ROTATE_INTERVAL') or 24 * 60 * 60)
+            )
+            if config.get('RUNTIME') == 'async':
+                from core.aiobot import is_supported_proxy
+                from core.aiodatabase import AsyncDatabase
+                from core.aiotbot import AsyncTelegramBot
+
+                if is_sqlite_url(config['DATABASE_URL']):
+                    logger.critical(msg='The async runtime works with PostgreSQL only!')
+                    logger.critical(msg='Exiting!')
+                    sys.exit()
+
+                # Like the threaded runtime, the proxy is used when both its type and URL are set.
+                proxy_url = config.get('PROXY_URL') if config.get('PROXY_TYPE') else None
+                if proxy_url and not is_supported_proxy(proxy_url):
+                    logger.critical(msg='The async runtime supports HTTP proxies only, PROXY_URL must be http(s)://.')
+                    logger.critical(msg='Exiting!')
+                    sys.exit()
+
+                if config.get('SESSION_STORE') == 'database':
+                    logger.warning(msg='The async runtime keeps sessions in memory only.')
+                database = AsyncDatabase(
+                    db_url=config['DATABASE_URL'],
+                    min_conn=int(config.get('DB_POOL_MIN') or 1),
+                    max_conn=int(config.get('DB_POOL_MAX') or 10),
+                    pool_timeout=float(config.get('DB_POOL_TIMEOUT') or 10)
+                )
+                database = InstrumentedDatabase(database)
+                bot = AsyncTelegramBot(
+                    token=config.get('TOKEN'),
+                    db=database,
+                    proxy_url=proxy_url,
+                    adm_pin=config.get('ADMIN_PIN'),
+                    sessions=MemorySessionStore(ttl=float(config.get('SESSION_TTL') or 3600)),
+                    profile_seconds=float(config.get('PROFILE_SECONDS') or 30),
+                    photo_max_side=int(config.get('PHOTO_MAX_SIDE') or 1280),
+                    photo_quality=int(config.get('PHOTO_QUALITY') or 85),
+                    exchange_workers=int(config.get('EXCHANGE_WORKERS') or 2)
+                )
+            elif int(config.get('WORKER_PROCESSES') or 1) > 1:
+                bot = Supervisor(
+                    token=config.get('TOKEN'),
+                    create_bot=create_bot,
+                    config=config,
+                    workers=int(config['WORKER_PROCESSES']),
+                    webhook_url=config.get('WEBHOOK_URL'),
+                    webhook_host=config.get('WEBHOOK_HOST') or '0.0.0.0',
+                    webhook_port=int(config.get('WEBHOOK_PORT') or 8443),
+                    webhook_secret=config.get('WEBHOOK_SECRET')
+                )
+            else:
+                bot = create_bot(config)
+            metrics_port = int(config.get('METRICS_PORT') or 0)
+            if metrics_port and hasattr(bot, 'metrics'):
+                MetricsServer(bot.metrics, host=config.get('METRICS_HOST') or '0.0.0.0', port=metrics_port).start()
+            bot.run()
+
+        else:
+            logger.critical(msg='Configuration not found!')
+            logger.critical(msg='Exiting!')
+            sys.exit()
+
+    finally:
+        # Writing the queued records, also when the configuration was not read.
+        if log_listener is None:
+            log_listener = logs.start_listener(log_queue)
+        log_listener.stop()
 
 
 if __name__ == "__main__":
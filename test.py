@@ -1,5 +1,51 @@
+import asyncio
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import tempfile
+import sqlite3
+import sys
+import threading
+import time
 import unittest
-from core.locationcalc import get_area_coord
+import unittest.mock
+from collections import namedtuple
+from contextlib import contextmanager
+from importlib.util import find_spec
+from types import SimpleNamespace
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from zipfile import ZipFile
+
+import psycopg2
+import psycopg2.extensions
+import telebot as tb
+
+from core import exchange, flows, logs
+from core.cache import CachedDatabase, ResultCache
+from core.backends import create_schema, open_database
+from core.database import Database
+from core.dispatcher import Dispatcher, get_lane_num
+from core.locationcalc import get_area_coord, get_area_cells, get_cell_id, get_distance, split_area
+from core.menus import ADD_PLACE_TEXT, HELP_TEXT, SEARCH_USAGE_TEXT
+from core.metrics import DB_QUERY_SECONDS, InstrumentedDatabase, MetricsServer, Registry, stats_text
+from core.photos import PhotoPipeline, choose_variant, photo_hash, place_batches
+from core.place import Place
+from core.pool import ConnectionPool, PoolTimeoutError
+from core.profiling import MemoryTracer, SamplingProfiler
+from core.routes import (ADMIN_MENU_TEXT, MAIN_MENU_TEXT, MORE_PLACES_TEXT, PLACE_MENU_TEXT, get_command_argument,
+                         parse_search_text, route_callback, route_message, search_text, split_callback_data)
+from core.sender import Sender, TokenBucket
+from core.session import DatabaseSessionStore, MemorySessionStore, SessionStore, decode_content, encode_content
+from core.sqlitedb import SqliteDatabase
+from core.supervisor import aggregate_stats, get_update_chat_id, get_worker_num
+from core.tbot import TelegramBot
+from core.webhook import SECRET_HEADER, WebhookServer
 
 class TestLocationCalc(unittest.TestCase):
 
@@ -15,5 +61,1395 @@ class TestLocationCalc(unittest.TestCase):
         self.assertEqual(get_area_coord('-54.734692', '-67.200944', 1000),
                          (-54.743692, -67.216532, -54.725692, -67.185356))
 
+    def test_distance_equator_degree(self):
+        self.assertAlmostEqual(get_distance('0', '0', '0', '1'), 111_195, delta=1)
+
+    def test_distance_same_point(self):
+        self.assertEqual(get_distance('51.498305', '0.085904', '51.498305', '0.085904'), 0)
+
+
+class TestLocationGrid(unittest.TestCase):
+
+    def test_cell_neighbours(self):
+        self.assertEqual(get_cell_id('51.498305', '0.085904') - get_cell_id('51.498305', '0.075904'), 1)
+
+    def test_area_cells_contain_point(self):
+        area = get_area_coord('-54.734692', '-67.200944', 1000)
+        self.assertIn(get_cell_id('-54.734692', '-67.200944'), get_area_cells(area))
+        self.assertEqual(len(get_area_cells(area)), 12)
+
+    def test_area_cells_antimeridian(self):
+        area = get_area_coord('0.0', '179.999', 1000)
+        self.assertIn(get_cell_id('0.0', '-179.999'), get_area_cells(area))
+
+    def test_area_cells_too_big(self):
+        self.assertIsNone(get_area_cells(get_area_coord('0.0', '0.0', 50_000)))
+
+    def test_pole(self):
+        self.assertEqual(get_area_coord('90', '10', 1000), (89.991, -180.0, 90.0, 180.0))
+        self.assertEqual(get_area_coord('89.995', '10', 1000)[1::2], (-180.0, 180.0))
+
+    def test_antimeridian(self):
+        area = get_area_coord('0.0', '179.999', 1000)
+        self.assertEqual(area[1::2], (179.99, -179.992))
+        self.assertEqual(split_area(area), [(area[0], 179.99, area[2], 180.0), (area[0], -180.0, area[2], -179.992)])
+        self.assertEqual(get_area_coord('0.0', '-179.999', 1000)[1::2], (179.992, -179.99))
+
+
+@unittest.skipUnless(find_spec('numpy'), 'NumPy is not installed')
+class TestGeodesy(unittest.TestCase):
+
+    def test_bounding_box_matches_scalar(self):
+        from core import geodesy
+        for lat, long in (('0.006735', '9.353520'), ('51.498305', '0.085904'),
+                          ('-54.734692', '-67.200944'), ('90', '10'), ('0.0', '179.999'), ('-89.995', '0')):
+            self.assertEqual(geodesy.bounding_box(lat, long, 1000), get_area_coord(lat, long, 1000))
+
+    def test_search_areas_match_scalar(self):
+        from core import geodesy
+        radii = (500, 2_000, 10_000, 50_000)
+        self.assertEqual(geodesy.search_areas(51.498305, 0.085904, radii),
+                         [get_area_coord(51.498305, 0.085904, radius) for radius in radii])
+
+    def test_distances_match_scalar(self):
+        from core import geodesy
+        lats, longs = [0.0, 51.498305, -54.734692], [1.0, 0.085904, -67.200944]
+        for value, lat, long in zip(geodesy.distances(0, 0, lats, longs), lats, longs):
+            self.assertAlmostEqual(value, get_distance(0, 0, lat, long), places=6)
+
+    def test_within_radius(self):
+        from core import geodesy
+        mask = geodesy.within_radius(0, 0, [0.0, 0.0, 0.0], [0.001, 0.01, 0.1], 2000)
+        self.assertEqual(mask.tolist(), [True, True, False])
+
+
+@unittest.skipUnless(find_spec('psycopg2'), 'psycopg2 is not installed')
+class TestStatements(unittest.TestCase):
+
+    def test_parameters_match_types(self):
+        from core.database import STATEMENTS
+        for name, (types, query) in STATEMENTS.items():
+            numbers = {int(number) for number in re.findall(r'\$(\d+)', query)}
+            self.assertEqual(numbers, set(range(1, len(types) + 1)), name)
+
+    def test_schema_migrations_run_once(self):
+        from core.database import SCHEMA
+        # Data migrations scan the whole table, so they only run inside the blocks which check the columns.
+        for statement in SCHEMA:
+            self.assertFalse(statement.strip().startswith(('update', 'insert')), statement)
+
+
+class FakeConnection:
+    """ Connection which counts the queries sent to the server """
+
+    def __init__(self):
+        self.closed = 0
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.queries = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    def execute(self, query, params=None):
+        if self.closed:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.queries += 1
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def open(self, **kwargs):
+        self.connections = []
+
+        def connect(db_url):
+            self.connections.append(FakeConnection())
+            return self.connections[-1]
+        return ConnectionPool('postgresql:///test', connect=connect, **kwargs)
+
+    def test_min_and_max_size(self):
+        pool = self.open(min_conn=2, max_conn=3, timeout=0.05)
+        self.assertEqual(len(self.connections), 2)
+        taken = [pool.getconn() for _ in range(3)]
+        self.assertEqual(len(self.connections), 3)
+        self.assertEqual(pool.stats()['in_use'], 3)
+        with self.assertRaises(PoolTimeoutError):
+            pool.getconn()
+        for conn in taken:
+            pool.putconn(conn)
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['idle'], stats['checkouts'], stats['timeouts']), (3, 3, 3, 1))
+        pool.close()
+        self.assertTrue(all(conn.closed for conn in self.connections))
+
+    def test_waiting_checkout(self):
+        pool = self.open(min_conn=1, max_conn=1, timeout=5)
+        conn = pool.getconn()
+        threading.Timer(0.05, pool.putconn, (conn,)).start()
+        self.assertIs(pool.getconn(), conn)
+        self.assertGreater(pool.stats()['wait_time_max'], 0)
+
+    def test_broken_connection_replaced(self):
+        pool = self.open(min_conn=1, max_conn=1)
+        self.connections[0].status = psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+        self.assertIs(pool.getconn(), self.connections[1])
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(pool.stats()['broken'], 1)
+
+    def test_closed_connection_not_returned(self):
+        pool = self.open(min_conn=1, max_conn=2)
+        with self.assertRaises(psycopg2.OperationalError):
+            with pool.cursor() as cursor:
+                self.connections[0].close()
+                cursor.execute('select 1')
+        self.assertEqual(pool.stats()['size'], 0)
+        with pool.cursor() as cursor:
+            cursor.execute('select 1')
+        self.assertEqual(len(self.connections), 2)
+
+    def test_only_idle_connections_probed(self):
+        pool = self.open(min_conn=1, max_conn=1, probe_after=60)
+        pool.putconn(pool.getconn())
+        self.assertEqual(self.connections[0].queries, 0)
+        pool._probe_after = 0
+        pool.putconn(pool.getconn())
+        self.assertEqual(self.connections[0].queries, 1)
+
+
+# Unix socket which does not exist: Database fails to connect at once and gets a fake pool.
+UNREACHABLE_DB_URL = 'postgresql:///test?host=/nonexistent'
+
+
+class FakeCursor:
+    """ Cursor which records the rows of execute_values; rows of user 0 break the transaction """
+
+    class connection:
+        encoding = 'UTF8'
+
+    def __init__(self):
+        self.rows = []
+
+    def mogrify(self, template, args):
+        if args[0] == 0:
+            raise psycopg2.IntegrityError('insert or update on table "places" violates foreign key constraint')
+        self.rows.append(args)
+        return b'()'
+
+    def execute(self, query, params=None):
+        pass
+
+
+class FakePool:
+    """ Pool which commits the rows of a cursor only if its block succeeds """
+
+    def __init__(self):
+        self.committed = []
+        self.transactions = 0
+
+    @contextmanager
+    def cursor(self):
+        cursor = FakeCursor()
+        self.transactions += 1
+        yield cursor
+        self.committed.extend(row[0] for row in cursor.rows)
+
+    def close(self):
+        pass
+
+
+class TestWriteBuffer(unittest.TestCase):
+
+    CONTENT = {'lat': 51.5, 'long': 0.1, 'description': 'Place'}
+
+    def open(self, size, delay):
+        with self.assertLogs('database.py', logging.ERROR):
+            db = Database(UNREACHABLE_DB_URL, write_buffer_size=size, write_buffer_delay=delay)
+        db._pool = FakePool()
+        return db
+
+    def add(self, db, user_id, results, done=None):
+        def callback(saved):
+            results[user_id] = saved
+            if done is not None:
+                done.set()
+        db.create_new_place(user_id, dict(self.CONTENT), callback=callback)
+
+    def test_full_buffer_in_one_transaction(self):
+        db = self.open(size=3, delay=60)
+        results, done = {}, threading.Event()
+        for user_id in (1, 2, 3):
+            self.add(db, user_id, results, done if user_id == 3 else None)
+        self.assertTrue(done.wait(5))
+        db.close()
+        self.assertEqual(results, {1: True, 2: True, 3: True})
+        self.assertEqual(db._pool.transactions, 1)
+        self.assertEqual(sorted(db._pool.committed), [1, 2, 3])
+
+    def test_flushed_after_delay(self):
+        db = self.open(size=100, delay=0.1)
+        results, done = {}, threading.Event()
+        self.add(db, 1, results, done)
+        self.assertTrue(done.wait(5))
+        db.close()
+        self.assertEqual(results, {1: True})
+
+    def test_flushed_on_close(self):
+        db = self.open(size=100, delay=60)
+        results = {}
+        self.add(db, 1, results)
+        self.add(db, 2, results)
+        self.assertEqual(results, {})
+        db.close()
+        self.assertEqual(results, {1: True, 2: True})
+        self.assertEqual(db._pool.transactions, 1)
+
+    def test_only_broken_place_fails(self):
+        db = self.open(size=100, delay=60)
+        results = {}
+        for user_id in (1, 0, 2):
+            self.add(db, user_id, results)
+        with self.assertLogs('database.py', logging.WARNING):
+            db.close()
+        self.assertEqual(results, {1: True, 0: False, 2: True})
+        # The batch and then every place on its own.
+        self.assertEqual(db._pool.transactions, 4)
+        self.assertEqual(sorted(db._pool.committed), [1, 2])
+
+
+class FakeDatabase:
+
+    def __init__(self):
+        self.places = {}
+        self.calls = 0
+        self.users = set()
+        self.file_ids = {}
+        self.fail_writes = False
+        self.missing_photos = set()
+
+    def create_user(self, user_id):
+        self.users.add(user_id)
+
+    def get_last_places(self, user_id, limit=10, before_id=None):
+        self.calls += 1
+        return self.places.get(user_id, [])[:limit]
+
+    def get_nearest_places(self, user_id, lat, long, limit=10):
+        self.calls += 1
+        places = [place._replace(distance=round(get_distance(lat, long, place.lat, place.long)))
+                  for place in self.places.get(user_id, [])]
+        return sorted(places, key=lambda place: place.distance)[:limit]
+
+    def create_new_place(self, user_id, content, callback=None):
+        if not self.fail_writes:
+            self.places.setdefault(user_id, []).append(
+                Place(len(self.places.get(user_id, [])) + 1, content['lat'], content['long'], content['description'],
+                      'photo' in content))
+        if callback is not None:
+            callback(not self.fail_writes)
+
+    def delete_places(self, user_id):
+        self.places.pop(user_id, None)
+
+    def search_places(self, user_id, text, limit=10, offset=0):
+        found = [place for place in self.places.get(user_id, []) if text in place.description]
+        return found[offset:offset + limit]
+
+    def iter_places(self, user_id, chunk_size=1000):
+        yield from self.places.get(user_id, [])
+
+    def import_places(self, user_id, places, batch_size=1000):
+        count = 0
+        for content in places:
+            self.create_new_place(user_id, content)
+            count += 1
+        return count
+
+    def get_place_photo(self, place_id):
+        return None if place_id in self.missing_photos else b'photo'
+
+    def set_photo_file_id(self, place_id, file_id):
+        self.file_ids[place_id] = file_id
+
+    def stats(self):
+        return {'size': 1}
+
+    def close(self):
+        pass
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        places = [[Place(num, 51.5, 0.1, str(num))] for num in range(4)]
+        cache = ResultCache(max_size=2, ttl=60)
+        cache.set(('last', 1), places[1])
+        cache.set(('last', 2), places[2])
+        cache.get(('last', 1))
+        cache.set(('last', 3), places[3])
+        self.assertIsNone(cache.get(('last', 2)))
+        self.assertEqual(cache.get(('last', 1)), places[1])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = ResultCache(ttl=0)
+        cache.set(('last', 1), [Place(1, 51.5, 0.1, 'a')])
+        self.assertIsNone(cache.get(('last', 1)))
+
+    def test_invalidated_during_read_not_cached(self):
+        cache = ResultCache()
+        generation = cache.generation(1)
+        cache.invalidate_user(1)
+        cache.set(('last', 1), [Place(1, 51.5, 0.1, 'a')], generation)
+        self.assertIsNone(cache.get(('last', 1)))
+        cache.set(('last', 1), [Place(1, 51.5, 0.1, 'a')], cache.generation(1))
+        self.assertIsNotNone(cache.get(('last', 1)))
+        generation = cache.generation(2)
+        cache.invalidate_user(None)
+        cache.set(('last', 2), [Place(2, 51.5, 0.1, 'b')], generation)
+        self.assertIsNone(cache.get(('last', 2)))
+
+    def test_photo_file_id_drops_owner_places(self):
+        db = FakeDatabase()
+        cached = CachedDatabase(db)
+        cached.create_new_place(1, {'lat': 51.5, 'long': 0.1, 'description': 'a'})
+        cached.create_new_place(2, {'lat': 51.5, 'long': 0.1, 'description': 'b'})
+        db.places[2][0] = db.places[2][0]._replace(id=2)
+        cached.get_last_places(1)
+        cached.get_last_places(2)
+        cached.set_photo_file_id(db.places[1][0].id, 'abc')
+        cached.get_last_places(2)
+        self.assertEqual(db.calls, 2)
+        cached.get_last_places(1)
+        self.assertEqual(db.calls, 3)
+
+    def test_invalidation_on_write(self):
+        db = FakeDatabase()
+        cached = CachedDatabase(db)
+        cached.create_new_place(1, {'lat': 51.5, 'long': 0.1, 'description': 'a'})
+        self.assertEqual(len(cached.get_last_places(1)), 1)
+        self.assertEqual(len(cached.get_last_places(1)), 1)
+        self.assertEqual(db.calls, 1)
+        cached.create_new_place(1, {'lat': 51.6, 'long': 0.1, 'description': 'b'})
+        self.assertEqual(len(cached.get_last_places(1)), 2)
+        cached.delete_places(1)
+        self.assertEqual(cached.get_last_places(1), [])
+        self.assertEqual(cached.stats()['cache']['hits'], 1)
+
+    def test_nearest_cached_by_location(self):
+        db = FakeDatabase()
+        cached = CachedDatabase(db)
+        cached.create_new_place(1, {'lat': 51.501, 'long': 0.101, 'description': 'a'})
+        cached.create_new_place(1, {'lat': 51.509, 'long': 0.109, 'description': 'b'})
+        self.assertEqual(get_cell_id(51.501, 0.101), get_cell_id(51.508, 0.108))
+        self.assertEqual([place.description for place in cached.get_nearest_places(1, 51.501, 0.101, limit=1)], ['a'])
+        # A point of the same grid cell has another nearest place.
+        self.assertEqual([place.description for place in cached.get_nearest_places(1, 51.508, 0.108, limit=1)], ['b'])
+        cached.get_nearest_places(1, 51.501, 0.101, limit=1)
+        self.assertEqual(db.calls, 2)
+
+
+class TestSqliteDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = open_database(f'sqlite:///{os.path.join(self.tmp_dir.name, "places.db")}')
+        self.db.create_user(1)
+        self.db.create_user(1)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def add_place(self, lat, long, description, **content):
+        saved = []
+        self.db.create_new_place(1, dict(content, lat=lat, long=long, description=description),
+                                 callback=saved.append)
+        self.assertEqual(saved, [True])
+
+    def test_backend_by_url(self):
+        self.assertIsInstance(self.db, SqliteDatabase)
+
+    def test_schema_created_once(self):
+        db_url = f'sqlite:///{os.path.join(self.tmp_dir.name, "workers.db")}'
+        worker_db = open_database(db_url, create_schema=False)
+        self.assertIsNone(worker_db.get_last_places(1))
+        create_schema(db_url)
+        self.assertEqual(worker_db.get_last_places(1), [])
+        worker_db.close()
+
+    def test_last_places_and_delete(self):
+        for num in range(12):
+            self.add_place(51.5, 0.1 + num / 100, f'place {num}')
+        places = self.db.get_last_places(1)
+        self.assertEqual(len(places), 10)
+        self.assertEqual(places[0].description, 'place 11')
+        self.db.delete_places(1)
+        self.assertEqual(self.db.get_last_places(1), [])
+        self.assertEqual(self.db.get_near_places(1, get_area_coord(51.5, 0.1, 50_000)), [])
+
+    def test_keyset_pages_and_stream(self):
+        for num in range(25):
+            self.add_place(51.5, 0.1, f'place {num}')
+        pages, before_id = [], None
+        while True:
+            page = self.db.get_last_places(1, limit=10, before_id=before_id)
+            if not page:
+                break
+            pages.append([place.description for place in page])
+            before_id = page[-1].id
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(pages[0][0], 'place 24')
+        self.assertEqual(pages[2][-1], 'place 0')
+        places = self.db.iter_places(1, chunk_size=4)
+        self.assertEqual([place.description for place in places], [f'place {num}' for num in range(25)])
+
+    def test_nearest_places(self):
+        self.add_place(51.5, 0.1, 'here')
+        self.add_place(51.52, 0.1, 'near')
+        self.add_place(52.5, 0.1, 'far')
+        places = self.db.get_nearest_places(1, 51.501, 0.1, limit=2)
+        self.assertEqual([place.description for place in places], ['here', 'near'])
+        self.assertEqual(places[0].distance, 111)
+        near = self.db.get_near_places(1, get_area_coord(51.5, 0.1, 1000))
+        self.assertEqual([place.description for place in near], ['here'])
+
+    def test_nearest_limited_in_ring(self):
+        for num in range(5):
+            self.add_place(51.5 + num * 0.001, 0.1, f'place {num}')
+        self.db.create_user(2)
+        self.db.create_new_place(2, {'lat': 51.5, 'long': 0.1, 'description': 'other'})
+        places = self.db.get_nearest_places(1, 51.5021, 0.1, limit=3)
+        self.assertEqual([place.description for place in places], ['place 2', 'place 3', 'place 1'])
+        self.assertIsInstance(places[0].distance, int)
+        # Places out of the last ring radius are not returned.
+        places = self.db.get_nearest_places(1, 51.5, 0.1, radii=(50,))
+        self.assertEqual([(place.description, place.distance) for place in places], [('place 0', 0)])
+
+    def test_nearest_across_antimeridian_and_pole(self):
+        self.add_place(0.0, 179.999, 'east')
+        self.add_place(0.0, -179.999, 'west')
+        self.add_place(89.999, 100.0, 'pole')
+        places = self.db.get_nearest_places(1, 0.0, -179.9995)
+        self.assertEqual([place.description for place in places], ['west', 'east'])
+        near = self.db.get_near_places(1, get_area_coord(0.0, 179.9995, 1000))
+        self.assertEqual(sorted(place.description for place in near), ['east', 'west'])
+        places = self.db.get_nearest_places(1, 89.999, -80.0)
+        self.assertEqual([place.description for place in places], ['pole'])
+
+    def test_write_buffer_ignored(self):
+        with self.assertLogs('backends.py', level='WARNING'):
+            open_database(f'sqlite:///{os.path.join(self.tmp_dir.name, "places.db")}', write_buffer_size=10).close()
+
+    def test_search(self):
+        self.add_place(51.5, 0.1, 'Coffee at the old harbour')
+        self.add_place(51.5, 0.1, 'Harbour view')
+        self.add_place(51.5, 0.1, 'Bookshop')
+        self.assertEqual([place.description for place in self.db.search_places(1, 'harb')],
+                         ['Harbour view', 'Coffee at the old harbour'])
+        self.assertEqual(len(self.db.search_places(1, 'harbour coffee')), 1)
+        self.assertEqual(len(self.db.search_places(1, 'harbour', limit=1, offset=1)), 1)
+        self.assertEqual(self.db.search_places(1, '"*'), [])
+        self.assertEqual(self.db.search_places(2, 'harbour'), [])
+
+    def test_photo_and_sessions(self):
+        self.add_place(51.5, 0.1, 'photo', photo=b'\x89PNG', photo_file_id='abc')
+        place = self.db.get_last_places(1)[0]
+        self.assertTrue(place.has_photo)
+        self.assertEqual(self.db.get_place_photo(place.id), b'\x89PNG')
+        self.db.set_photo_file_id(place.id, 'def')
+        self.assertEqual(self.db.get_last_places(1)[0].photo_file_id, 'def')
+        sessions = DatabaseSessionStore(self.db, ttl=60)
+        sessions.set(1, {'photo': b'1'})
+        self.assertEqual(sessions.get(1), {'photo': b'1'})
+        self.assertIn(1, sessions)
+        sessions.delete(1)
+        self.assertNotIn(1, sessions)
+
+    def test_photos_stored_once(self):
+        self.db.create_user(2)
+        self.add_place(51.5, 0.1, 'first', photo=b'\xff\xd8same')
+        self.add_place(51.5, 0.1, 'second', photo=b'\xff\xd8same')
+        self.db.create_new_place(2, {'lat': 51.5, 'long': 0.1, 'description': 'other', 'photo': b'\xff\xd8same'})
+        conn = self.db._connection()
+        self.assertEqual(conn.execute('select count(*) from photos').fetchone()[0], 1)
+        self.db.delete_places(1)
+        self.assertEqual(conn.execute('select count(*) from photos').fetchone()[0], 1)
+        self.db.delete_places(2)
+        self.assertEqual(conn.execute('select count(*) from photos').fetchone()[0], 0)
+
+    def test_old_places_migrated(self):
+        path = os.path.join(self.tmp_dir.name, 'old.db')
+        conn = sqlite3.connect(path)
+        conn.execute('create table users (user_id integer not null primary key)')
+        conn.execute('create table places (id integer primary key, user_id integer, lat real, long real, cell integer,'
+                     ' place_description text, photo blob, photo_file_id text, created_at timestamp)')
+        conn.execute("insert into places values (1, 1, 51.5, 0.1, null, '''old''', x'ffd8', null, '2020-01-01')")
+        conn.commit()
+        conn.close()
+        db = SqliteDatabase(path)
+        self.assertEqual(db.get_last_places(1), [Place(1, 51.5, 0.1, 'old', True, None)])
+        self.assertEqual(db.get_place_photo(1), b'\xff\xd8')
+        row = db._connection().execute('select photo, photo_hash from places').fetchone()
+        self.assertEqual(row, (None, photo_hash(b'\xff\xd8')))
+        db.close()
+
+
+PhotoSize = namedtuple('PhotoSize', 'file_id width height')
+
+
+class TestPhotos(unittest.TestCase):
+
+    SIZES = [PhotoSize('s', 90, 51), PhotoSize('m', 320, 180), PhotoSize('x', 800, 450), PhotoSize('y', 2560, 1440)]
+
+    def test_choose_variant(self):
+        self.assertEqual(choose_variant(self.SIZES, max_side=1280).file_id, 'x')
+        self.assertEqual(choose_variant(self.SIZES, max_side=320).file_id, 'm')
+        self.assertEqual(choose_variant(self.SIZES, max_side=10).file_id, 's')
+
+    def test_pipeline(self):
+        started, downloads = threading.Event(), []
+
+        def download(file_id):
+            downloads.append(file_id)
+            started.wait(5)
+            if file_id == 'broken':
+                raise OSError('no file')
+            return file_id.encode()
+
+        pipeline = PhotoPipeline(download, workers=2)
+        pipeline.submit('a')
+        pipeline.submit('a')
+        self.assertEqual(pipeline.stats()['pending'], 1)
+        started.set()
+        # Data which Pillow can't read is stored as it is.
+        self.assertEqual(pipeline.result('a'), (photo_hash(b'a'), b'a'))
+        self.assertEqual(pipeline.result('b'), (photo_hash(b'b'), b'b'))
+        self.assertIsNone(pipeline.result('broken'))
+        pipeline.submit('c')
+        pipeline.discard('c')
+        pipeline.close()
+        self.assertEqual(downloads.count('a'), 1)
+        self.assertEqual(pipeline.stats()['failed'], 1)
+
+
+class TestExchange(unittest.TestCase):
+
+    PLACES = [
+        Place(1, 51.5, -0.1, 'Cafe, "old" <harbour>', has_photo=True),
+        Place(2, -33.9, 151.2, ''),
+    ]
+
+    def test_roundtrip(self):
+        for file_format in exchange.FORMATS:
+            text = io.StringIO()
+            self.assertEqual(exchange.WRITERS[file_format](self.PLACES, text, with_photos=True), 2)
+            file = io.BytesIO(text.getvalue().encode())
+            places = list(exchange.read_places(file, f'places.{file_format}'))
+            self.assertEqual([(p['lat'], p['long'], p['description']) for p in places],
+                             [(p.lat, p.long, p.description) for p in self.PLACES], file_format)
+            self.assertEqual(places[0]['photo_path'], 'photos/1.jpg')
+
+    def test_wrong_places_skipped(self):
+        file = io.BytesIO(b'lat,long,description\n91,0,north\nx,0,wrong\n10,20,ok\n')
+        self.assertEqual([place and place['description'] for place in exchange.read_places(file, 'a.csv')],
+                         [None, None, 'ok'])
+        with self.assertRaises(ValueError):
+            list(exchange.read_places(io.BytesIO(b''), 'places.txt'))
+
+    def test_wrong_features_skipped(self):
+        features = [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [0.1]}},
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': 5}},
+            {'type': 'Feature', 'geometry': [], 'properties': {}},
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [0.1, 51.5, 10]},
+             'properties': {'description': 'ok'}},
+        ]
+        file = io.BytesIO(json.dumps({'type': 'FeatureCollection', 'features': features}).encode())
+        self.assertEqual([place and place['description'] for place in exchange.read_places(file, 'a.geojson')],
+                         [None, None, None, 'ok'])
+
+    def test_photo_batches(self):
+        places = [{'photo': b'x' * 40}, {}, {'photo': b'x' * 70}, {}, {}, {}]
+        self.assertEqual([len(batch) for batch in place_batches(places, 3, max_bytes=100)], [3, 3])
+        self.assertEqual([len(batch) for batch in place_batches(places, 10, max_bytes=100)], [3, 3])
+        self.assertEqual([len(batch) for batch in place_batches(places, 10, max_bytes=40)], [1, 2, 3])
+
+    def test_big_photo_not_imported(self):
+        file = io.BytesIO()
+        with ZipFile(file, 'w') as zip_file:
+            zip_file.writestr('places.csv', 'lat,long,description,photo\n51.5,0.1,Cafe,photos/1.jpg\n')
+            zip_file.writestr('photos/1.jpg', b'x' * (exchange.MAX_PHOTO_SIZE + 1))
+        file.seek(0)
+        places = list(exchange.read_places(file, 'places.zip'))
+        self.assertEqual(places, [{'lat': 51.5, 'long': 0.1, 'description': 'Cafe'}])
+
+    def test_database_zip_with_photos(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = SqliteDatabase(os.path.join(tmp_dir, 'places.db'))
+            db.create_user(1)
+            db.create_user(2)
+            db.create_new_place(1, {'lat': 51.5, 'long': 0.1, 'description': 'Cafe', 'photo': b'\xff\xd8'})
+            db.create_new_place(1, {'lat': 51.6, 'long': 0.2, 'description': 'Park'})
+            file = io.BytesIO()
+            self.assertEqual(exchange.export_places(db, 1, file, 'gpx', with_photos=True), 2)
+            file.seek(0)
+            self.assertEqual(exchange.import_places(db, 2, file, 'places.zip'), (2, 0))
+            places = db.get_last_places(2)
+            self.assertEqual(sorted(place.description for place in places), ['Cafe', 'Park'])
+            photo_place = next(place for place in places if place.has_photo)
+            self.assertEqual(db.get_place_photo(photo_place.id), b'\xff\xd8')
+            db.close()
+
+    def test_blocking_database(self):
+        db = FakeDatabase()
+        db.places[5] = [Place(num, 51.5, 0.1, str(num)) for num in range(1, 6)]
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            blocking = exchange.BlockingDatabase(AsyncFakeDatabase(db), loop)
+            return await loop.run_in_executor(None, lambda: list(blocking.iter_places(5, chunk_size=2)))
+        self.assertEqual(asyncio.run(run()), db.places[5])
+
+
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root_handlers = logging.getLogger().handlers[:]
+        self.root_level = logging.getLogger().level
+
+    def tearDown(self):
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        for handler in self.root_handlers:
+            root.addHandler(handler)
+        root.setLevel(self.root_level)
+        self.tmp_dir.cleanup()
+
+    def test_queue_json_records(self):
+        listener = logs.setup_logging(level='INFO', path=self.tmp_dir.name, json_format=True)
+        logger = logging.getLogger('test.py')
+        logger.debug('hidden %s', 1)
+        logger.info('UserID: %s - %s', 42, 'saved')
+        try:
+            raise ValueError('wrong')
+        except ValueError:
+            logger.exception('failed')
+        listener.stop()
+        with open(os.path.join(self.tmp_dir.name, logs.LOG_FILE)) as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual([record['message'] for record in records], ['UserID: 42 - saved', 'failed'])
+        self.assertIn('ValueError: wrong', records[1]['exc_info'])
+
+    def test_queue_keeps_record(self):
+        handler = logs._QueueHandler(queue.SimpleQueue())
+        try:
+            raise ValueError('wrong')
+        except ValueError:
+            record = logging.makeLogRecord({'msg': 'UserID: %s', 'args': (42,), 'exc_info': sys.exc_info()})
+        handler.handle(record)
+        self.assertEqual((record.msg, record.args), ('UserID: %s', (42,)))
+        self.assertIsNotNone(record.exc_info)
+        queued = handler.queue.get_nowait()
+        self.assertEqual((queued.msg, queued.args, queued.exc_info), ('UserID: 42', None, None))
+
+    def test_rotation_compressed(self):
+        path = os.path.join(self.tmp_dir.name, 'bot.log')
+        handler = logs.CompressedRotatingFileHandler(path, max_bytes=100, backup_count=2)
+        for num in range(10):
+            handler.emit(logging.makeLogRecord({'msg': f'record {num} ' + 'x' * 40}))
+        handler.close()
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ['bot.log', 'bot.log.1.gz', 'bot.log.2.gz'])
+        with gzip.open(path + '.1.gz', 'rt') as file:
+            self.assertIn('record 7', file.read())
+
+    def test_rotation_counts_bytes(self):
+        path = os.path.join(self.tmp_dir.name, 'bot.log')
+        handler = logs.CompressedRotatingFileHandler(path, max_bytes=100, backup_count=1)
+        # 30 characters are 60 bytes in UTF-8: the file is rotated before the third record.
+        for _ in range(3):
+            handler.emit(logging.makeLogRecord({'msg': 'ж' * 30}))
+        handler.close()
+        self.assertEqual(os.path.getsize(path), 61)
+        self.assertTrue(os.path.exists(path + '.1.gz'))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_sampling_profiler(self):
+        stopped = threading.Event()
+
+        def busy_loop():
+            while not stopped.is_set():
+                sum(range(1000))
+
+        thread = threading.Thread(target=busy_loop, name='busy')
+        thread.start()
+        profiled = []
+        done = threading.Event()
+        profiler = SamplingProfiler(interval=0.001)
+        self.assertTrue(profiler.start(0.2, callback=lambda collapsed: (profiled.append(collapsed), done.set())))
+        self.assertFalse(profiler.start(0.2))
+        self.assertTrue(done.wait(5))
+        stopped.set()
+        thread.join()
+        collapsed = profiler.stop()
+        self.assertEqual(profiled, [collapsed])
+        self.assertFalse(profiler.running)
+        busy = [line.rsplit(' ', 1) for line in collapsed.splitlines() if line.startswith('busy;')]
+        self.assertTrue(any('test.py:busy_loop' in stack and int(count) > 0 for stack, count in busy))
+
+    def test_memory_tracer(self):
+        tracer = MemoryTracer()
+        tracer.start()
+        kept = [bytearray(1024) for _ in range(100)]
+        diff = tracer.stop()
+        self.assertFalse(tracer.running)
+        self.assertIn('test.py', diff.splitlines()[1])
+        self.assertEqual(len(kept), 100)
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_order_within_chat(self):
+        dispatcher = Dispatcher(workers=3, lane_size=10)
+        handled = {1: [], 2: []}
+        for num in range(20):
+            for chat_id in handled:
+                dispatcher.submit(chat_id, handled[chat_id].append, num)
+        dispatcher.close()
+        self.assertEqual(handled, {1: list(range(20)), 2: list(range(20))})
+
+    def test_duplicate_key_coalesced(self):
+        dispatcher = Dispatcher(workers=1, lane_size=10)
+        started, release = threading.Event(), threading.Event()
+        dispatcher.submit(1, lambda: (started.set(), release.wait(1)))
+        started.wait(1)
+        self.assertTrue(dispatcher.submit(1, lambda: None, key=(1, 'save')))
+        self.assertFalse(dispatcher.submit(1, lambda: None, key=(1, 'save')))
+        release.set()
+        dispatcher.close()
+        self.assertEqual(dispatcher.stats()['coalesced'], 1)
+
+
+def too_many_requests(retry_after):
+    result = SimpleNamespace(status_code=429, json=lambda: {'parameters': {'retry_after': retry_after}})
+    return tb.apihelper.ApiException('Too Many Requests', 'sendMessage', result)
+
+
+class TestSender(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        self.assertEqual([bucket.reserve(), bucket.reserve()], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.01)
+        bucket.pause(5)
+        self.assertGreater(bucket.reserve(), 4.9)
+        self.assertFalse(bucket.is_full())
+
+    def test_global_rate(self):
+        sender = Sender(FakeBotApi(), workers=4, global_rate=20, chat_rate=1000)
+        started = time.monotonic()
+        for chat_id in range(30):
+            sender.submit(chat_id, lambda: None)
+        sender.close()
+        # 20 calls go at once, the other 10 at 20 per second.
+        self.assertGreaterEqual(time.monotonic() - started, 0.45)
+        self.assertEqual(sender.stats()['sent'], 30)
+
+    def test_chat_rate_and_order(self):
+        sent = []
+        sender = Sender(FakeBotApi(), workers=4, global_rate=1000, chat_rate=20, chat_burst=1)
+        started = time.monotonic()
+        for num in range(6):
+            sender.submit(1, sent.append, num)
+        sender.submit(2, sent.append, 'other')
+        sender.close()
+        self.assertGreaterEqual(time.monotonic() - started, 0.24)
+        self.assertEqual([num for num in sent if num != 'other'], list(range(6)))
+        # The other chat does not wait for the first one.
+        self.assertLess(sent.index('other'), 3)
+
+    def test_retry_after_pauses_chat(self):
+        calls = []
+
+        def send(chat_id):
+            calls.append((chat_id, time.monotonic()))
+            if len(calls) == 1:
+                raise too_many_requests(0.3)
+
+        sender = Sender(FakeBotApi(), workers=2, global_rate=1000, chat_rate=1000)
+        started = time.monotonic()
+        sender.submit(1, send, 1)
+        sender.submit(1, send, 1)
+        time.sleep(0.05)
+        sender.submit(2, send, 2)
+        sender.close()
+        self.assertEqual([chat_id for chat_id, _ in calls], [1, 2, 1, 1])
+        # Only the chat which got 429 waits.
+        self.assertLess(calls[1][1] - started, 0.2)
+        self.assertGreaterEqual(calls[2][1] - calls[0][1], 0.29)
+        self.assertEqual(sender.stats()['retries'], 1)
+        self.assertEqual(sender.stats()['sent'], 3)
+
+    def test_close_drains_queue(self):
+        api = FakeBotApi()
+        sender = Sender(api, workers=2, global_rate=1000, chat_rate=1000, chat_burst=10)
+        for num in range(5):
+            sender.send_message(num % 2, text=str(num))
+        sender.close()
+        self.assertEqual(sorted(item[2] for item in api.sent), ['0', '1', '2', '3', '4'])
+        self.assertEqual(sender.stats()['queue_depth'], 0)
+        with self.assertRaises(RuntimeError):
+            sender.submit(1, lambda: None)
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def test_interface_is_abstract(self):
+        class PartialStore(SessionStore):
+            def get(self, user_id):
+                return None
+
+        with self.assertRaises(TypeError):
+            PartialStore()
+
+    def test_lru_eviction(self):
+        sessions = MemorySessionStore(ttl=60, max_size=2)
+        sessions.set(1, {'lat': 1})
+        sessions.set(2, {'lat': 2})
+        sessions.get(1)
+        sessions.set(3, {'lat': 3})
+        self.assertIn(1, sessions)
+        self.assertNotIn(2, sessions)
+        self.assertEqual(len(sessions), 2)
+
+    def test_ttl_eviction(self):
+        sessions = MemorySessionStore(ttl=0, max_size=2)
+        sessions.set(1, {'lat': 1})
+        self.assertIsNone(sessions.get(1))
+
+    def test_contains_does_not_prolong(self):
+        sessions = MemorySessionStore(ttl=60, max_size=2)
+        sessions.set(1, {'lat': 1})
+        sessions.set(2, {'lat': 2})
+        expires_at = sessions._sessions[1][0]
+        self.assertIn(1, sessions)
+        self.assertEqual(sessions._sessions[1][0], expires_at)
+        # The check doesn't make the session the newest one, so it is still evicted first.
+        sessions.set(3, {'lat': 3})
+        self.assertNotIn(1, sessions)
+        self.assertIn(2, sessions)
+
+    def test_content_encoding(self):
+        content = {'lat': 1.5, 'description': 'Cafe', 'photo': b'\xff\xd8'}
+        self.assertEqual(decode_content(encode_content(content)), content)
+
+
+class TestRoutes(unittest.TestCase):
+
+    def test_callback_main_menu(self):
+        self.assertEqual(route_callback(MAIN_MENU_TEXT, 'get_places', lambda: False), 'list_last_places')
+
+    def test_callback_place_menu_needs_session(self):
+        self.assertIsNone(route_callback(PLACE_MENU_TEXT, 'save', lambda: False))
+        self.assertEqual(route_callback(PLACE_MENU_TEXT, 'save', lambda: True), 'add_new_place_save')
+
+    def test_callback_unknown_menu(self):
+        self.assertEqual(route_callback('Your places:', 'save', lambda: True), 'main_menu')
+
+    def test_message_commands_first(self):
+        self.assertEqual(route_message('text', '/start@my_bot', lambda: True, lambda: True), 'create_new_user')
+
+    def test_message_in_session(self):
+        self.assertEqual(route_message('text', 'Cafe', lambda: True, lambda: True), 'add_new_place_description')
+        self.assertEqual(route_message('photo', None, lambda: True, lambda: False), 'add_new_place_photo')
+
+    def test_message_without_session(self):
+        self.assertEqual(route_message('text', '0000', lambda: False, lambda: True), 'check_admin_pin')
+        self.assertEqual(route_message('location', None, lambda: False, lambda: False), 'location_received')
+        self.assertEqual(route_message('text', 'Hi', lambda: False, lambda: False), 'main_menu')
+        self.assertIsNone(route_message('photo', None, lambda: False, lambda: False))
+
+    def test_callback_argument(self):
+        self.assertEqual(split_callback_data('next_page:42'), ('next_page', '42'))
+        self.assertEqual(split_callback_data('help'), ('help', None))
+        self.assertEqual(route_callback(MORE_PLACES_TEXT, 'next_page', lambda: False), 'list_older_places')
+
+    def test_search(self):
+        self.assertEqual(route_message('text', '/search old harbour', lambda: True, lambda: False), 'search_places')
+        self.assertEqual(get_command_argument('/search  old harbour '), 'old harbour')
+        self.assertEqual(get_command_argument('/search'), '')
+        question = search_text('old\nPage: harbour', 2)
+        self.assertEqual(parse_search_text(question), ('old\nPage: harbour', 2))
+        self.assertEqual(route_callback(question, 'next_page', lambda: False), 'search_next_page')
+        self.assertEqual(route_callback(question, 'menu', lambda: False), 'main_menu')
+
+    def test_export_and_import(self):
+        self.assertEqual(route_message('text', '/export gpx', lambda: True, lambda: False), 'export_places')
+        self.assertEqual(route_message('document', None, lambda: True, lambda: False), 'import_places')
+
+
+class FakeBotApi:
+    """ Bot API which records what is sent, with the signatures of telebot.TeleBot and core.aiobot.BotApi """
+
+    def __init__(self):
+        self.sent = []
+        self.files = {}
+        self._file_ids = itertools.count(1)
+
+    def _photo_message(self):
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f'sent-{next(self._file_ids)}')])
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        buttons = [button['callback_data'] for row in reply_markup.keyboard for button in row] if reply_markup else []
+        self.sent.append(('message', chat_id, text, buttons))
+
+    def send_venue(self, chat_id, latitude, longitude, title, address, **kwargs):
+        self.sent.append(('venue', chat_id, title))
+
+    def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self.sent.append(('photo', chat_id, caption))
+        return self._photo_message()
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        self.sent.append(('album', chat_id, [item.caption for item in media]))
+        return [self._photo_message() for _ in media]
+
+    def get_file(self, file_id):
+        return SimpleNamespace(file_path=f'photos/{file_id}.jpg')
+
+    def download_file(self, file_path):
+        return self.files.get(file_path, file_path.encode())
+
+    def send_document(self, chat_id, document, file_name=None, **kwargs):
+        if isinstance(document, tuple):
+            file_name, document = document
+            document = document.read()
+        with ZipFile(io.BytesIO(document)) as zip_file:
+            self.sent.append(('document', chat_id, file_name, zip_file.read('places.csv').decode()))
+
+
+class AsyncFakeApi:
+    """ FakeBotApi behind coroutines, as core.aiobot.BotApi """
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        method = getattr(self._api, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class AsyncFakeDatabase(AsyncFakeApi):
+    """ FakeDatabase behind coroutines, as core.aiodatabase.AsyncDatabase """
+
+    async def create_new_place(self, user_id, content):
+        results = []
+        self._api.create_new_place(user_id, content, callback=results.append)
+        return results[0]
+
+    async def iter_places(self, user_id, chunk_size=1000):
+        for place in self._api.iter_places(user_id, chunk_size):
+            yield place
+
+
+def message_update(text=None, location=None, photo=None, document=None):
+    message = {'message_id': 1, 'date': 0, 'chat': {'id': 5, 'type': 'private'}}
+    if text is not None:
+        message['text'] = text
+    if location is not None:
+        message['location'] = {'latitude': location[0], 'longitude': location[1]}
+    if photo is not None:
+        message['photo'] = [{'file_id': f'{photo}-small', 'width': 90, 'height': 60},
+                            {'file_id': photo, 'width': 1280, 'height': 853}]
+    if document is not None:
+        message['document'] = {'file_id': document[1], 'file_name': document[0], 'file_size': 100}
+    return tb.types.Update.de_json({'update_id': 1, 'message': message})
+
+
+def callback_update(question, data):
+    return tb.types.Update.de_json({'update_id': 1, 'callback_query': {
+        'id': '1', 'chat_instance': '1', 'data': data, 'from': {'id': 5, 'is_bot': False, 'first_name': 'A'},
+        'message': {'message_id': 2, 'date': 0, 'text': question, 'chat': {'id': 5, 'type': 'private'}}}})
+
+
+def menu(text, buttons):
+    return 'message', 5, text, buttons
+
+
+MAIN_MENU = menu(MAIN_MENU_TEXT, ['add_place', 'get_places', 'get_places_location', 'delete_places', 'help'])
+PLACE_MENU = menu(PLACE_MENU_TEXT, ['location', 'description', 'photo', 'cancel'])
+PLACE_MENU_SAVE = menu(PLACE_MENU_TEXT, ['location', 'description', 'photo', 'cancel', 'save'])
+
+
+class BotHandlersTests:
+    """ Conversations which both runtimes must answer the same; run_updates(db, updates) of a subclass runs them """
+
+    def test_add_place_and_list(self):
+        db = FakeDatabase()
+        sent = self.run_updates(db, [
+            message_update('/start'),
+            callback_update(MAIN_MENU_TEXT, 'add_place'),
+            message_update(location=(51.5, 0.1)),
+            message_update('Cafe'),
+            message_update(photo='cafe'),
+            callback_update(PLACE_MENU_TEXT, 'save'),
+            callback_update(MAIN_MENU_TEXT, 'get_places'),
+            message_update(location=(51.5, 0.1)),
+        ])
+        self.assertEqual(sent, [
+            menu(flows.WELCOME_TEXT, []), menu(HELP_TEXT, []), MAIN_MENU,
+            menu(ADD_PLACE_TEXT, []), PLACE_MENU,
+            menu(flows.LOCATION_RECEIVED_TEXT, []), PLACE_MENU,
+            menu(flows.DESCRIPTION_RECEIVED_TEXT, []), PLACE_MENU_SAVE,
+            menu(flows.PHOTO_RECEIVED_TEXT, []), PLACE_MENU_SAVE,
+            menu(flows.PLACE_SAVED_TEXT, []), MAIN_MENU,
+            menu(flows.PLACES_TEXT, []), ('photo', 5, '#1 - Cafe'), ('venue', 5, '#1 - Cafe'), MAIN_MENU,
+            menu(flows.LOCATION_RECEIVED_TEXT, []), menu(flows.PLACES_TEXT, []), ('photo', 5, '#1 - Cafe (0 m)'),
+            ('venue', 5, '#1 - Cafe (0 m)'), MAIN_MENU,
+        ])
+        self.assertEqual(db.users, {5})
+        self.assertEqual(db.places[5], [Place(1, 51.5, 0.1, 'Cafe', True)])
+        self.assertEqual(db.file_ids, {1: 'sent-2'})
+
+    def test_album_and_pages(self):
+        db = FakeDatabase()
+        db.places[5] = [Place(num, 51.5, 0.1, f'Place {num}', num <= 2) for num in range(1, 13)]
+        sent = self.run_updates(db, [callback_update(MAIN_MENU_TEXT, 'get_places')])
+        self.assertEqual(sent[:2], [menu(flows.PLACES_TEXT, []), ('album', 5, ['#1 - Place 1', '#2 - Place 2'])])
+        self.assertEqual(len([item for item in sent if item[0] == 'venue']), 10)
+        self.assertEqual(sent[-1], menu(MORE_PLACES_TEXT, ['menu', 'next_page:10']))
+        self.assertEqual(db.file_ids, {1: 'sent-1', 2: 'sent-2'})
+
+    def test_missing_photos_skipped(self):
+        db = FakeDatabase()
+        db.places[5] = [Place(num, 51.5, 0.1, f'Place {num}', True) for num in range(1, 4)]
+        db.missing_photos = {2}
+        sent = self.run_updates(db, [callback_update(MAIN_MENU_TEXT, 'get_places')])
+        self.assertEqual(sent[1], ('album', 5, ['#1 - Place 1', '#3 - Place 3']))
+        self.assertEqual(db.file_ids, {1: 'sent-1', 3: 'sent-2'})
+        db.missing_photos = {1, 2}
+        db.file_ids = {}
+        sent = self.run_updates(db, [callback_update(MAIN_MENU_TEXT, 'get_places')])
+        self.assertEqual(sent[1], ('photo', 5, '#3 - Place 3'))
+        self.assertEqual(db.file_ids, {3: 'sent-1'})
+
+    def test_place_not_saved(self):
+        db = FakeDatabase()
+        db.fail_writes = True
+        sent = self.run_updates(db, [
+            callback_update(MAIN_MENU_TEXT, 'add_place'),
+            message_update(location=(51.5, 0.1)),
+            message_update('Cafe'),
+            callback_update(PLACE_MENU_TEXT, 'save'),
+            callback_update(PLACE_MENU_TEXT, 'save'),
+        ])
+        # The second 'Save' has no place in progress.
+        self.assertEqual(sent[-2:], [menu(flows.PLACE_NOT_SAVED_TEXT, []), MAIN_MENU])
+
+    def test_search_and_admin(self):
+        db = FakeDatabase()
+        db.places[5] = [Place(1, 51.5, 0.1, 'Cafe')]
+        sent = self.run_updates(db, [
+            message_update('/search'),
+            message_update('/search Cafe'),
+            message_update('/admin'),
+            message_update('0000'),
+            message_update('/admin'),
+            message_update('1234'),
+            callback_update(ADMIN_MENU_TEXT, 'exit'),
+        ])
+        admin_menu = menu(ADMIN_MENU_TEXT, ['logs', 'stats', 'profile', 'memory', 'exit'])
+        self.assertEqual(sent, [
+            menu(SEARCH_USAGE_TEXT, []), MAIN_MENU,
+            menu(flows.PLACES_TEXT, []), ('venue', 5, '#1 - Cafe'), menu(search_text('Cafe', 1), ['menu']),
+            menu(flows.ADMIN_PROMPT_TEXT, []), MAIN_MENU,
+            menu(flows.ADMIN_PROMPT_TEXT, []), admin_menu,
+            MAIN_MENU,
+        ])
+
+    def test_export_and_import(self):
+        db = FakeDatabase()
+        db.places[5] = [Place(1, 51.5, 0.1, 'Cafe', created_at='2020-01-01T00:00:00')]
+        sent = self.run_updates(db, [
+            message_update('/export csv'),
+            message_update(document=('places.csv', 'doc')),
+        ], files={'photos/doc.jpg': b'lat,long,description\n48.85,2.35,Louvre\n100,0,Wrong\n'})
+        self.assertEqual(sent, [
+            ('document', 5, 'places_csv.zip',
+             'lat,long,description,created_at,photo\r\n51.5,0.1,Cafe,2020-01-01T00:00:00,\r\n'), MAIN_MENU,
+            menu('1 places have been imported. 1 were skipped.', []), MAIN_MENU,
+        ])
+        self.assertEqual(db.places[5][1], Place(2, 48.85, 2.35, 'Louvre'))
+
+
+class TestTelegramBot(BotHandlersTests, unittest.TestCase):
+
+    def run_updates(self, db, updates, files=None):
+        api = FakeBotApi()
+        api.files = files or {}
+        bot = TelegramBot('1:token', db, None, None, '1234', workers=1, send_rate=1000, chat_send_rate=1000,
+                          exchange_workers=1)
+        for name in ('send_message', 'send_venue', 'send_photo', 'send_media_group', 'send_document', 'get_file',
+                     'download_file'):
+            setattr(bot._bot, name, getattr(api, name))
+        bot._register_handlers()
+        for update in updates:
+            bot._process_update(update)
+        bot._close()
+        return api.sent
+
+
+@unittest.skipUnless(find_spec('aiohttp'), 'aiohttp is not installed')
+class TestAsyncTelegramBot(BotHandlersTests, unittest.TestCase):
+
+    def run_updates(self, db, updates, files=None):
+        from core.aiotbot import AsyncTelegramBot
+        api = FakeBotApi()
+        api.files = files or {}
+        bot = AsyncTelegramBot('1:token', AsyncFakeDatabase(db), None, '1234')
+        bot._api = AsyncFakeApi(api)
+
+        async def run():
+            for update in updates:
+                if update.message:
+                    await bot._handle_message(update.message)
+                else:
+                    await bot._handle_callback(update.callback_query)
+        asyncio.run(run())
+        return api.sent
+
+
+class StopPolling(Exception):
+    pass
+
+
+@unittest.skipUnless(find_spec('aiohttp'), 'aiohttp is not installed')
+class TestBotApi(unittest.TestCase):
+
+    def test_bad_answer_body(self):
+        from aiohttp import web
+        from core.aiobot import ApiError, BotApi
+
+        async def proxy_error(request):
+            return web.Response(status=502, text='<html>Bad Gateway</html>', content_type='text/html')
+
+        async def run():
+            app = web.Application()
+            app.router.add_post('/{path:.*}', proxy_error)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            api = BotApi('1:token', api_url=f'http://127.0.0.1:{port}')
+            await api.start()
+            try:
+                with self.assertRaises(ApiError) as error:
+                    await api.send_message(5, 'Hi')
+                self.assertEqual(error.exception.error_code, 502)
+            finally:
+                await api.close()
+                await runner.cleanup()
+        asyncio.run(run())
+
+    def test_socks_proxy_rejected(self):
+        from core.aiobot import BotApi
+
+        with self.assertRaises(ValueError):
+            BotApi('1:token', proxy_url='socks5://127.0.0.1:9150')
+        BotApi('1:token', proxy_url='http://127.0.0.1:3128')
+
+    def test_polling_survives_dropped_connections(self):
+        import aiohttp
+        from core.aiotbot import AsyncTelegramBot
+
+        update = message_update('/start')
+        answers = [aiohttp.ServerDisconnectedError(), aiohttp.ClientPayloadError('cut'), ValueError('bad json'),
+                   [update], StopPolling()]
+        offsets = []
+        delays = []
+
+        async def get_updates(offset=None, timeout=10):
+            offsets.append(offset)
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        async def handle_update(chat_id, update):
+            bot._semaphore.release()
+
+        async def sleep(delay):
+            delays.append(delay)
+
+        async def delete_webhook():
+            pass
+
+        bot = AsyncTelegramBot('1:token', AsyncFakeDatabase(FakeDatabase()), None, '1234')
+        bot._api = SimpleNamespace(delete_webhook=delete_webhook, get_updates=get_updates)
+        bot._handle_update = handle_update
+
+        async def run():
+            bot._semaphore = asyncio.Semaphore(10)
+            with unittest.mock.patch('core.aiotbot.asyncio.sleep', sleep), self.assertRaises(StopPolling):
+                await bot._polling()
+        asyncio.run(run())
+        self.assertEqual(delays, [1, 2, 4])
+        self.assertEqual(offsets[-1], update.update_id + 1)
+
+
+class TestWebhookServer(unittest.TestCase):
+
+    UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'text': 'Hi',
+                                          'chat': {'id': 5, 'type': 'private'}}}
+
+    def setUp(self):
+        self.received = []
+        self.server = WebhookServer(self.received.append, host='127.0.0.1', port=0,
+                                    path='/hook', secret_token='secret')
+        self.server.start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def post(self, path, token):
+        request = Request(f'http://127.0.0.1:{self.server.port}{path}',
+                          data=json.dumps(self.UPDATE).encode(),
+                          headers={SECRET_HEADER: token, 'Content-Type': 'application/json'})
+        try:
+            return urlopen(request, timeout=5).status
+        except HTTPError as err:
+            return err.code
+
+    def test_update_received(self):
+        self.assertEqual(self.post('/hook', 'secret'), 200)
+        self.assertEqual(self.received, [self.UPDATE])
+
+    def test_wrong_secret(self):
+        self.assertEqual(self.post('/hook', 'wrong'), 403)
+        self.assertEqual(self.post('/other', 'secret'), 404)
+        self.assertEqual(self.received, [])
+
+    def test_secret_generated(self):
+        server = WebhookServer(self.received.append, host='127.0.0.1', port=0, path='/hook')
+        self.assertTrue(server.secret_token)
+        server.start()
+        try:
+            request = Request(f'http://127.0.0.1:{server.port}/hook', data=json.dumps(self.UPDATE).encode())
+            with self.assertRaises(HTTPError) as err:
+                urlopen(request, timeout=5)
+            self.assertEqual(err.exception.code, 403)
+        finally:
+            server.close()
+        self.assertEqual(self.received, [])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        counter = registry.counter('calls_total', 'Calls.', ('method',))
+        histogram = registry.histogram('call_seconds', 'Call time.', ('method',), buckets=(0.1, 1))
+        counter.labels('send "x"').inc()
+        counter.labels('send "x"').inc(2)
+        for value in (0.05, 0.5, 5):
+            histogram.labels('get').observe(value)
+        text = registry.render(stats={'db': {'connections': 3, 'name': 'x'}})
+        self.assertIn('# TYPE calls_total counter\ncalls_total{method="send \\"x\\""} 3\n', text)
+        self.assertIn('call_seconds_bucket{method="get",le="0.1"} 1\n', text)
+        self.assertIn('call_seconds_bucket{method="get",le="+Inf"} 3\n', text)
+        self.assertIn('call_seconds_count{method="get"} 3\n', text)
+        self.assertIn('bot_db_connections 3\n', text)
+        self.assertNotIn('name', text)
+        self.assertEqual(registry.render(samples=registry.samples()), registry.render())
+
+    def test_instrumented_database(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = InstrumentedDatabase(SqliteDatabase(os.path.join(tmp_dir, 'places.db')))
+            histogram = DB_QUERY_SECONDS.labels('get_last_places')
+            count = histogram.count
+            self.assertEqual(db.get_last_places(1), [])
+            db.get_last_places(1)
+            self.assertEqual(histogram.count, count + 2)
+            self.assertEqual(list(db.iter_places(1)), [])
+            db.close()
+
+    def test_instrumented_async_database(self):
+        db = InstrumentedDatabase(AsyncFakeDatabase(FakeDatabase()))
+        histogram = DB_QUERY_SECONDS.labels('get_last_places')
+        count = histogram.count
+
+        async def run():
+            self.assertEqual(await db.get_last_places(1), [])
+            return [place async for place in db.iter_places(1)]
+        self.assertEqual(asyncio.run(run()), [])
+        self.assertEqual(histogram.count, count + 1)
+
+    def test_server(self):
+        server = MetricsServer(lambda: 'calls_total 1\n', host='127.0.0.1', port=0)
+        server.start()
+        try:
+            with urlopen(f'http://127.0.0.1:{server.port}/metrics', timeout=5) as response:
+                self.assertEqual(response.read(), b'calls_total 1\n')
+            with self.assertRaises(HTTPError):
+                urlopen(f'http://127.0.0.1:{server.port}/other', timeout=5)
+        finally:
+            server.close()
+
+    def test_stats_text(self):
+        self.assertEqual(stats_text({'sender': {'sent': 2, 'latency_avg': 0.123456}}),
+                         'sender_sent: 2\nsender_latency_avg: 0.1235')
+        self.assertEqual(len(stats_text({'x' * 5000: 1})), 4000)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def test_update_chat_id(self):
+        self.assertEqual(get_update_chat_id({'update_id': 1, 'message': {'chat': {'id': 42}}}), 42)
+        self.assertEqual(get_update_chat_id(
+            {'update_id': 2, 'callback_query': {'from': {'id': 7}, 'message': {'chat': {'id': 43}}}}), 43)
+        self.assertIsNone(get_update_chat_id({'update_id': 3, 'poll': {}}))
+
+    def test_chats_spread_over_lanes(self):
+        for processes, lanes in ((8, 8), (4, 8), (3, 6), (1, 8)):
+            for worker_num in range(processes):
+                chat_ids = [chat_id for chat_id in range(1, 20_001) if get_worker_num(chat_id, processes) == worker_num]
+                counts = [0] * lanes
+                for chat_id in chat_ids:
+                    counts[get_lane_num(chat_id, lanes)] += 1
+                # Every lane gets its share within 20 %.
+                self.assertGreater(min(counts), len(chat_ids) / lanes * 0.8, (processes, lanes, counts))
+
+    def test_aggregate_stats(self):
+        stats = aggregate_stats([
+            {'db': {'in_use': 1, 'max_size': 10, 'wait_time_max': 0.5, 'utilisation': 0.2}, 'sender': {'sent': 3}},
+            {'db': {'in_use': 2, 'max_size': 10, 'wait_time_max': 0.1, 'utilisation': 0.4}, 'sender': {'sent': 4}},
+        ])
+        self.assertEqual(stats['db']['in_use'], 3)
+        # Every worker has its own pool.
+        self.assertEqual(stats['db']['max_size'], 20)
+        self.assertEqual(stats['db']['wait_time_max'], 0.5)
+        self.assertAlmostEqual(stats['db']['utilisation'], 0.3)
+        self.assertEqual(stats['sender']['sent'], 7)
+
+
 if __name__ == "__main__":
-  unittest.main()
\ No newline at end of file
+  unittest.main()